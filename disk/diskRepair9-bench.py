@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+#
+# Author: Peter Maloney
+#
+# Benchmark and regression test for diskRepair9.py (Linux only, run as root)
+#
+# Makes a loop device on a sparse file, with bad sectors at known LBAs, and runs diskRepair9.py on it with each action and scan backend. For each run it reports:
+#     MB/s (from the start and done events of --events)
+#     read and write syscalls per GB (from /proc/self/io of the diskRepair9 process)
+#     peak resident memory (from wait4)
+#     whether every bad sector was found, and rewritten (or for zerogood, left alone)
+#
+# The bad sectors are made one of two ways:
+#     dm = (default if device-mapper works) a dm table over the loop device, with an error target for each bad sector. The kernel really fails the IO, but writes fail too, so the sectors can never be repaired, and only finding them is checked.
+#     file = diskRepair9.py runs in a wrapper that fails reads of the bad sectors in the python file and os functions it uses, and makes a bad sector good when it is written, like a disk remapping it.
+#            A real unreadable page under mmap is a SIGBUS, not an OSError, which the wrapper can't fake, so the mmap backend is only run in dm mode.
+#
+# With --save, the results are saved as json, and with --compare, a run fails if any MB/s is more than --tolerance percent lower than in the saved results.
+#
+# Licensed GNU GPLv2; if you did not recieve a copy of the license, get one at http://www.gnu.org/licenses/gpl-2.0.html
+
+import sys
+import os
+import argparse
+import subprocess
+import tempfile
+import shutil
+import random
+import json
+import array
+
+################################################################################
+# error codes
+################################################################################
+
+failed_test=1
+bad_argparse=2 # defined by argparse, not used here
+missing_command=3
+
+################################################################################
+# Output functions
+################################################################################
+
+def info(txt):
+    print("INFO: %s" % (txt))
+    sys.stdout.flush()
+
+def error(txt):
+    print("ERROR: %s" % (txt))
+    sys.stdout.flush()
+
+################################################################################
+# fault injection
+################################################################################
+
+# This runs as the diskRepair9 process (python3 -c), with the settings in the environment. It installs the fault injection (mode file), and at exit writes its stats, then runs diskRepair9.py as __main__.
+bootstrap = r'''
+import os, sys, json, errno, atexit, builtins, runpy, threading
+
+settings = json.loads(os.environ["DISKREPAIR9_BENCH"])
+device = settings["device"]
+sector_size = settings["sector_size"]
+bad = set(settings["inject"])
+lock = threading.Lock()
+device_rdev = os.stat(device).st_rdev
+
+def is_device(fd):
+    try:
+        return os.fstat(fd).st_rdev == device_rdev
+    except OSError:
+        return False
+
+def check(offset, length):
+    if length <= 0:
+        return
+    first = offset // sector_size
+    last = (offset + length - 1) // sector_size
+    with lock:
+        for sector in bad:
+            if first <= sector <= last:
+                raise OSError(errno.EIO, "Input/output error (injected at sector %s)" % sector)
+
+def written(offset, length):
+    with lock:
+        for sector in range(offset // sector_size, (offset + length + sector_size - 1) // sector_size):
+            bad.discard(sector)
+
+if bad:
+    real_preadv = os.preadv
+    real_pread = os.pread
+    real_pwrite = os.pwrite
+    real_open = builtins.open
+
+    def preadv(fd, buffers, offset, *a):
+        if is_device(fd):
+            check(offset, sum(len(b) for b in buffers))
+        return real_preadv(fd, buffers, offset, *a)
+
+    def pread(fd, length, offset):
+        if is_device(fd):
+            check(offset, length)
+        return real_pread(fd, length, offset)
+
+    def pwrite(fd, data, offset, *a):
+        n = real_pwrite(fd, data, offset, *a)
+        if is_device(fd):
+            written(offset, n)
+        return n
+
+    # the buffered scan backend
+    class InjectingFile():
+        def __init__(self, f):
+            self.f = f
+        def read(self, n=-1):
+            check(self.f.tell(), n)
+            return self.f.read(n)
+        def __getattr__(self, name):
+            return getattr(self.f, name)
+        def __enter__(self):
+            return self
+        def __exit__(self, *a):
+            self.f.close()
+
+    def open_(file, mode="r", *a, **k):
+        f = real_open(file, mode, *a, **k)
+        if isinstance(file, str) and os.path.realpath(file) == os.path.realpath(device) and "r" in mode and "b" in mode:
+            return InjectingFile(f)
+        return f
+
+    os.preadv = preadv
+    os.pread = pread
+    os.pwrite = pwrite
+    builtins.open = open_
+
+def save_stats():
+    stats = {"inject_left": sorted(bad)}
+    with open("/proc/self/io") as f:
+        for line in f:
+            key, value = line.split(":")
+            stats[key] = int(value)
+    with open(settings["stats"], "w") as f:
+        json.dump(stats, f)
+atexit.register(save_stats)
+
+sys.argv = [settings["script"]] + settings["args"]
+runpy.run_path(settings["script"], run_name="__main__")
+'''
+
+################################################################################
+# devices
+################################################################################
+
+def run_cmd(cmd, **k):
+    return subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **k).stdout.decode("utf-8").strip()
+
+def dm_works():
+    if not shutil.which("dmsetup"):
+        return False
+    p = subprocess.run(["dmsetup", "version"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return p.returncode == 0
+
+# a loop device on a sparse file, optionally with a dm table that fails the bad sectors
+class TestDevice():
+    def __init__(self, work_dir, size, bad, mode, sector_size=512):
+        self.image = os.path.join(work_dir, "disk.img")
+        with open(self.image, "wb") as f:
+            f.truncate(size)
+        self.size = size
+        self.sectors = size // sector_size
+        self.sector_size = sector_size
+        self.bad = bad
+        self.mode = mode
+        self.dm_name = None
+        self.loop = run_cmd(["losetup", "--find", "--show", "--sector-size", str(sector_size), self.image])
+        self.path = self.loop
+
+        if mode == "dm":
+            dm_name = "diskRepair9-bench-%s" % os.getpid()
+            try:
+                run_cmd(["dmsetup", "create", dm_name], input=self.dm_table().encode("utf-8"))
+            except:
+                # close() won't be called, since the constructor failed
+                run_cmd(["losetup", "--detach", self.loop])
+                raise
+            self.dm_name = dm_name
+            self.path = "/dev/mapper/%s" % self.dm_name
+
+    # linear segments of the loop device, with an error target for each bad sector (dm tables are in 512 byte sectors)
+    def dm_table(self):
+        lines = []
+        units = self.sector_size // 512
+        start = 0
+        for sector in sorted(self.bad) + [self.sectors]:
+            if sector > start:
+                lines += ["%s %s linear %s %s" % (start*units, (sector - start)*units, self.loop, start*units)]
+            if sector < self.sectors:
+                lines += ["%s %s error" % (sector*units, units)]
+            start = sector + 1
+        return "\n".join(lines) + "\n"
+
+    # makes the disk look like new for the next run: no data, and nothing cached
+    # Truncating the image to nothing and back makes it all holes again, which read as zeros, so what a zerogood or zeroall case wrote doesn't change the next case.
+    def reset(self):
+        with open(self.image, "r+b") as f:
+            f.truncate(0)
+            f.truncate(self.size)
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        if self.dm_name:
+            run_cmd(["dmsetup", "remove", self.dm_name])
+        run_cmd(["losetup", "--detach", self.loop])
+
+################################################################################
+# runs
+################################################################################
+
+# runs diskRepair9.py once, and returns a dict of the results
+# scans is False for actions that only read a list of sectors, where MB/s means nothing
+def run_case(options, device, name, diskrepair_args, inject, expect_rewritten, scans):
+    work_dir = tempfile.mkdtemp(prefix="diskRepair9-bench-")
+    try:
+        events_path = os.path.join(work_dir, "events.jsonl")
+        stats_path = os.path.join(work_dir, "stats.json")
+        state_dir = os.path.join(work_dir, "state")
+        args = diskrepair_args + ["--events", events_path, "--state-dir", state_dir, "--throttle", "none", "--slow-threshold", "0", device.path]
+        settings = {
+            "device": device.path,
+            "sector_size": device.sector_size,
+            "inject": sorted(inject),
+            "stats": stats_path,
+            "script": options.script,
+            "args": args,
+        }
+        env = dict(os.environ)
+        env["DISKREPAIR9_BENCH"] = json.dumps(settings)
+
+        device.reset()
+        with open(os.path.join(work_dir, "output.txt"), "wb") as out:
+            p = subprocess.Popen([sys.executable, "-c", bootstrap], env=env, stdout=out, stderr=subprocess.STDOUT)
+            pid, status, rusage = os.wait4(p.pid, 0)
+        returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status >> 8
+
+        events = []
+        if os.path.exists(events_path):
+            with open(events_path) as f:
+                events = [json.loads(line) for line in f]
+        stats = {}
+        if os.path.exists(stats_path):
+            with open(stats_path) as f:
+                stats = json.load(f)
+
+        # found: in the checkpoint's bad sectors, or repaired or failed to be repaired
+        found = set()
+        for path in os.listdir(state_dir) if os.path.exists(state_dir) else []:
+            if path.endswith(".bad"):
+                a = array.array("Q")
+                with open(os.path.join(state_dir, path), "rb") as f:
+                    a.frombytes(f.read())
+                found.update(a)
+        rewritten = set()
+        for e in events:
+            if e["event"] in ["repair_ok", "repair_failed", "salvaged", "lost"]:
+                found.add(e["sector"])
+            if e["event"] == "repair_ok":
+                rewritten.add(e["sector"])
+
+        start = [e for e in events if e["event"] == "start"]
+        done = [e for e in events if e["event"] == "done"]
+        elapsed = None
+        if start and done:
+            elapsed = done[-1]["time"] - start[0]["time"]
+        gb = device.size / 1000000000
+
+        result = {
+            "name": name,
+            "returncode": returncode,
+            "elapsed": elapsed,
+            "mb_per_s": round(device.size / elapsed / 1000000, 2) if elapsed and scans else None,
+            "read_syscalls_per_gb": round(stats.get("syscr", 0) / gb),
+            "write_syscalls_per_gb": round(stats.get("syscw", 0) / gb),
+            "peak_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+            "bad": len(device.bad),
+            "found": len(found & set(device.bad)),
+            "rewritten": len(rewritten & set(device.bad)),
+        }
+
+        problems = []
+        if returncode != 0:
+            problems += ["exit status %s" % returncode]
+        if result["found"] != len(device.bad):
+            problems += ["found %s of %s bad sectors" % (result["found"], len(device.bad))]
+        if expect_rewritten and result["rewritten"] != len(device.bad):
+            problems += ["rewrote %s of %s bad sectors" % (result["rewritten"], len(device.bad))]
+        if not expect_rewritten and result["rewritten"]:
+            problems += ["rewrote %s bad sectors, but should have left them alone" % (result["rewritten"])]
+        if inject and not expect_rewritten and len(stats.get("inject_left", [])) != len(inject):
+            problems += ["wrote over %s bad sectors" % (len(inject) - len(stats.get("inject_left", [])))]
+        result["problems"] = problems
+
+        if problems and options.keep:
+            info("%s - output kept in %s" % (name, work_dir))
+            work_dir = None
+        return result
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir)
+
+# returns a list of (name, diskRepair9 args, expect_rewritten, scans) for the runs to do
+def get_cases(options, mode, kmsg_file):
+    cases = []
+    for backend in options.backends:
+        if( backend == "mmap" and mode == "file" ):
+            info("skipping the mmap backend; file mode can't inject its real failure, a SIGBUS, so it only runs in dm mode")
+            continue
+        backend_args = ["--backend", backend, "--queue-depth", str(options.queue_depth)]
+        if backend == "mmap":
+            backend_args = ["--backend", backend]
+        cases += [
+            ("scan %s" % backend, ["-a", "zerobad", "--dry-run"] + backend_args, False, True),
+            ("zerobad %s" % backend, ["-a", "zerobad"] + backend_args, mode == "file", True),
+            ("zerogood %s" % backend, ["-a", "zerogood"] + backend_args, False, True),
+        ]
+    # quick doesn't scan, so the backend doesn't matter; it gets the bad sectors from a made up kernel log
+    quick_action = "quick"
+    if not shutil.which("smartctl"):
+        quick_action = "zerobaddmesg"
+    cases += [(quick_action, ["-a", quick_action, "--kmsg-file", kmsg_file], mode == "file", False)]
+    return cases
+
+def print_results(results):
+    columns = ["name", "mb_per_s", "read_syscalls_per_gb", "write_syscalls_per_gb", "peak_rss_mb", "found", "rewritten"]
+    titles = ["run", "MB/s", "reads/GB", "writes/GB", "RSS MB", "found", "rewritten"]
+    widths = [max([len(t), 9] + [len(str(r[c])) for r in results]) for c, t in zip(columns, titles)]
+    print("  ".join(t.ljust(w) for t, w in zip(titles, widths)) + "  result")
+    for r in results:
+        values = [str(r[c]) for c in columns]
+        values[5] = "%s/%s" % (r["found"], r["bad"])
+        values[6] = "%s/%s" % (r["rewritten"], r["bad"])
+        print("  ".join(v.ljust(w) for v, w in zip(values, widths)) + "  " + ("; ".join(r["problems"]) or "ok"))
+
+# returns a list of problems for runs that got slower than in the saved results
+def compare(results, path, tolerance):
+    with open(path) as f:
+        saved = {r["name"]: r for r in json.load(f)}
+    problems = []
+    for r in results:
+        old = saved.get(r["name"])
+        if not old or not old["mb_per_s"] or not r["mb_per_s"]:
+            continue
+        change = 100 * (r["mb_per_s"] - old["mb_per_s"]) / old["mb_per_s"]
+        info("%s - %.2f MB/s, was %.2f MB/s (%+.1f %%)" % (r["name"], r["mb_per_s"], old["mb_per_s"], change))
+        if change < -tolerance:
+            problems += ["%s got %.1f %% slower" % (r["name"], -change)]
+    return problems
+
+################################################################################
+# Main
+################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark diskRepair9.py, and check that it finds and repairs injected bad sectors.")
+    parser.add_argument('--script', action='store', type=str,
+                    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "diskRepair9.py"),
+                    help="the diskRepair9.py to test (default: the one next to this script)")
+    parser.add_argument('--mode', action='store', type=str, default="auto", choices=["auto", "dm", "file"],
+                    help="how to make bad sectors: dm = dm error targets; file = fault injection in the diskRepair9 process; auto = (default) dm if device-mapper works, else file")
+    parser.add_argument('--size', action='store', type=int, default=256*1024*1024,
+                    help="size of the test disk in bytes (default 268435456)")
+    parser.add_argument('--sector-size', action='store', type=int, default=512,
+                    help="logical sector size of the test disk (default 512)")
+    parser.add_argument('--bad', action='store', type=str, default=None,
+                    help="comma separated bad sectors (default: --bad-count random sectors)")
+    parser.add_argument('--bad-count', action='store', type=int, default=8,
+                    help="how many random bad sectors to make (default 8)")
+    parser.add_argument('--seed', action='store', type=int, default=9,
+                    help="seed for the random bad sectors (default 9)")
+    parser.add_argument('--backends', action='store', type=str, default="buffered,mmap,direct",
+                    help="comma separated scan backends to run (default buffered,mmap,direct)")
+    parser.add_argument('-q', '--queue-depth', action='store', type=int, default=1,
+                    help="--queue-depth for the buffered and direct backends (default 1)")
+    parser.add_argument('--save', action='store', type=str, default=None,
+                    help="save the results to this json file")
+    parser.add_argument('--compare', action='store', type=str, default=None,
+                    help="compare MB/s to results saved with --save")
+    parser.add_argument('--tolerance', action='store', type=float, default=10,
+                    help="for --compare, how many percent slower is still ok (default 10)")
+    parser.add_argument('--keep', action='store_const', const=True, default=False,
+                    help="keep the output and state of failed runs")
+    options = parser.parse_args()
+    options.backends = options.backends.split(",")
+
+    mode = options.mode
+    if mode == "auto":
+        mode = "dm" if dm_works() else "file"
+    if mode == "dm" and not dm_works():
+        error("device-mapper doesn't work here; use --mode file")
+        exit(missing_command)
+
+    sectors = options.size // options.sector_size
+    if options.bad:
+        bad = sorted(set(int(s) for s in options.bad.split(",")))
+    else:
+        bad = sorted(random.Random(options.seed).sample(range(0, sectors), options.bad_count))
+    info("mode = %s, size = %s, bad sectors = %s" % (mode, options.size, bad))
+
+    work_dir = tempfile.mkdtemp(prefix="diskRepair9-bench-")
+    device = None
+    try:
+        device = TestDevice(work_dir, options.size, bad, mode, options.sector_size)
+        kernel_name = os.path.basename(os.path.realpath(device.path))
+        kmsg_file = os.path.join(work_dir, "kmsg.txt")
+        with open(kmsg_file, "w") as f:
+            for sector in bad:
+                # the block layer logs 512 byte sectors
+                f.write("blk_update_request: I/O error, dev %s, sector %s op 0x0:(READ)\n" % (kernel_name, sector * options.sector_size // 512))
+
+        inject = bad if mode == "file" else []
+        results = []
+        for name, diskrepair_args, expect_rewritten, scans in get_cases(options, mode, kmsg_file):
+            info("running %s" % (name))
+            results += [run_case(options, device, name, diskrepair_args, inject, expect_rewritten, scans)]
+    finally:
+        if device:
+            device.close()
+        shutil.rmtree(work_dir)
+
+    print_results(results)
+    problems = [p for r in results for p in r["problems"]]
+    if options.compare:
+        problems += compare(results, options.compare, options.tolerance)
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump(results, f, indent=1)
+
+    for p in problems:
+        error(p)
+    if problems:
+        exit(failed_test)
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,19 @@ import time
 import random
 import os
 import glob
+import fnmatch
+import errno
+import mmap
+import json
+import array
+import threading
+import bisect
+import contextlib
+import hashlib
+import re
+import math
+import struct
+import collections
 
 ################################################################################
 # error codes
@@ -34,6 +47,9 @@ sameline_used=0
 debug_enabled = False
 syslog_enabled = False
 
+# in parallel mode, the worker processes send their output to the controller in this queue, so the controller can print it above the dashboard
+output_queue = None
+
 # Does not print a newline at the end, and if called more than once, the later lines overwrite the previous ones
 def sameline(text):
     global sameline_used
@@ -60,12 +76,19 @@ def samelinereturn():
         print()
         sameline_used = 0
 
-def info(txt, end='\n'):
+# prints a line of output, or in a parallel worker, sends it to the controller to print
+def output(txt, end='\n'):
+    if output_queue != None:
+        output_queue.put(txt)
+        return
     samelinereturn()
-    txt = "INFO: %s" % (txt)
     print(txt, end=end)
     sys.stdout.flush()
 
+def info(txt, end='\n'):
+    txt = "INFO: %s" % (txt)
+    output(txt, end=end)
+
     if syslog_enabled:
         syslog.syslog(syslog.LOG_INFO, txt)
         
@@ -74,28 +97,21 @@ def debug(txt, end='\n'):
         return
     
     txt = "DEBUG: %s" % (txt)
-
-    samelinereturn()
-    print(txt, end=end)
-    sys.stdout.flush()
+    output(txt, end=end)
 
     if syslog_enabled:
         syslog.syslog(syslog.LOG_DEBUG, txt)
 
 def warn(txt, end='\n'):
-    samelinereturn()
     txt = "WARN: %s" % (txt)
-    print(txt, end=end)
-    sys.stdout.flush()
+    output(txt, end=end)
 
     if syslog_enabled:
         syslog.syslog(syslog.LOG_WARNING, txt)
 
 def error(txt, end='\n'):
-    samelinereturn()
     txt = "ERROR: %s" % (txt)
-    print(txt, end=end)
-    sys.stdout.flush()
+    output(txt, end=end)
 
     if syslog_enabled:
         syslog.syslog(syslog.LOG_ERR, txt)
@@ -108,79 +124,279 @@ def dump(chunk):
     pass
 
 ################################################################################
-# misc functions
+# device discovery
 ################################################################################
 
-def get_serial(dev_path):
-    ex = "/dev/disk/by-id/ata-*"
-    matches = glob.glob(ex)
+# one block device found in sysfs, with what is known about it
+class DiskInfo():
+    def __init__(self, name):
+        self.name = name
+        self.path = "/dev/%s" % name
+        self.sysfs_dir = "/sys/class/block/%s" % name
+        self.serial = None
+        self.wwn = None
+        self.model = None
+        self.transport = None
+        self.rotational = False
+        self.removable = False
+        self.size = 0
+        # for a partition, the DiskInfo of its disk
+        self.parent = None
+        self.partition = None
+        # the names in /dev/disk/by-id that link to this device
+        self.ids = []
+        # the names of the devices this one is made of (for dm and md devices)
+        self.slaves = []
+
+    def __str__(self):
+        return "%s serial=%s wwn=%s model=%s transport=%s%s" % (self.path, self.serial, self.wwn, self.model, self.transport, " rotational" if self.rotational else "")
 
-    dev_path_r = os.path.realpath(dev_path)
+    # the value a selector key matches against, which is None if the device doesn't have it; raises an Exception for an unknown key
+    def get(self, key):
+        if key in ["name", "path", "serial", "wwn", "model", "transport", "rotational", "removable"]:
+            return getattr(self, key)
+        if key == "id":
+            return self.ids
+        raise Exception("unknown selector key \"%s\"; known keys are name, path, serial, wwn, model, transport, id, rotational, removable" % (key))
 
-    shortest_match = None
-    
-    for m in matches:
-        dev_path2 = os.path.realpath(m)
-        if dev_path == dev_path2 or dev_path:
-            s = m.split("_")
-            match = s[-1]
-            if not shortest_match or len(match) < len(shortest_match):
-                # the shortest should contain the serial; others probably have things like "-part1" on the end
-                shortest_match = match
-    
-    if shortest_match:
-        return shortest_match
+# guesses the transport from the sysfs device path, like /sys/devices/pci0000:00/0000:00:1f.2/ata1/host0/target0:0:0/0:0:0:0/block/sda
+def get_transport(name, sysfs_path):
+    parts = sysfs_path.split("/")
+    if name.startswith("dm-"):
+        return "dm"
+    if name.startswith("md"):
+        return "md"
+    if name.startswith("loop"):
+        return "loop"
+    if "nvme" in parts or name.startswith("nvme"):
+        return "nvme"
+    if any(p.startswith("usb") for p in parts):
+        return "usb"
+    if any(re.match(r"ata[0-9]+$", p) for p in parts):
+        return "sata"
+    if any(p.startswith("virtio") for p in parts):
+        return "virtio"
+    if any(p.startswith("mmc") for p in parts):
+        return "mmc"
+    if any(re.match(r"host[0-9]+$", p) for p in parts):
+        if any(p.startswith("end_device-") or p.startswith("expander-") for p in parts):
+            return "sas"
+        return "scsi"
+    if "virtual" in parts:
+        return "virtual"
+    return None
+
+# the serial at the end of a /dev/disk/by-id name, like ata-ST3000DM001-1CH166_Z1F41BLC, or None if the name doesn't have one
+def get_by_id_serial(id_name):
+    if "-part" in id_name.rsplit("_", 1)[-1]:
+        return None
+    prefix = id_name.split("-", 1)[0]
+    if prefix not in ["ata", "nvme", "scsi", "usb", "virtio", "mmc", "ieee1394"] or "_" not in id_name:
+        return None
+    return id_name.rsplit("_", 1)[-1] or None
+
+# An index of the block devices, made by walking /sys/class/block and /dev/disk/by-id once, so looking up a device by path, serial or wwn, or picking devices with a selector, doesn't glob or run anything per device.
+class DiskIndex():
+    # kinds of devices that "all" leaves out; they are not disks, or are made of files or memory
+    not_disks_re = re.compile(r"(loop|ram|zram|sr|fd|nbd)[0-9]+$")
+
+    def __init__(self, sysfs_dir="/sys/class/block", by_id_dir="/dev/disk/by-id"):
+        # name -> DiskInfo
+        self.disks = collections.OrderedDict()
+        # serial, wwn and by-id name -> DiskInfo
+        self.keys = {}
+
+        try:
+            names = sorted(os.listdir(sysfs_dir))
+        except OSError:
+            names = []
+        for name in names:
+            self.disks[name] = self.load(name)
+
+        for name, info in self.disks.items():
+            if info.partition != None:
+                parent_name = os.path.basename(os.path.dirname(os.path.realpath(info.sysfs_dir)))
+                info.parent = self.disks.get(parent_name)
+
+        try:
+            id_names = sorted(os.listdir(by_id_dir))
+        except OSError:
+            id_names = []
+        for id_name in id_names:
+            name = os.path.basename(os.path.realpath(os.path.join(by_id_dir, id_name)))
+            info = self.disks.get(name)
+            if not info:
+                continue
+            info.ids += [id_name]
+            if id_name.startswith("wwn-") and not info.wwn:
+                info.wwn = id_name[4:]
+            elif not info.serial:
+                info.serial = get_by_id_serial(id_name)
+
+        for name, info in self.disks.items():
+            parent = info.parent
+            if parent:
+                # partitions get the serial of the disk, so they have their own checkpoints and logs
+                if parent.serial and not info.serial:
+                    info.serial = "%s-part%s" % (parent.serial, info.partition)
+                for attr in ["model", "transport", "rotational", "removable"]:
+                    setattr(info, attr, getattr(parent, attr))
+            for key in [info.serial, info.wwn] + info.ids:
+                if key:
+                    self.keys.setdefault(key, info)
 
+    def load(self, name):
+        info = DiskInfo(name)
+        sysfs_dir = info.sysfs_dir
+        info.partition = int_or_none(read_sysfs(sysfs_dir + "/partition"))
+        info.size = (int_or_none(read_sysfs(sysfs_dir + "/size")) or 0)*512
+        info.transport = get_transport(name, os.path.realpath(sysfs_dir))
+        if info.partition == None:
+            info.serial = read_sysfs_serial(sysfs_dir)
+            info.wwn = read_sysfs(sysfs_dir + "/wwid") or read_sysfs(sysfs_dir + "/device/wwid") or None
+            info.model = read_sysfs(sysfs_dir + "/device/model") or None
+            info.rotational = read_sysfs(sysfs_dir + "/queue/rotational") == "1"
+            info.removable = read_sysfs(sysfs_dir + "/removable") == "1"
+            try:
+                info.slaves = sorted(os.listdir(sysfs_dir + "/slaves"))
+            except OSError:
+                pass
+        if info.transport == "dm":
+            # We assume there is no serial for device mapper devices, so use the more stable path, /dev/mapper/<name>
+            dm_name = read_sysfs(sysfs_dir + "/dm/name")
+            if dm_name:
+                info.serial = "/dev/mapper/%s" % dm_name
+        return info
+
+    # returns the DiskInfo for a device path (which may be a symlink), or None
+    def get(self, path):
+        return self.disks.get(os.path.basename(os.path.realpath(path)))
+
+    # returns the DiskInfo for a serial, wwn, or the end of a /dev/disk/by-id name (like the old glob "/dev/disk/by-id/*<serial>"), or None
+    def find(self, key):
+        info = self.keys.get(key)
+        if info:
+            return info
+        matches = set()
+        for id_key, info in self.keys.items():
+            if id_key.endswith(key):
+                matches.add(info.name)
+        if len(matches) > 1:
+            raise Exception("\"%s\" matched multiple devices: %s" % (key, sorted(matches)))
+        if matches:
+            return self.disks[matches.pop()]
+        return None
+
+    # the disks (not partitions) that "all" selects
+    # Devices made of other devices (dm, md) are left out, since their disks are already in the list, and a destructive action would otherwise hit the same disks twice.
+    def all(self):
+        return [info for info in self.disks.values() if info.partition == None and info.size and not self.not_disks_re.match(info.name)
+                and not info.slaves and info.transport not in ["dm", "md"]]
+
+    # returns the disks matching a selector, which is comma separated terms that all have to match
+    # A term is key=pattern (shell style, like model=ST3000*), or a key alone for the true/false keys (rotational, removable), or either with "!" in front to negate it.
+    def select(self, selector):
+        ret = []
+        terms = selector.split(",")
+        for info in self.disks.values():
+            if info.partition != None or not info.size:
+                continue
+            if all(self.match(info, term) for term in terms):
+                ret += [info]
+        return ret
+
+    def match(self, info, term):
+        negate = term.startswith("!")
+        if negate:
+            term = term[1:]
+        if "=" in term:
+            key, pattern = term.split("=", 1)
+            value = info.get(key)
+            values = value if isinstance(value, list) else [value]
+            ret = any(v != None and fnmatch.fnmatchcase(str(v), pattern) for v in values)
+        else:
+            value = info.get(term)
+            if not isinstance(value, bool):
+                raise Exception("selector \"%s\" needs a value, like %s=pattern" % (term, term))
+            ret = value
+        return ret != negate
+
+    # a term like "transport=sata" or "rotational" that select() understands, as opposed to a path or serial
+    @staticmethod
+    def is_selector(arg):
+        term = arg.split(",")[0].lstrip("!")
+        return "=" in arg or term in ["rotational", "removable"]
+
+disk_index = None
+
+# returns the DiskIndex, made on the first call
+def get_disk_index():
+    global disk_index
+    if disk_index == None:
+        disk_index = DiskIndex()
+    return disk_index
+
+################################################################################
+# misc functions
+################################################################################
+
+# returns the serial number of a device, from the DiskIndex, or raises an Exception if it has none
+def get_serial(dev_path):
+    info = get_disk_index().get(dev_path)
+    if info and info.serial:
+        return info.serial
     raise Exception("failed to find serial for device \"%s\"" % (dev_path))
 
+# turns the devices on the command line (paths, serials, "all" and selectors) into Device objects
 def get_devices(args):
     ret = []
-    args2 = []
-
-    for n in range(0, len(args)):
-        arg = args[n]
-        if arg == "all":
-            # TODO: how to properly list all disk devices? This might miss something eg. when there are no sata/scsi devices.
-            for ex in ["/dev/sd[a-z]", "/dev/sd[a-z][a-z]"]:
-                for match in glob.glob(ex):
-                    if match not in args:
-                        args2 += [match]
-        else:
-            args2 += [arg]
+    index = get_disk_index()
+    paths = []
 
-    # on Linux, allow using the serial number
-    # if the device given looks like a serial number, change it to have the device path instead
-    for n in range(0, len(args2)):
-        arg = args2[n]
-        serial = None
-        
-        if not os.path.exists(arg) and not "/" in arg:
-            # this arg is a serial
-            ex = "/dev/disk/by-id/*%s" % arg
-            matches = glob.glob(ex)
-            if( len(matches) != 1 ):
-                raise Exception("Expression \"%s\" matched multiple files: %s" % (ex, matches))
-            
-            id_path = matches[0]
-            dev_path = id_path
-            serial = arg
-        elif os.path.exists(arg):
+    def add(path, serial):
+        if os.path.realpath(path) not in paths:
+            paths.append(os.path.realpath(path))
+            ret.append(Device(path, serial))
+
+    for arg in args:
+        if arg == "all" or DiskIndex.is_selector(arg):
+            infos = index.all() if arg == "all" else index.select(arg)
+            if not infos:
+                warn("\"%s\" selected no devices" % (arg))
+            for info in infos:
+                debug("\"%s\" selected %s" % (arg, info))
+                add(info.path, info.serial or info.path)
+            continue
+
+        if os.path.exists(arg):
             # this arg is a path
+            info = index.get(arg)
             dev_path = arg
+            if os.path.realpath(arg).startswith("/dev/dm-"):
+                # the index names dm devices /dev/mapper/<name>, so the same LV gets the same serial (and so the same state files) whether it was given as /dev/vgname/lvname, /dev/mapper/vgname-lvname or /dev/dm-N
+                serial = arg
+                if info and info.serial:
+                    serial = info.serial
+                # this is expected to be like /dev/dm-99
+                dev_path = os.path.realpath(arg)
+            elif info and info.serial:
+                serial = info.serial
+            else:
+                # no serial (eg. a loop device, or a regular file), so the path has to do
+                warn("found no serial for \"%s\"; using the path in its place" % (arg))
+                serial = arg
+        elif not "/" in arg:
+            # on Linux, allow using the serial number (or wwn, or the end of a /dev/disk/by-id name)
+            info = index.find(arg)
+            if not info:
+                raise Exception("device %s doesn't exist" % (arg))
+            dev_path = info.path
+            # the serial from the index, not arg, which can be a wwn or by-id name, so the state files are the same as when the device is given by path
+            serial = info.serial or arg
         else:
             raise Exception("device %s doesn't exist" % (arg))
 
-        dev_path_r = os.path.realpath(dev_path)
-        if dev_path_r.startswith("/dev/dm-"):
-            # We assume there is no serial for device mapper paths, so just fake it.
-            # this is expected to be the more stable path, such as /dev/vgname/lvname or /dev/mapper/vgname-lvname
-            serial = dev_path
-            # this is expected to be like /dev/dm-99
-            dev_path = os.path.realpath(dev_path)
-        elif not serial:
-            serial = get_serial(dev_path)
-
-        ret += [Device(dev_path, serial)]
+        add(dev_path, serial)
 
     return ret
 
@@ -217,22 +433,83 @@ def require(cmd):
         error("Could not find required command %s" % (cmd))
         exit(missing_command)
 
-# low level scanning and repairing by using hdparm (Linux only)
-# returns the last sector worked on (failed or successful)
-def fixup_hdparm(device, sector, fuzzy_after=300):
-    sector = int(sector)
-    device_size = get_file_size(device.path)
-    x_end_sector = device_size / sector_size - 1
-    prev_sector = None
-    start_sector = sector
-    end_sector = sector+fuzzy_after
-    check_sector = start_sector
-    while check_sector <= end_sector:
-        force_repair = False
-        if( check_sector > x_end_sector ):
-            #if check_sector is not a valid sector (past end of disk), return
-            return prev_sector
-        p = subprocess.Popen(["hdparm", "--read-sector", str(check_sector), device.path], 
+################################################################################
+# sector level IO
+################################################################################
+
+# The result of reading or writing one sector. The codes are the ones hdparm returns, so the hdparm engine and the native engine can be handled by the same code in fixup_sectors()
+class SectorResult():
+    ok = 0
+    # I/O Error
+    io_error = errno.EIO
+    # The running kernel lacks CONFIG_IDE_TASK_IOCTL support for this device.
+    # FAILED: Invalid argument
+    invalid = errno.EINVAL
+    # reading sector 5860531760: FAILED: Inappropriate ioctl for device
+    # It does this when a disk is so bad that it fails and Linux loses it, and smartctl fails too
+    disk_failed = errno.ENOTTY
+    # hdparm returns 0, but says "SG_IO: bad/missing sense data" and the data is all zeros (see fixup_sectors)
+    bad_sense = -1
+    # the native engine's request was refused or cut short: EINVAL from pread/pwrite (a misaligned O_DIRECT request, or one past the end of the device), or a short read or write
+    # Unlike hdparm's EINVAL, that says nothing about the sector, so it is skipped instead of rewritten.
+    rejected = -2
+
+    def __init__(self, code, output=""):
+        self.code = code
+        self.output = output
+
+    def __str__(self):
+        return str(self.code)
+
+    def is_ok(self):
+        return self.code == SectorResult.ok
+
+    # whether the sector should be rewritten
+    def is_bad(self):
+        return self.code in [SectorResult.io_error, SectorResult.invalid, SectorResult.bad_sense]
+
+    def is_disk_failed(self):
+        return self.code == SectorResult.disk_failed
+
+    def is_rejected(self):
+        return self.code == SectorResult.rejected
+
+# raised when a disk fails or disappears, so the work on that disk stops, but not on the others (like the other workers in parallel mode)
+class DiskFailed(Exception):
+    pass
+
+# prints the error for a result that says the disk failed, and raises DiskFailed
+def disk_failed(device, result):
+    error("%s - %s" % (device, result.output))
+    raise DiskFailed("%s - disk failed... can no longer access it." % (device))
+
+# converts an OSError from the native engine to the code hdparm would have returned for the same problem
+def sector_result_from_oserror(e, output=None):
+    code = e.errno
+    if code in [errno.ENXIO, errno.ENODEV, errno.ENOENT]:
+        # the device is gone... this is what hdparm reports as "Inappropriate ioctl for device"
+        code = SectorResult.disk_failed
+    elif code == errno.EINVAL:
+        code = SectorResult.rejected
+    if output is None:
+        output = str(e)
+    return SectorResult(code, output)
+
+# page aligned buffer, as required by O_DIRECT; an anonymous mmap is always page aligned
+def get_aligned_buffer(size):
+    page_size = mmap.PAGESIZE
+    size = int((size + page_size - 1) / page_size) * page_size
+    return mmap.mmap(-1, size)
+
+# reads and writes single sectors by running hdparm once per sector (Linux only)
+class HdparmSectorIO():
+    name = "hdparm"
+
+    def __init__(self, device):
+        self.device = device
+
+    def read_sector(self, sector):
+        p = subprocess.Popen(["hdparm", "--read-sector", str(sector), self.device.path], 
             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         
         stdoutdata, stderrdata = p.communicate()
@@ -246,7 +523,6 @@ def fixup_hdparm(device, sector, fuzzy_after=300):
                     zeros_count += 1
 
         p.wait()
-        prev_sector = check_sector
         if( p.returncode == 0 and zeros_count == 32 and "SG_IO: bad/missing sense data" in output ):
             # fails but returns 0
             # example output seen on ST3000DM001-9YN166
@@ -266,119 +542,442 @@ def fixup_hdparm(device, sector, fuzzy_after=300):
             # [1695937.595259] ata4.00: error: { UNC }
             # [1695937.643025] ata4.00: configured for UDMA/133
             # [1695937.643048] ata4: EH complete
-            force_repair = True
+            return SectorResult(SectorResult.bad_sense, output)
+
+        return SectorResult(p.returncode, output)
+
+    # hdparm can only write zeros
+    def write_sector(self, sector):
+        p = subprocess.Popen(["hdparm", "--yes-i-know-what-i-am-doing", "--write-sector", str(sector), self.device.path], 
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdoutdata, stderrdata = p.communicate()
+        return SectorResult(p.returncode, (stdoutdata + stderrdata).decode("utf-8"))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+# reads and writes sectors in-process with pread/pwrite on a single fd, instead of forking hdparm for every sector
+# With O_DIRECT, every read goes to the disk instead of the page cache, so a bad sector fails the same way it does with hdparm. O_DIRECT requires the buffer, offset and length to be aligned, which is why this uses one preallocated mmap buffer for everything.
+class NativeSectorIO():
+    name = "native"
+
+    def __init__(self, device, direct=True, max_sectors=1):
+        self.device = device
+        self.direct = direct
+        self.sector_size = device.sector_size
+        # room for a whole physical sector, for repair_sector()
+        max_sectors = max(max_sectors, device.physical_sectors)
+
+        flags = os.O_RDONLY
+        if not dry_run:
+            flags = os.O_RDWR
+        # without preadv, reads go through os.pread, which can't read into the aligned buffer that O_DIRECT needs
+        if direct and hasattr(os, "O_DIRECT") and hasattr(os, "preadv"):
+            flags |= os.O_DIRECT
+        self.fd = os.open(device.path, flags)
+
+        self.buf = get_aligned_buffer(max_sectors*self.sector_size)
+        self.view = memoryview(self.buf)
+        # separate buffer so write data doesn't get overwritten by reads; zeros unless the caller fills it
+        self.write_buf = get_aligned_buffer(max_sectors*self.sector_size)
+        self.write_view = memoryview(self.write_buf)
+
+    # returns a SectorResult; on success, self.data() has what was read
+    def read(self, sector, count=1):
+        length = count*self.sector_size
+        try:
+            if hasattr(os, "preadv"):
+                n = os.preadv(self.fd, [self.view[0:length]], sector*self.sector_size)
+            else:
+                data = os.pread(self.fd, length, sector*self.sector_size)
+                n = len(data)
+                self.view[0:n] = data
+        except OSError as e:
+            return sector_result_from_oserror(e)
+        self.length = n
+        if n != length:
+            # past the end of the device
+            return SectorResult(SectorResult.rejected, "short read: %s of %s bytes at sector %s" % (n, length, sector))
+        return SectorResult(SectorResult.ok)
+
+    def read_sector(self, sector):
+        return self.read(sector, 1)
+
+    # the data from the last successful read; only valid until the next read
+    def data(self):
+        return self.view[0:self.length]
+
+    # writes data (default zeros) to count sectors at sector
+    def write(self, sector, count=1, data=None):
+        length = count*self.sector_size
+        if data is not None:
+            self.write_view[0:length] = data
+        try:
+            n = os.pwrite(self.fd, self.write_view[0:length], sector*self.sector_size)
+        except OSError as e:
+            return sector_result_from_oserror(e)
+        if n != length:
+            return SectorResult(SectorResult.rejected, "short write: %s of %s bytes at sector %s" % (n, length, sector))
+        return SectorResult(SectorResult.ok)
+
+    def write_sector(self, sector):
+        return self.write(sector, 1)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        # data() might still be referenced, so let the buffers be freed when that is gone, instead of closing them here
+        self.view = None
+        self.write_view = None
+        self.buf = None
+        self.write_buf = None
+
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+# overwrites one bad sector (with zeros, or data, which is the sector's data that the recover action salvaged) unless this is a dry run
+# When a physical sector has more than one logical sector (512e disks), writing only part of it makes the disk read the rest first, which fails when it is bad, so with the native engine the whole physical sector is written, with the logical sectors in it that still read ok written back as they were.
+# returns True if the sector was repaired
+def repair_sector(io, device, sector, data=None):
+    if( dry_run ):
+        info("%s - DRY RUN - skipping repair of sector %s" % (device, sector))
+        device.mark_bad(sector)
+        return False
+
+    per_physical = device.physical_sectors
+    if( per_physical > 1 and isinstance(io, NativeSectorIO) ):
+        first = sector - sector % per_physical
+        block = bytearray(per_physical*device.sector_size)
+        for n in range(0, per_physical):
+            if( first + n == sector ):
+                if data != None:
+                    block[n*device.sector_size:(n+1)*device.sector_size] = data
+            elif io.read(first + n, 1).is_ok():
+                block[n*device.sector_size:(n+1)*device.sector_size] = io.data()
+        result = io.write(first, per_physical, block)
+    elif data != None:
+        result = io.write(sector, 1, data)
+    else:
+        result = io.write_sector(sector)
+    if( result.is_ok() ):
+        info("%s - repair of sector %s successful" % (device, sector))
+        with device.lock:
+            device.rewritten += 1
+        device.metrics.repair(sector, True)
+        device.mark_bad(sector, repaired=True)
+        return True
+    elif( result.is_rejected() ):
+        warn("%s - write of sector %s was rejected, so it wasn't repaired: %s" % (device, sector, result.output))
+        return False
+    else:
+        info("%s - repair of sector %s failed" % (device, sector))
+        device.metrics.repair(sector, False)
+        device.mark_bad(sector)
+        return False
+
+# finds the bad sectors in a range that failed to read, by reading it in halves, and then the failed halves in halves, down to single sectors
+# io needs read(sector, count) and max_sectors >= count, so it is a NativeSectorIO
+# Damage is usually clustered, so this needs about 2*log2(count) reads per bad area, instead of reading every sector in the range one by one.
+# returns a list of bad sectors in ascending order and how many reads it took
+def locate_bad_sectors(io, device, sector, count):
+    bad = []
+    reads = 0
+    # the whole range is already known to have failed, so start with its halves
+    # the stack is popped from the end, so the lower half goes on last to be read first
+    stack = []
+    if count > 1:
+        half = int(count/2)
+        stack += [(sector + half, count - half), (sector, half)]
+    else:
+        stack += [(sector, count)]
+    
+    while stack:
+        range_sector, range_count = stack.pop()
+        result = io.read(range_sector, range_count)
+        reads += 1
+        if( result.is_ok() ):
+            continue
+        elif( result.is_disk_failed() ):
+            disk_failed(device, result)
+        elif( range_count > 1 ):
+            half = int(range_count/2)
+            stack += [(range_sector + half, range_count - half), (range_sector, half)]
+        elif( result.is_bad() ):
+            debug("%s - %s return code was %s for sector %s" % (device, io.name, result, range_sector))
+            bad += [range_sector]
+        elif( result.is_rejected() ):
+            warn("%s - read of sector %s was rejected, so it isn't counted as bad: %s" % (device, range_sector, result.output))
+        else:
+            error("%s - %s" % (device, result.output))
+            error("%s - Unsuppoted %s error code = %s detected at sector %s... skipping it" % (device, io.name, result, range_sector))
+    
+    return bad, reads
+
+# finds the sectors that make a range slow to read, like locate_bad_sectors(), but by timing the reads: a half that takes longer than threshold seconds is read again in halves, down to single sectors
+# The disk might have the range in its cache after the first read, so a slow sector can be missed, but one that needs internal retries is usually slow every time.
+# A sector that fails to read is counted as slow too, with a time of None.
+# returns a list of (sector, seconds) in ascending order and how many reads it took
+def locate_slow_sectors(io, device, sector, count, threshold):
+    slow = []
+    reads = 0
+    stack = [(sector, count)]
+    while stack:
+        range_sector, range_count = stack.pop()
+        start = time.monotonic()
+        result = io.read(range_sector, range_count)
+        elapsed = time.monotonic() - start
+        reads += 1
+        if( result.is_ok() and elapsed < threshold ):
+            continue
+        elif( result.is_disk_failed() ):
+            disk_failed(device, result)
+        elif( range_count > 1 ):
+            half = int(range_count/2)
+            stack += [(range_sector + half, range_count - half), (range_sector, half)]
+        elif( result.is_ok() ):
+            slow += [(range_sector, elapsed)]
+        elif( result.is_rejected() ):
+            warn("%s - read of sector %s was rejected while looking for slow sectors: %s" % (device, range_sector, result.output))
+        else:
+            warn("%s - sector %s failed to read while looking for slow sectors: %s" % (device, range_sector, result))
+            slow += [(range_sector, None)]
+    return slow, reads
+
+# rewrites a sector that reads ok but slowly with its own data, so the disk gets a chance to remap it before it goes bad
+# The whole physical sector is read and written back, for 512e disks.
+# returns True if it was rewritten
+def rewrite_slow_sector(io, device, sector):
+    if( dry_run ):
+        info("%s - DRY RUN - skipping rewrite of slow sector %s" % (device, sector))
+        return False
+    per_physical = device.physical_sectors
+    first = sector - sector % per_physical
+    result = io.read(first, per_physical)
+    if( result.is_ok() ):
+        result = io.write(first, per_physical, io.data())
+    if( result.is_ok() ):
+        info("%s - rewrite of slow sector %s successful" % (device, sector))
+        return True
+    info("%s - rewrite of slow sector %s failed: %s" % (device, sector, result))
+    return False
+
+# salvages bad sectors for the recover action
+# Each sector is read again and again, with a doubling wait between tries, and different kinds of reads in turn: a single sector with O_DIRECT, a single sector through the page cache, and the 4 KiB (or physical sector) block around it with O_DIRECT. The first read that works is written back, so the disk remaps the sector with its old data. If no read works in tries tries or budget seconds, the sector is written with zeros like zerobad.
+# The sectors are split into regions (sectors less than region_gap apart), and jobs threads work on different regions at the same time, so one region that never reads doesn't hold up the rest. The reads release the GIL; the writes and bookkeeping are done one at a time, with a lock.
+class Recovery():
+    def __init__(self, device, tries=10, budget=60, jobs=4, backoff=0.05, region_gap=2048):
+        self.device = device
+        self.tries = tries
+        self.budget = budget
+        self.jobs = jobs
+        self.backoff = backoff
+        self.region_gap = region_gap
+        self.lock = threading.Lock()
+        # the block read around a sector, in sectors
+        self.block_sectors = max(device.physical_sectors, 4096 // device.sector_size, 1)
+        self.salvaged = []
+        self.lost = []
+
+    # returns the sectors split into lists of sectors less than region_gap apart
+    def regions(self, sectors):
+        regions = []
+        for sector in sorted(sectors):
+            if regions and sector - regions[-1][-1] < self.region_gap:
+                regions[-1] += [sector]
+            else:
+                regions += [[sector]]
+        return regions
+
+    # returns the data of the sector from the first read that works, or None, how many reads it took, and whether every read was rejected (see SectorResult.rejected), which means the sector isn't bad at all
+    def salvage(self, direct_io, buffered_io, sector):
+        device = self.device
+        start = time.time()
+        # the kinds of reads that were rejected; once all of them were, and none really failed, trying again won't help
+        rejected = set()
+        failed = False
+        for attempt in range(0, self.tries):
+            kind = attempt % 3
+            if kind == 0:
+                result = direct_io.read(sector, 1)
+                data = direct_io.data
+            elif kind == 1:
+                # drop the page cache for it first, so this really reads the disk
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(buffered_io.fd, sector*device.sector_size, device.sector_size, os.POSIX_FADV_DONTNEED)
+                result = buffered_io.read(sector, 1)
+                data = buffered_io.data
+            else:
+                first = sector - sector % self.block_sectors
+                count = min(self.block_sectors, device.sectors - first)
+                result = direct_io.read(first, count)
+                data = lambda: direct_io.data()[(sector - first)*device.sector_size:(sector - first + 1)*device.sector_size]
+
+            if( result.is_ok() ):
+                return bytes(data()), attempt + 1, False
+            elif( result.is_disk_failed() ):
+                disk_failed(device, result)
+            elif( result.is_rejected() ):
+                debug("%s - read of sector %s was rejected: %s" % (device, sector, result.output))
+                rejected.add(kind)
+                if( len(rejected) == 3 and not failed ):
+                    return None, attempt + 1, True
+            else:
+                failed = True
+
+            if( time.time() - start >= self.budget ):
+                debug("%s - sector %s used its %s s budget after %s reads" % (device, sector, self.budget, attempt + 1))
+                return None, attempt + 1, False
+            time.sleep(min(self.backoff * 2**attempt, 5))
+        return None, self.tries, False
+
+    def recover_region(self, sectors):
+        device = self.device
+        with NativeSectorIO(device, max_sectors=self.block_sectors) as direct_io, NativeSectorIO(device, direct=False) as buffered_io:
+            for sector in sectors:
+                device.check_health()
+                data, reads, rejected = self.salvage(direct_io, buffered_io, sector)
+                with self.lock:
+                    if rejected:
+                        warn("%s - every read of sector %s was rejected, so it isn't bad; skipping it" % (device, sector))
+                        continue
+                    elif data != None:
+                        info("%s - salvaged sector %s after %s reads" % (device, sector, reads))
+                        self.salvaged += [sector]
+                        device.metrics.event("salvaged", sector=sector, reads=reads)
+                    else:
+                        info("%s - lost sector %s after %s reads; writing zeros" % (device, sector, reads))
+                        self.lost += [sector]
+                        device.metrics.event("lost", sector=sector, reads=reads)
+                    repair_sector(direct_io, device, sector, data)
+
+    def run(self, sectors):
+        import concurrent.futures
+
+        regions = self.regions(sectors)
+        info("%s - recovering %s sectors in %s regions, %s at a time" % (self.device, len(sectors), len(regions), self.jobs))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.jobs)) as executor:
+            for future in [executor.submit(self.recover_region, region) for region in regions]:
+                # raises the exception of a failed region here, like a failed disk
+                future.result()
+        info("%s - recover: %s sectors salvaged, %s sectors lost" % (self.device, len(self.salvaged), len(self.lost)))
+
+# low level scanning and repairing, one sector at a time
+# io is a HdparmSectorIO or NativeSectorIO
+# returns the last sector worked on (failed or successful)
+def fixup_sectors(io, device, sector, fuzzy_after=300):
+    sector = int(sector)
+    x_end_sector = device.sectors - 1
+    prev_sector = None
+    start_sector = sector
+    end_sector = sector+fuzzy_after
+    check_sector = start_sector
+    while check_sector <= end_sector:
+        device.check_health()
+        if( check_sector > x_end_sector ):
+            #if check_sector is not a valid sector (past end of disk), return
+            return prev_sector
+        result = io.read_sector(check_sector)
+        prev_sector = check_sector
             
-        if( not force_repair and p.returncode == 0 ):
+        if( result.is_ok() ):
             # this sector is OK... no repair needed
             #debug("sector %s is ok" % (check_sector))
             pass
-        elif( 
-              force_repair
-            
-            # I/O Error
-              or p.returncode == 5 
-             
-            # The running kernel lacks CONFIG_IDE_TASK_IOCTL support for this device.
-            # FAILED: Invalid argument
-              or p.returncode == 22 ): 
+        elif( result.is_bad() ):
             # if fail,
-            debug("%s - return code was %s" % (device, p.returncode))
-            if( not dry_run ):
-                p = subprocess.Popen(["hdparm", "--yes-i-know-what-i-am-doing", "--write-sector", str(check_sector), device.path], 
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                p.wait()
-                if( p.returncode == 0 ):
-                    info("%s - repair of sector %s successful" % (device, check_sector))
-                else:
-                    info("%s - repair of sector %s failed" % (device, check_sector))
-            else:
-                info("%s - DRY RUN - skipping repair of sector %s" % (device, check_sector))
+            debug("%s - %s return code was %s" % (device, io.name, result))
+            repair_sector(io, device, check_sector)
                 
             if end_sector < check_sector + fuzzy_after:
                 # if we find an error, we want to search fuzzy_after past that too
                 end_sector = check_sector + fuzzy_after
             
-        elif( p.returncode == 25 ): # reading sector 5860531760: FAILED: Inappropriate ioctl for device
-            # It does this when a disk is so bad that it fails and Linux loses it, and smartctl fails too
-            
-            # print the error again
-            error("%s - %s" (device, output))
-            
-            # notify user and exit
-            error("%s - disk failed... can no longer access it." % (device))
-            
-            # TODO: make this handle multi-disk dmesg scan, so it will check other disks after one fails
-            exit(failed_disk)
+        elif( result.is_disk_failed() ):
+            # print the error again, and stop working on this disk; the other disks go on
+            disk_failed(device, result)
+        elif( result.is_rejected() ):
+            warn("%s - read of sector %s was rejected, so it isn't repaired: %s" % (device, check_sector, result.output))
         else:
             # print the error again
-            error("%s - %s" (device, output))
+            error("%s - %s" % (device, result.output))
             
             # notify user and exit
-            error("%s - Unsuppoted hdparm error code = %s detected... aborting" % (device, p.returncode))
+            error("%s - Unsuppoted %s error code = %s detected... aborting" % (device, io.name, result))
             return prev_sector
 
         check_sector += 1
 
     return prev_sector
 
-# high level repair using python... fallback when other methods are unavailable (FreeBSD)
+# low level scanning and repairing by using hdparm (Linux only)
+# returns the last sector worked on (failed or successful)
+def fixup_hdparm(device, sector, fuzzy_after=300):
+    with HdparmSectorIO(device) as io:
+        return fixup_sectors(io, device, sector, fuzzy_after=fuzzy_after)
+
+# same as fixup_hdparm, but without forking a process per sector
+def fixup_native(device, sector, fuzzy_after=300):
+    with NativeSectorIO(device) as io:
+        return fixup_sectors(io, device, sector, fuzzy_after=fuzzy_after)
+
+# repair using only python... fallback when other methods are unavailable (FreeBSD)
 # on FreeBSD, this might actually work even though it won't work on Linux, because FreeBSD has (raw/lower level) character devices, and Linux has block devices
+# It uses the same IO as the native engine, pread/pwrite at exact offsets on one fd (with O_DIRECT where the OS has it), so a read error really comes from the disk, and the device isn't reopened for every write. Unlike fixup_sectors(), it checks only fuzzy_after sectors without going further after an error, and with --random it writes random data.
 def fixup_python(device, sector, fuzzy_after=300):
     sector = int(sector)
-    
-    device_size = get_file_size(device.path)
-    x_end_sector = device_size / sector_size - 1
-    
-    data = None
-    if not args.random:
-        data = get_zeros(sector_size)
-    
+    x_end_sector = device.sectors - 1
+
     prev_sector = None
-    with open(device.path, "rb") as f:
-        x = sector
-        if( x > x_end_sector ):
-            #if x is not a valid sector (past end of disk), return
-            return prev_sector
-        f.seek(sector*sector_size, 0)
-        for n in range(0, fuzzy_after):
-            x = sector + n
-            if( x > x_end_sector ):
-                #if x is not a valid sector (past end of disk), return
-                return prev_sector
+    with NativeSectorIO(device) as io:
+        for x in range(sector, min(sector + fuzzy_after, x_end_sector + 1)):
             prev_sector = x
-            try:
-                f.seek(x*sector_size, 0)
-                chunk = f.read(sector_size)
+            result = io.read_sector(x)
+            if( result.is_ok() ):
                 # this sector is OK... no repair needed
-            except:
-                #e = sys.exc_info()[0]
-                #debug("%s - %s" % (device, e))
-                if( not dry_run ):
-                    # overwrite one sector with zeros
-                    try:
-                        with open(device.path, "wb") as fw:
-                            tell = fw.seek(x*sector_size, 0)
-                            if x*sector_size != tell:
-                                error("%s - seek sector %s does not match target sector %s" % (device, tell, x*sector_size))
-                            else:
-                                if args.random:
-                                    data = get_random_data(sector_size)
-                                fw.write(data)
-                        info("%s - repair of sector %s successful" % (device, x))
-                    except:
-                        e = sys.exc_info()[0]
-                        debug("%s - %s" % (device, e))
-                        info("%s - repair of sector %s failed" % (device, x))
-                else:
-                    info("%s - DRY RUN - skipping repair of sector %s" % (device, x))
+                continue
+            elif( result.is_disk_failed() ):
+                disk_failed(device, result)
+            elif( result.is_rejected() ):
+                warn("%s - read of sector %s was rejected, so it isn't repaired: %s" % (device, x, result.output))
+                continue
+
+            debug("%s - %s return code was %s for sector %s" % (device, io.name, result, x))
+            data = None
+            if args.random:
+                data = get_random_data(device.sector_size)
+            repair_sector(io, device, x, data)
     return prev_sector
 
 found_hdparm = which("hdparm")
 
+# which fixup_* function fixup() uses; "auto" picks native on Linux, and otherwise hdparm if found, else python
+def get_fixup_engine():
+    engine = args.fixup_engine
+    if engine == "auto":
+        if sys.platform.startswith("linux"):
+            engine = "native"
+        elif found_hdparm:
+            engine = "hdparm"
+        else:
+            engine = "python"
+    return engine
+
 # fuzzy_after: how many sectors after the given sector to also scan (default 300)
 def fixup(device, sector, fuzzy_after=300):
-    global found_hdparm
-    if found_hdparm:
+    engine = get_fixup_engine()
+    if engine == "native":
+        return fixup_native(device, sector, fuzzy_after=fuzzy_after)
+    elif engine == "hdparm":
         return fixup_hdparm(device, sector, fuzzy_after=fuzzy_after)
     else:
         # TODO: on FreeBSD, run    sysctl kern.geom.debugflags=0x10 
@@ -424,9 +1023,337 @@ def x3_get_random_data(chunksize):
     #info("get_random_data, chunksize = %s" % chunksize)
     return bytearray(os.urandom(chunksize))
 
+# about 200 MB/s; too slow for whole disks, but fine for single sectors
 def get_random_data(chunksize):
     #info("get_random_data, chunksize = %s" % chunksize)
-    return random.getrandbits(chunksize*8)
+    return random.getrandbits(chunksize*8).to_bytes(chunksize, "little")
+
+# the data for zerogood/zeroall without --random
+class ZeroPattern():
+    def __init__(self, chunksize, sector_size=512):
+        self.zeros = memoryview(get_zeros(chunksize))
+        self.sector_size = sector_size
+
+    # returns the data for count sectors at sector
+    def get(self, sector, count):
+        return self.zeros[0:count*self.sector_size]
+
+# the data for zerogood/zeroall with --random, at several GB/s
+# None of the random generators python has are faster than about 300 MB/s (see benchmark_random), so a pool of random bytes is made once from a seeded PRNG, and the data for a chunk is a slice of the pool. The disk is split into blocks the size of the pool, and each block gets the pool rotated by a different amount, so the data doesn't simply repeat every pool size.
+# The data for each sector only depends on the seed and the sector number, so it can be made again later to verify what was written.
+class RandomPattern():
+    def __init__(self, chunksize, seed, sector_size=512, pool_size=16*1024*1024):
+        self.seed = seed
+        self.sector_size = sector_size
+        self.pool_sectors = int(pool_size / sector_size)
+        pool = random.Random(seed).getrandbits(pool_size*8).to_bytes(pool_size, "little")
+        # the start is repeated at the end, so a chunk starting anywhere in the pool is one slice
+        self.pool = memoryview(pool + pool[0:chunksize])
+        self.chunksize = chunksize
+
+    def rotation(self, block):
+        h = hashlib.blake2b(("%s:%s" % (self.seed, block)).encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(h, "little") % self.pool_sectors
+
+    # returns the data for count sectors at sector; count*sector_size must not be more than chunksize
+    def get(self, sector, count):
+        block = int(sector / self.pool_sectors)
+        end_block = int((sector + count - 1) / self.pool_sectors)
+        if block != end_block:
+            # the chunk crosses into the next block, which has a different rotation
+            first_count = (block + 1)*self.pool_sectors - sector
+            return bytes(self.get(sector, first_count)) + bytes(self.get(sector + first_count, count - first_count))
+
+        offset = (sector % self.pool_sectors + self.rotation(block)) % self.pool_sectors
+        return self.pool[offset*self.sector_size:(offset + count)*self.sector_size]
+
+patterns = {}
+
+# returns the ZeroPattern or RandomPattern (with --random) for chunksize and sector_size, made only once, since a RandomPattern takes some time and memory to make
+def get_pattern(chunksize, sector_size=512):
+    key = (chunksize, sector_size)
+    if key not in patterns:
+        if args.random:
+            patterns[key] = RandomPattern(chunksize, random_seed, sector_size)
+        else:
+            patterns[key] = ZeroPattern(chunksize, sector_size)
+    return patterns[key]
+
+# reads back what a PatternWriter wrote and compares it to the pattern
+# This runs in a thread behind the writes, so verifying mostly overlaps with writing instead of doubling the time. The queue is bounded, so if the reads are slower than the writes, the writes wait instead of verification falling far behind.
+# Reads use O_DIRECT so they come from the disk, not the page cache. (An O_DIRECT read writes out any dirty cached pages in its range first, so buffered writes are verified too.)
+class Verifier():
+    def __init__(self, device, chunksize, pattern, queue_size=64):
+        import queue
+
+        self.device = device
+        self.sector_size = device.sector_size
+        self.pattern = pattern
+        flags = os.O_RDONLY
+        if hasattr(os, "O_DIRECT"):
+            flags |= os.O_DIRECT
+        self.fd = os.open(device.path, flags)
+        self.buf = memoryview(get_aligned_buffer(chunksize))
+
+        self.verified_bytes = 0
+        # sectors that read back different from what was written
+        self.mismatched = SectorSet()
+        # (sector, count) of reads that failed
+        self.unreadable = []
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # called after count sectors at sector were written
+    def add(self, sector, count):
+        self.queue.put((sector, count))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                break
+            sector, count = item
+            try:
+                self.verify(sector, count)
+            except OSError as e:
+                self.unreadable += [(sector, count)]
+                debug("%s - verify read failed, sector = %s, count = %s: %s" % (self.device, sector, count, e))
+
+    def verify(self, sector, count):
+        sector_size = self.sector_size
+        length = count*sector_size
+        got = self.buf[0:length]
+        n = os.preadv(self.fd, [got], sector*sector_size)
+        if n != length:
+            raise OSError(errno.EIO, "short read: %s of %s bytes" % (n, length))
+        # tobytes() copies, but comparing bytes is a memcmp, which is much faster than comparing memoryviews
+        if got.tobytes() != bytes(self.pattern.get(sector, count)):
+            # find the exact sectors
+            for n in range(0, count):
+                if got[n*sector_size:(n+1)*sector_size].tobytes() != bytes(self.pattern.get(sector + n, 1)):
+                    self.mismatched.add(sector + n)
+        self.verified_bytes += length
+
+    # waits for the verification to finish, and reports the result
+    # The sectors that didn't read back as written are marked bad (so they go in the coverage map, checkpoint and --bad-out), and reported as ranges. The chunks that failed to read are bisected to find their bad sectors, like a failed scan chunk.
+    # raises DiskFailed if any sector failed, since the disk didn't remap it, so the run fails like for a failed disk
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        os.close(self.fd)
+        device = self.device
+
+        failed = ExtentList(self.sector_size)
+        for sector in self.mismatched:
+            failed.add(sector)
+        unreadable_sectors = 0
+        for sector, count in self.unreadable:
+            with NativeSectorIO(device, max_sectors=count) as io:
+                found, reads = locate_bad_sectors(io, device, sector, count)
+            unreadable_sectors += len(found)
+            for bad_sector in found:
+                failed.add(bad_sector)
+        for sector in failed.sectors():
+            device.mark_bad(sector)
+        for start, length, state in failed.extents():
+            if length == 1:
+                error("%s - verify: sector %s didn't read back as written" % (device, start))
+            else:
+                error("%s - verify: sectors %s to %s didn't read back as written" % (device, start, start + length - 1))
+        info("%s - verified %.2f GB; %s sectors different than written, %s sectors unreadable" % 
+             (device, self.verified_bytes/1000000000, len(self.mismatched), unreadable_sectors))
+        if len(failed):
+            raise DiskFailed("%s - verify failed for %s sectors" % (device, failed.count()))
+
+# ioctls from linux/fs.h, _IO(0x12, 119) and _IO(0x12, 127); both take a uint64 start and length in bytes
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+# returns the write strategy for zerogood/zeroall on a device: --write-strategy, or for auto, the fastest one the device supports
+# zeroout (BLKZEROOUT) is used when the device has a write zeroes command, so the disk zeros itself without the data going over the bus, and discard (BLKDISCARD) when the device says discarded blocks read as zeros (discard_zeroes_data, which kernels since 4.12 always report as 0). Both only write zeros, so --random always uses direct.
+# They are only picked for zeroall. zerogood writes around the bad sectors so they get remapped by plain writes, and the disk might not remap them the same way for an offloaded write zeroes or a discard, so it uses direct unless asked.
+def get_write_strategy(device):
+    strategy = args.write_strategy
+    if strategy != "auto":
+        return strategy
+    if( args.random or action != "zeroall" ):
+        return "direct"
+    if device.write_zeroes_max_bytes:
+        return "zeroout"
+    if device.discard_zeroes_data and device.discard_max_bytes:
+        return "discard"
+    return "direct"
+
+# writes the zerogood/zeroall data (zeros, or random data with --random) on one fd, so there is no seeking or reopening between writes
+# strategy is one of:
+#     direct = pwrite with O_DIRECT, from one reused page aligned buffer, so nothing goes through the page cache
+#     buffered = pwrite through the page cache (the old way; for devices or OSes where O_DIRECT doesn't work)
+#     zeroout = BLKZEROOUT ioctls (Linux only), which use the disk's write zeroes command if it has one, and otherwise make the kernel write the zeros
+#     discard = BLKDISCARD ioctls (Linux only, mostly SSDs and thin LVs); unless the device says discarded blocks read as zeros, each range is read back, and written with zeros if it doesn't
+# If a strategy doesn't work on the device, it falls back to direct, and from direct to buffered. The bytes and time of each strategy used are reported by close().
+# if verifier is given, everything written is given to it to read back
+class PatternWriter():
+    # the most one zeroout or discard ioctl does, so progress, checkpoints and interrupts still happen during long ones
+    ioctl_chunksize = 256*1024*1024
+
+    def __init__(self, device, chunksize, strategy="direct", verifier=None):
+        self.device = device
+        self.chunksize = chunksize
+        self.sector_size = device.sector_size
+        self.pattern = get_pattern(chunksize, self.sector_size)
+        self.verifier = verifier
+        self.fd = None
+        # write() can be called by the --stripes threads of a single pass zerogood scan
+        self.lock = threading.RLock()
+        # strategy -> [bytes written, seconds]
+        self.stats = collections.OrderedDict()
+        # bytes that still read as something other than zeros after a discard, and were written with zeros
+        self.discard_rewritten = 0
+        if strategy in ["zeroout", "discard"] and not isinstance(self.pattern, ZeroPattern):
+            warn("%s - write strategy %s only writes zeros; using direct for --random" % (device, strategy))
+            strategy = "direct"
+        self.open(strategy)
+
+    def open(self, strategy):
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
+        if strategy != "buffered" and not hasattr(os, "O_DIRECT"):
+            strategy = "buffered"
+        flags = os.O_WRONLY
+        if strategy == "discard":
+            # to read back the discarded ranges
+            flags = os.O_RDWR
+        if strategy != "buffered":
+            flags |= os.O_DIRECT
+        try:
+            self.fd = os.open(self.device.path, flags)
+        except OSError as e:
+            if e.errno != errno.EINVAL or strategy == "buffered":
+                raise
+            warn("%s - can't open with O_DIRECT (%s); writing buffered instead" % (self.device, e))
+            return self.open("buffered")
+        self.strategy = strategy
+        self.stats.setdefault(strategy, [0, 0])
+        debug("%s - write strategy = %s" % (self.device, strategy))
+
+        self.buffer = None
+        self.read_buffer = None
+        if strategy != "buffered":
+            # O_DIRECT needs an aligned buffer; a new mmap is zeros, so a ZeroPattern never has to be copied into it
+            self.buffer = memoryview(get_aligned_buffer(self.chunksize))
+        if strategy == "discard" and not self.device.discard_zeroes_data:
+            self.read_buffer = memoryview(get_aligned_buffer(self.chunksize))
+
+    # the most sectors write() takes at once
+    def max_sectors(self):
+        if self.strategy in ["zeroout", "discard"]:
+            return max(self.ioctl_chunksize, self.chunksize) // self.sector_size
+        return self.chunksize // self.sector_size
+
+    # writes count sectors at sector; count must not be more than max_sectors()
+    def write(self, sector, count):
+        with self.lock:
+            self.write_locked(sector, count)
+
+    def write_locked(self, sector, count):
+        strategy = self.strategy
+        start_time = time.monotonic()
+        if strategy in ["zeroout", "discard"]:
+            try:
+                self.write_ioctl(sector, count)
+            except OSError as e:
+                if e.errno not in [errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL]:
+                    raise
+                warn("%s - write strategy %s doesn't work on this device (%s); using direct instead" % (self.device, strategy, e))
+                self.open("direct")
+                return self.write_locked(sector, count)
+        else:
+            chunk_sectors = self.chunksize // self.sector_size
+            for piece in range(sector, sector + count, chunk_sectors):
+                self.write_pattern(piece, min(chunk_sectors, sector + count - piece))
+        stats = self.stats[strategy]
+        stats[0] += count*self.sector_size
+        stats[1] += time.monotonic() - start_time
+
+        if self.verifier:
+            chunk_sectors = self.chunksize // self.sector_size
+            for piece in range(sector, sector + count, chunk_sectors):
+                self.verifier.add(piece, min(chunk_sectors, sector + count - piece))
+
+    # writes count sectors of the pattern at sector; count*sector_size must not be more than chunksize
+    def write_pattern(self, sector, count):
+        length = count*self.sector_size
+        data = self.pattern.get(sector, count)
+        if self.buffer != None:
+            if not isinstance(self.pattern, ZeroPattern):
+                self.buffer[0:length] = data
+            data = self.buffer[0:length]
+
+        written = 0
+        while written < length:
+            try:
+                n = os.pwrite(self.fd, data[written:], sector*self.sector_size + written)
+            except OSError as e:
+                if e.errno != errno.EINVAL or self.strategy == "buffered":
+                    raise
+                warn("%s - O_DIRECT write failed (%s); writing buffered instead" % (self.device, e))
+                self.open("buffered")
+                return self.write_pattern(sector, count)
+            if n == 0:
+                raise OSError(errno.ENOSPC, "No space left on device")
+            written += n
+
+    def write_ioctl(self, sector, count):
+        import fcntl
+        offset = sector*self.sector_size
+        length = count*self.sector_size
+        request = BLKZEROOUT if self.strategy == "zeroout" else BLKDISCARD
+        fcntl.ioctl(self.fd, request, struct.pack("QQ", offset, length))
+
+        if self.read_buffer == None:
+            return
+        # the device doesn't promise that discarded blocks read as zeros, so check, and write zeros where they don't
+        chunk_sectors = self.chunksize // self.sector_size
+        for piece in range(sector, sector + count, chunk_sectors):
+            piece_count = min(chunk_sectors, sector + count - piece)
+            piece_length = piece_count*self.sector_size
+            got = self.read_buffer[0:piece_length]
+            n = os.preadv(self.fd, [got], piece*self.sector_size)
+            if n != piece_length or got.tobytes() != self.buffer[0:piece_length].tobytes():
+                self.write_pattern(piece, piece_count)
+                self.discard_rewritten += piece_length
+
+    # makes sure everything is on the disk, and reports the speed of each strategy used
+    def close(self):
+        start_time = time.monotonic()
+        try:
+            os.fsync(self.fd)
+        except OSError as e:
+            warn("%s - fsync after writing failed: %s" % (self.device, e))
+        self.stats[self.strategy][1] += time.monotonic() - start_time
+        os.close(self.fd)
+
+        for strategy, (written, seconds) in self.stats.items():
+            if not written:
+                continue
+            rate = written / seconds / 1000000 if seconds > 0 else 0
+            info("%s - write strategy %s: wrote %.2f GB at %.2f MB/s" % (self.device, strategy, written/1000000000, rate))
+            self.device.metrics.event("write_strategy", strategy=strategy, bytes=written, seconds=round(seconds, 3), mb_per_s=round(rate, 2))
+        if self.discard_rewritten:
+            warn("%s - %.2f GB didn't read as zeros after discarding, so it was written with zeros" % (self.device, self.discard_rewritten/1000000000))
+
+        if self.verifier:
+            self.verifier.close()
+
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.close()
 
 
 # http://stackoverflow.com/questions/2773604/query-size-of-block-device-file-in-python
@@ -457,7 +1384,6 @@ class OSFile():
         self.os_fd = os.open(path, flags)
         #self.file_obj = os.fdopen(self.os_fd)
 
-        import mmap
         size = self.size
         self.m = mmap.mmap(self.os_fd, size, prot=mmap.PROT_READ)
 
@@ -508,55 +1434,1790 @@ class OSFile():
         os.close(self.os_fd)
 
 
-def open_device_for_scan(device):
-    global args
-    
-    if args.direct:
-        o = OSFile()
-        return o.open(device, os.O_DIRECT | os.O_RDONLY)
-    else:
-        return open(device, "rb")
+# reads with real O_DIRECT, so scanning doesn't fill the page cache, into one preallocated page aligned buffer, so there is no allocation per chunk
+# Has the same interface as OSFile, except that read() returns a memoryview of the buffer, which is only valid until the next read.
+class DirectFile():
+    def __init__(self):
+        self.os_fd = None
+        self.position = 0
 
+    # buffer_size is the largest read that will be done
+    def open(self, path, buffer_size, flags=os.O_RDONLY):
+        if hasattr(os, "O_DIRECT"):
+            flags |= os.O_DIRECT
+        self.os_fd = os.open(path, flags)
+        self.buf = get_aligned_buffer(buffer_size)
+        self.view = memoryview(self.buf)
+        return self
 
-class Device():
-    def __init__(self, path, serial):
-        if not path:
-            raise Exception("path is required")
-        if not serial:
-            raise Exception("serial is required")
-        self.path = path
-        self.serial = serial
-        self.status_txt = None
+    def seek(self, position, how):
+        if how == os.SEEK_CUR:
+            self.position += position
+        elif how == os.SEEK_SET:
+            self.position = position
+        else:
+            raise Exception("unsupported")
 
-    def __str__(self):
-        return "{" + self.path + "|" + self.serial + "}"
+    def tell(self):
+        return self.position
+
+    def read(self, chunksize):
+        if chunksize > len(self.view):
+            raise Exception("read size %s is larger than the buffer size %s" % (chunksize, len(self.view)))
+        n = os.preadv(self.os_fd, [self.view[0:chunksize]], self.position)
+        self.position += n
+        return self.view[0:n]
+
+    def __enter__(self):
+        return self
     
-    def print_status(self, txt):
+    def __exit__(self, type, value, traceback):
+        os.close(self.os_fd)
+        # the last chunk returned by read() might still be referenced, so let the buffer be freed when that is gone, instead of closing it here
+        self.view = None
+        self.buf = None
+
+# keeps queue_depth sequential reads in flight in a thread pool, so devices that can do more than one IO at a time (SAS arrays, SSDs, dm devices) reach their real throughput
+# os.preadv releases the GIL, so the threads really do read in parallel.
+# Has the same interface as DirectFile. Each read() returns the result of the read that was started for exactly that position and size, so a read error is raised for exactly the chunk that failed, like with the other backends. A seek() or a different size throws away the reads in flight and starts over from there.
+class PrefetchFile():
+    def __init__(self):
+        self.os_fd = None
+        self.position = 0
+
+    def open(self, path, buffer_size, queue_depth, direct=True):
+        import concurrent.futures
+
+        flags = os.O_RDONLY
+        if direct and hasattr(os, "O_DIRECT"):
+            flags |= os.O_DIRECT
+        self.os_fd = os.open(path, flags)
+        self.size = get_file_size(path)
+        self.queue_depth = queue_depth
+        self.buffer_size = buffer_size
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=queue_depth)
+        # (position, size, buffer, future) for each read in flight, oldest first
+        self.pending = collections.deque()
+        # one buffer per read in flight, plus the one returned by the last read()
+        self.free = []
+        for n in range(0, queue_depth+1):
+            self.free += [memoryview(get_aligned_buffer(buffer_size))]
+        self.current = None
+        # where the next read will be submitted
+        self.next_position = 0
+        return self
+
+    def _read(self, buf, position, size):
+        return os.preadv(self.os_fd, [buf[0:size]], position)
+
+    def _submit(self, size):
+        while len(self.pending) < self.queue_depth and self.next_position < self.size:
+            buf = self.free.pop()
+            future = self.executor.submit(self._read, buf, self.next_position, size)
+            self.pending.append((self.next_position, size, buf, future))
+            self.next_position += size
+
+    # throws away the reads in flight; they can't be cancelled once started, so wait for those so their buffers are free again
+    def _discard(self):
+        while self.pending:
+            position, size, buf, future = self.pending.popleft()
+            if not future.cancel():
+                try:
+                    future.result()
+                except OSError:
+                    pass
+            self.free += [buf]
+
+    def seek(self, position, how):
+        if how == os.SEEK_CUR:
+            self.position += position
+        elif how == os.SEEK_SET:
+            self.position = position
+        else:
+            raise Exception("unsupported")
+
+    def tell(self):
+        return self.position
+
+    def read(self, chunksize):
+        if chunksize > self.buffer_size:
+            raise Exception("read size %s is larger than the buffer size %s" % (chunksize, self.buffer_size))
+
+        # the caller is done with the chunk from the last read
+        if self.current != None:
+            self.free += [self.current]
+            self.current = None
+
+        if self.pending:
+            position, size, buf, future = self.pending[0]
+            if position != self.position or size != chunksize:
+                self._discard()
+        if not self.pending:
+            self.next_position = self.position
+        self._submit(chunksize)
+        if not self.pending:
+            # at the end
+            return b''
+
+        position, size, buf, future = self.pending.popleft()
+        self.current = buf
+        try:
+            n = future.result()
+        finally:
+            self._submit(chunksize)
+        self.position += n
+        return buf[0:n]
+
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self._discard()
+        self.executor.shutdown()
+        os.close(self.os_fd)
+
+# backend is one of:
+#    buffered - regular python file; every read allocates a new bytes object, and everything read goes through the page cache
+#    mmap - OSFile; mmaps the whole device
+#    direct - DirectFile; O_DIRECT reads into one reused buffer
+# With queue_depth more than 1, a PrefetchFile is used instead, which uses O_DIRECT only for the direct backend
+def open_device_for_scan(device, chunksize=1024*1024, backend=None, queue_depth=None):
+    global args
+
+    if backend == None:
+        backend = args.backend
+    if queue_depth == None:
+        queue_depth = args.queue_depth
+    
+    if queue_depth > 1:
+        if backend == "mmap":
+            raise Exception("backend mmap does not support a queue depth more than 1")
+        o = PrefetchFile()
+        return o.open(device, chunksize, queue_depth, direct=(backend == "direct"))
+    elif backend == "mmap":
+        o = OSFile()
+        return o.open(device, os.O_DIRECT | os.O_RDONLY)
+    elif backend == "direct":
+        o = DirectFile()
+        return o.open(device, chunksize)
+    else:
+        return open(device, "rb")
+
+
+################################################################################
+# throttling
+################################################################################
+
+# returns the sysfs directory for a block device path, like /sys/class/block/sda, or None (eg. not Linux, or a regular file)
+def get_sysfs_block_dir(path):
+    name = os.path.basename(os.path.realpath(path))
+    sysfs_dir = "/sys/class/block/%s" % name
+    if os.path.exists(sysfs_dir):
+        return sysfs_dir
+    return None
+
+# returns the contents of a sysfs file without the newline, or None if it can't be read
+def read_sysfs(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read().decode("utf-8", "replace").strip()
+    except OSError:
+        return None
+
+# returns the queue dir of a device; partitions use the one of their disk
+def get_sysfs_queue_dir(sysfs_dir):
+    queue_dir = sysfs_dir + "/queue"
+    if not os.path.exists(queue_dir):
+        queue_dir = os.path.dirname(os.path.realpath(sysfs_dir)) + "/queue"
+    return queue_dir
+
+# returns the serial number of a disk from sysfs (NVMe, virtio and SCSI/SATA with a serial number VPD page), or None
+def get_sysfs_serial(dev_path):
+    sysfs_dir = get_sysfs_block_dir(dev_path)
+    if not sysfs_dir:
+        return None
+    return read_sysfs_serial(sysfs_dir)
+
+# same as get_sysfs_serial, for the sysfs dir of the disk, like /sys/class/block/sda
+def read_sysfs_serial(sysfs_dir):
+    serial = read_sysfs(sysfs_dir + "/device/serial") or read_sysfs(sysfs_dir + "/serial")
+    if serial:
+        return serial
+    try:
+        with open(sysfs_dir + "/device/vpd_pg80", "rb") as f:
+            # 4 byte header, then the serial number, padded with spaces
+            serial = f.read()[4:].decode("ascii", "replace").strip(" \x00")
+    except OSError:
+        return None
+    return serial or None
+
+# paces scan reads so they don't starve other IO on the device (Linux only; elsewhere only max_rate works)
+# Every interval, it samples /sys/class/block/<dev>/stat, and compares the sectors the device did with the ones the scan did. If there is more than that (foreign IO), and the device is busier than target_util percent or the average IO takes longer than latency_budget ms, it doubles a sleep between chunks and halves the chunk size limit. If the foreign IO is within the targets, it eases off again, and if there is no foreign IO, it runs flat out.
+# mode "sleep" is the old --sleep-percent behavior, which sleeps some percent of the time no matter what else is happening, and mode "none" doesn't sleep at all. max_rate (MB/s) is a token bucket limit applied in any mode.
+class Throttle():
+    # the smallest sleep after backing off
+    min_delay = 0.005
+
+    def __init__(self, device, mode, min_chunksize, max_chunksize, target_util=80, latency_budget=50, max_rate=0, sleep_percent=0, interval=0.5):
+        self.device = device
+        self.mode = mode
+        self.min_chunksize = min_chunksize
+        self.max_chunksize = max_chunksize
+        self.target_util = target_util
+        self.latency_budget = latency_budget
+        self.max_rate = max_rate
+        self.sleep_percent = sleep_percent
+        self.interval = interval
+
+        # the current sleep per chunk and chunk size limit
+        self.delay = 0
+        self.chunk_limit = max_chunksize
+
+        self.stat_path = None
+        if mode == "adaptive":
+            sysfs_dir = get_sysfs_block_dir(device.path)
+            if sysfs_dir:
+                self.stat_path = os.path.join(sysfs_dir, "stat")
+            else:
+                debug("%s - no sysfs stat for this device; not throttling adaptively" % (device))
+
+        now = time.time()
+        self.prev_stat = self.read_stat()
+        self.prev_stat_time = now
+        # sectors done by the scan since the last sample
+        self.own_sectors = 0
+
+        self.prev_time = None
+
+        self.tokens = 0
+        self.token_time = now
+
+    # returns the fields of the stat file as ints, or None
+    # 0 read IOs, 1 read merges, 2 read sectors, 3 read ticks (ms), 4 write IOs, 5 write merges, 6 write sectors, 7 write ticks, 8 in flight, 9 io ticks (ms busy), 10 time in queue
+    def read_stat(self):
+        if not self.stat_path:
+            return None
+        try:
+            with open(self.stat_path, "r") as f:
+                return [int(x) for x in f.read().split()]
+        except (OSError, ValueError):
+            return None
+
+    # the read size for the next chunk
+    def chunksize(self, read_size):
+        return min(read_size, self.chunk_limit)
+
+    # called after each chunk the scan did, with how many bytes it read and wrote; sleeps as needed
+    def done(self, nbytes):
+        now = time.time()
+        if self.mode == "sleep":
+            if self.sleep_percent and self.prev_time:
+                sleep_factor = self.sleep_percent/100
+                sleep_time = (sleep_factor * (now - self.prev_time))/(1 - sleep_factor)
+                #debug("%s - sleeping %s seconds" % (self.device, sleep_time))
+                time.sleep(sleep_time)
+        elif self.mode == "adaptive" and self.prev_stat:
+            self.own_sectors += nbytes / 512
+            if now - self.prev_stat_time >= self.interval:
+                self.adjust(now)
+            if self.delay:
+                time.sleep(self.delay)
+
+        if self.max_rate:
+            # token bucket, with up to 1 second of burst
+            rate = self.max_rate*1000000
+            self.tokens = min(rate, self.tokens + (now - self.token_time)*rate) - nbytes
+            self.token_time = now
+            if self.tokens < 0:
+                time.sleep(-self.tokens / rate)
+
+        self.prev_time = time.time()
+
+    def adjust(self, now):
+        stat = self.read_stat()
+        if not stat:
+            return
+        d = [stat[n] - self.prev_stat[n] for n in range(0, 11)]
+        elapsed_ms = (now - self.prev_stat_time)*1000
+
+        # sysfs stat sectors are always 512 bytes
+        sectors = d[2] + d[6]
+        ios = d[0] + d[4]
+        # readahead with the buffered backend can read a bit more than the scan asked for, so a little extra isn't counted as foreign
+        foreign_sectors = sectors - self.own_sectors
+        foreign = foreign_sectors > max(0.05*self.own_sectors, 2048)
+        util = 100*d[9] / elapsed_ms
+        latency = 0
+        if ios:
+            latency = (d[3] + d[7]) / ios
+
+        if not foreign:
+            # nothing else is using the device
+            self.delay = 0
+            self.chunk_limit = self.max_chunksize
+        elif util > self.target_util or latency > self.latency_budget:
+            self.delay = max(self.delay*2, Throttle.min_delay)
+            self.chunk_limit = max(int(self.chunk_limit/2), self.min_chunksize)
+        else:
+            self.delay = self.delay*0.75
+            if self.delay < Throttle.min_delay:
+                self.delay = 0
+            self.chunk_limit = min(self.chunk_limit*2, self.max_chunksize)
+
+        debug("%s - throttle: util = %.1f %%, latency = %.1f ms, foreign sectors = %d, in flight = %d; delay = %.3f s, chunk limit = %s" %
+              (self.device, util, latency, max(0, foreign_sectors), stat[8], self.delay, self.chunk_limit))
+
+        self.prev_stat = stat
+        self.prev_stat_time = now
+        self.own_sectors = 0
+
+################################################################################
+# checkpoints
+################################################################################
+
+# writes data to a temp file, fsyncs it and renames it over path, so a crash can't leave a broken file
+def write_file_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+    # make the rename durable too
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+# a sorted set of sectors, in an array of unsigned 64 bit ints
+# That is 8 bytes per sector instead of about 36 for a list of python ints, lookups are a binary search, and it saves to a file as the raw array.
+# Sectors are usually found in ascending order, so add() is normally an append.
+class SectorSet():
+    def __init__(self, sectors=None):
+        self.a = array.array("Q")
+        if sectors != None:
+            self.a.extend(sorted(set(sectors)))
+
+    def add(self, sector):
+        if len(self.a) == 0 or sector > self.a[-1]:
+            self.a.append(sector)
+            return
+        i = bisect.bisect_left(self.a, sector)
+        if i < len(self.a) and self.a[i] == sector:
+            return
+        self.a.insert(i, sector)
+
+    def __contains__(self, sector):
+        i = bisect.bisect_left(self.a, sector)
+        return i < len(self.a) and self.a[i] == sector
+
+    def __len__(self):
+        return len(self.a)
+
+    def __iter__(self):
+        return iter(self.a)
+
+    def __str__(self):
+        return list_to_string(self.a)
+
+    # returns the first sector in the set that is >= sector, or None
+    def next(self, sector):
+        i = bisect.bisect_left(self.a, sector)
+        if i < len(self.a):
+            return self.a[i]
+        return None
+
+    def copy(self):
+        c = SectorSet()
+        c.a = array.array("Q", self.a)
+        return c
+
+    def save(self, path):
+        write_file_atomic(path, self.a.tobytes())
+
+    # returns an empty set if the file doesn't exist
+    def load(path):
+        s = SectorSet()
+        try:
+            with open(path, "rb") as f:
+                s.a.frombytes(f.read())
+        except FileNotFoundError:
+            pass
+        return s
+    load = staticmethod(load)
+
+# The progress of a scan, saved so it can be continued with --resume after an interrupt, reboot or crash
+# It is a json file in the state dir, named by the device serial and the action (and "dry-run" for dry runs), plus SectorSet files for the bad and repaired sectors. Saving is batched: update() only writes when interval seconds have passed since the last save, and every file is written with write_file_atomic(), so a crash can't leave a broken checkpoint.
+class Checkpoint():
+    def __init__(self, device, state_dir, interval=30):
+        self.device = device
+        name = device.file_name()
+        # each action has its own checkpoint, so a run with another action doesn't replace the one --resume needs
+        name = "%s.%s" % (name, action)
+        if dry_run:
+            name += ".dry-run"
+        self.path = os.path.join(state_dir, "%s.json" % name)
+        self.bad_path = os.path.join(state_dir, "%s.bad" % name)
+        self.repaired_path = os.path.join(state_dir, "%s.repaired" % name)
+        self.interval = interval
+        self.last_save_time = 0
+
+        self.action = action
+        self.dry_run = dry_run
+        self.start_sector = None
+        self.end_sector = None
+        # "scan" for the read pass, "write" for the zerogood/zeroall write pass, "recover" for salvaging the bad sectors after the scan, "list" for the list actions (zerobaddmesg, zerobadsmartctl, zerobadlist, quick)
+        self.phase = "scan"
+        # everything before this sector is done
+        self.sector = None
+        self.bad = SectorSet()
+        self.repaired = SectorSet()
+        # len of bad and repaired at the last save; they only grow, so this tells if they need saving
+        self.saved_counts = (0, 0)
+        self.done = False
+
+    # returns True if there was a checkpoint to load
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                d = json.load(f)
+        except FileNotFoundError:
+            return False
+
+        # the file name has the action, so this is only for files that were renamed or copied
+        if( d["action"] != self.action or d["dry_run"] != self.dry_run ):
+            warn("%s - checkpoint %s is for action %s with dry_run = %s, not action %s with dry_run = %s; ignoring it" %
+                 (self.device, self.path, d["action"], d["dry_run"], self.action, self.dry_run))
+            return False
+
+        self.start_sector = d["start_sector"]
+        self.end_sector = d["end_sector"]
+        self.phase = d["phase"]
+        self.sector = d["sector"]
+        self.bad = SectorSet.load(self.bad_path)
+        self.repaired = SectorSet.load(self.repaired_path)
+        self.saved_counts = (len(self.bad), len(self.repaired))
+        self.done = d["done"]
+        return True
+
+    def save(self):
+        d = {
+            "serial": self.device.serial,
+            "path": self.device.path,
+            "action": self.action,
+            "dry_run": self.dry_run,
+            "start_sector": self.start_sector,
+            "end_sector": self.end_sector,
+            "phase": self.phase,
+            "sector": self.sector,
+            "bad_count": len(self.bad),
+            "repaired_count": len(self.repaired),
+            "done": self.done,
+            "time": time.time(),
+        }
+        # the sets first, so the json never says more is done than the sets have
+        counts = (len(self.bad), len(self.repaired))
+        if counts != self.saved_counts:
+            self.bad.save(self.bad_path)
+            self.repaired.save(self.repaired_path)
+            self.saved_counts = counts
+        write_file_atomic(self.path, bytes(json.dumps(d, separators=(",", ":")), "utf-8"))
+        self.last_save_time = time.time()
+
+    # called for every chunk, so this only saves every interval seconds
+    def update(self, sector, now=None):
+        self.sector = sector
+        if now == None:
+            now = time.time()
+        if now - self.last_save_time >= self.interval:
+            self.save()
+
+    def add_bad(self, sector):
+        self.bad.add(sector)
+
+    def add_repaired(self, sector):
+        self.repaired.add(sector)
+
+    # the next phase starts at start_sector
+    def next_phase(self, phase):
+        self.phase = phase
+        self.sector = self.start_sector
+        self.save()
+
+    def finish(self):
+        self.done = True
+        self.save()
+
+# returns a new or (with --resume) loaded Checkpoint for device, or None if checkpoints are disabled
+def open_checkpoint(device, start_sector, end_sector):
+    if not args.state_dir:
+        return None
+
+    try:
+        os.makedirs(args.state_dir, exist_ok=True)
+    except OSError as e:
+        warn("%s - can't create state dir %s, so not saving checkpoints: %s" % (device, args.state_dir, e))
+        return None
+
+    checkpoint = Checkpoint(device, args.state_dir, interval=args.checkpoint_interval)
+    if args.resume and checkpoint.load():
+        info("%s - resuming from checkpoint %s; phase = %s, sector = %s, %s bad, %s repaired" %
+             (device, checkpoint.path, checkpoint.phase, checkpoint.sector, len(checkpoint.bad), len(checkpoint.repaired)))
+        return checkpoint
+    elif args.resume:
+        info("%s - no checkpoint to resume at %s; starting at sector %s" % (device, checkpoint.path, start_sector))
+
+    checkpoint.start_sector = start_sector
+    checkpoint.end_sector = end_sector
+    checkpoint.sector = start_sector
+    if( action == "zeroall" ):
+        # there is no scan first
+        checkpoint.phase = "write"
+    elif( action in ["zerobaddmesg", "zerobadsmartctl", "quick", "zerobadlist"] ):
+        checkpoint.phase = "list"
+    return checkpoint
+
+# the states an ExtentList can give a range of sectors; the index is the state's number in the binary format
+extent_states = ["bad", "repaired", "slow"]
+
+# a set of sector ranges, each with a state, for exporting bad sectors with --bad-out and importing them with --bad-in
+# Each state is a sorted list of non-overlapping (start, end) ranges (end is exclusive), so a damaged area of thousands of sectors is one extent instead of thousands of ints, and merging and subtracting are done range by range.
+# A sector has at most one state; adding a range with one state removes it from the others, so a bad sector that was later repaired is only "repaired".
+# The text format is a line per extent of "start length state", with # comments and a "sector_size <bytes>" line. A line with only a start is one bad sector, so a plain list of sectors works too.
+# The binary format is a header of struct "<8sIQ" (magic, sector size, extent count), then the extents as struct "<QQB" (start, length, state index).
+class ExtentList():
+    magic = b"DR9EXT1\0"
+    header = struct.Struct("<8sIQ")
+    record = struct.Struct("<QQB")
+
+    def __init__(self, sector_size=512):
+        self.sector_size = sector_size
+        self.ranges = {state: [] for state in extent_states}
+
+    # adds sectors start to start+length-1 with a state, removing them from the other states
+    def add(self, start, length=1, state="bad"):
+        if length <= 0:
+            return
+        end = start + length
+        for other in extent_states:
+            if other != state:
+                self.remove_range(self.ranges[other], start, end)
+        ranges = self.ranges[state]
+        if not ranges or start > ranges[-1][1]:
+            # the usual case, sectors found in ascending order
+            ranges.append((start, end))
+            return
+        # replace every range that overlaps or touches this one with one range covering them all
+        i = bisect.bisect_left(ranges, (start,))
+        if i > 0 and ranges[i-1][1] >= start:
+            i -= 1
+        j = i
+        while j < len(ranges) and ranges[j][0] <= end:
+            start = min(start, ranges[j][0])
+            end = max(end, ranges[j][1])
+            j += 1
+        ranges[i:j] = [(start, end)]
+
+    # removes sectors start to end-1 from a sorted list of ranges
+    def remove_range(self, ranges, start, end):
+        if not ranges or start >= ranges[-1][1] or end <= ranges[0][0]:
+            return
+        i = bisect.bisect_left(ranges, (start,))
+        if i > 0 and ranges[i-1][1] > start:
+            i -= 1
+        j = i
+        keep = []
+        while j < len(ranges) and ranges[j][0] < end:
+            r_start, r_end = ranges[j]
+            if r_start < start:
+                keep += [(r_start, start)]
+            if r_end > end:
+                keep += [(end, r_end)]
+            j += 1
+        ranges[i:j] = keep
+
+    # removes sectors start to start+length-1 from every state
+    def remove(self, start, length=1):
+        for state in extent_states:
+            self.remove_range(self.ranges[state], start, start + length)
+
+    # adds all the extents of another ExtentList; where they overlap, the other list's state wins
+    def merge(self, other):
+        other = other.converted(self.sector_size)
+        for start, length, state in other.extents():
+            self.add(start, length, state)
+
+    # removes every sector that is in another ExtentList, whatever its state there, eg. "bad in the kernel log" minus "already repaired"
+    def subtract(self, other):
+        other = other.converted(self.sector_size)
+        for start, length, state in other.extents():
+            self.remove(start, length)
+
+    # returns this list in sectors of another size; a sector that is partly in a range is in it
+    def converted(self, sector_size):
+        if sector_size == self.sector_size:
+            return self
+        ret = ExtentList(sector_size)
+        for start, length, state in self.extents():
+            first = start * self.sector_size // sector_size
+            last = ((start + length) * self.sector_size + sector_size - 1) // sector_size
+            ret.add(first, last - first, state)
+        return ret
+
+    # yields (start, length, state) for every extent, in ascending order of start
+    def extents(self):
+        all_ranges = []
+        for state in extent_states:
+            all_ranges += [(start, end - start, state) for start, end in self.ranges[state]]
+        return sorted(all_ranges)
+
+    # yields every sector with a state, in ascending order
+    def sectors(self, state="bad"):
+        for start, end in self.ranges[state]:
+            for sector in range(start, end):
+                yield sector
+
+    def count(self, state="bad"):
+        return sum(end - start for start, end in self.ranges[state])
+
+    def __len__(self):
+        return sum(len(ranges) for ranges in self.ranges.values())
+
+    def __str__(self):
+        return ", ".join(["%s %s sectors in %s extents" % (state, self.count(state), len(self.ranges[state])) for state in extent_states])
+
+    def to_text(self, comment=None):
+        lines = ["# diskRepair9 extents: start length state"]
+        if comment:
+            lines += ["# %s" % comment]
+        lines += ["sector_size %s" % self.sector_size]
+        lines += ["%s %s %s" % extent for extent in self.extents()]
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def to_binary(self):
+        extents = self.extents()
+        data = [ExtentList.header.pack(ExtentList.magic, self.sector_size, len(extents))]
+        for start, length, state in extents:
+            data += [ExtentList.record.pack(start, length, extent_states.index(state))]
+        return b"".join(data)
+
+    def save(self, path, binary=False, comment=None):
+        write_file_atomic(path, self.to_binary() if binary else self.to_text(comment))
+
+    # loads either format; raises an Exception for a line or record it doesn't understand
+    def load(path):
+        with open(path, "rb") as f:
+            data = f.read()
+
+        if data.startswith(ExtentList.magic):
+            magic, sector_size, count = ExtentList.header.unpack_from(data)
+            extents = ExtentList(sector_size)
+            offset = ExtentList.header.size
+            if len(data) != offset + count*ExtentList.record.size:
+                raise Exception("extent file %s is truncated: expected %s extents" % (path, count))
+            for n in range(count):
+                start, length, state = ExtentList.record.unpack_from(data, offset)
+                offset += ExtentList.record.size
+                if state >= len(extent_states):
+                    raise Exception("extent file %s has an unknown state %s" % (path, state))
+                extents.add(start, length, extent_states[state])
+            return extents
+
+        extents = ExtentList()
+        for line_number, line in enumerate(data.decode("utf-8").splitlines(), 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            try:
+                if fields[0] == "sector_size":
+                    if len(extents):
+                        raise ValueError("sector_size has to come before the extents")
+                    extents.sector_size = int(fields[1])
+                    continue
+                start = int(fields[0])
+                length = int(fields[1]) if len(fields) > 1 else 1
+                state = fields[2] if len(fields) > 2 else "bad"
+                if state not in extent_states or len(fields) > 3:
+                    raise ValueError("expected: start [length [state]], with state one of %s" % (", ".join(extent_states)))
+            except (ValueError, IndexError) as e:
+                raise Exception("extent file %s line %s: %s" % (path, line_number, e))
+            extents.add(start, length, state)
+        return extents
+    load = staticmethod(load)
+
+# returns the --bad-in, --bad-out or --bad-exclude path for a device; {serial} in it is replaced by the serial, so one option can name a file per device
+def get_extent_path(device, path):
+    return path.replace("{serial}", device.file_name())
+
+# adds the --bad-in files for a device to extents (an ExtentList in the device's sectors), then removes the --bad-exclude files, and returns it
+def load_bad_in(device, extents):
+    for path in args.bad_in:
+        path = get_extent_path(device, path)
+        loaded = ExtentList.load(path)
+        info("%s - loaded %s from %s" % (device, loaded, path))
+        # a sector repaired since another file said it was bad isn't bad anymore
+        extents.merge(loaded)
+    for path in args.bad_exclude:
+        path = get_extent_path(device, path)
+        excluded = ExtentList.load(path)
+        info("%s - excluding %s from %s" % (device, excluded, path))
+        extents.subtract(excluded)
+    return extents
+
+# writes what the device's run found to --bad-out
+def save_bad_out(device):
+    path = get_extent_path(device, args.bad_out)
+    device.extents.save(path, binary=(args.bad_format == "binary"), comment="device %s, serial %s, action %s" % (device.path, device.serial, action))
+    info("%s - wrote %s to %s" % (device, device.extents, path))
+
+# what is known about each granule of a CoverageMap
+coverage_unverified = 0
+coverage_clean = 1
+coverage_bad = 2
+coverage_repaired = 3
+coverage_names = ["unverified", "clean", "bad", "repaired"]
+
+# a byte of 4 clean granules
+coverage_clean_byte = 0x55
+coverage_not_clean_re = re.compile(b"[^\\x55]")
+
+# remembers which parts of a disk were read clean, were bad, or were repaired, across runs, so a later scan can skip what is already known to be clean
+# It is a file in the state dir named by the serial, with a small header and then 2 bits per granule of granularity bytes (4 granules per byte), used through mmap, so marking is just setting bits in memory, and the kernel writes the pages out. 1 MiB granules make 4 MB for a 16 TB disk.
+# A granule is only marked clean when all of it was read ok in one run of reads; bad and repaired are set for the granule of each bad sector, and stay until a later scan reads the whole granule clean again.
+class CoverageMap():
+    magic = b"DR9COV1\0"
+    header = struct.Struct("<8sQQ")
+
+    def __init__(self, device, state_dir, granularity=1024*1024):
+        if( granularity % device.physical_sector_size != 0 ):
+            raise Exception("coverage granularity (%s) must be a multiple of the physical sector size (%s)" % (granularity, device.physical_sector_size))
+        self.device = device
+        self.path = os.path.join(state_dir, "%s.coverage" % device.file_name())
+        self.granularity = granularity
+        self.granule_sectors = granularity // device.sector_size
+        self.granules = (device.size + granularity - 1) // granularity
+        # granules marked bad or repaired in this run, which a clean read around them must not overwrite, with the sectors in each that are still bad
+        self.marked = {}
+
+        length = self.header.size + (self.granules + 3) // 4
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, length)
+                os.pwrite(fd, self.header.pack(self.magic, granularity, device.size), 0)
+            else:
+                magic, file_granularity, file_size = self.header.unpack(os.pread(fd, self.header.size, 0))
+                if magic != self.magic:
+                    raise Exception("%s is not a coverage map" % (self.path))
+                if file_granularity != granularity or file_size != device.size:
+                    # eg. another --coverage-granularity, or a loop device or partition that changed size; the old map says nothing about this one
+                    warn("%s - coverage map %s has granularity %s and size %s, but this is granularity %s and size %s; starting a new one" %
+                         (device, self.path, file_granularity, file_size, granularity, device.size))
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, length)
+                    os.pwrite(fd, self.header.pack(self.magic, granularity, device.size), 0)
+            self.m = mmap.mmap(fd, length)
+        finally:
+            os.close(fd)
+
+    def get(self, granule):
+        byte = self.m[self.header.size + granule // 4]
+        return (byte >> (granule % 4 * 2)) & 3
+
+    def set(self, granule, state):
+        i = self.header.size + granule // 4
+        shift = granule % 4 * 2
+        self.m[i] = (self.m[i] & ~(3 << shift)) | (state << shift)
+
+    # marks the granules that are completely inside [start_sector, end_sector) clean
+    def mark_clean(self, start_sector, end_sector):
+        first = (start_sector + self.granule_sectors - 1) // self.granule_sectors
+        # the last granule can be short, at the end of the disk
+        if end_sector >= self.device.sectors:
+            end = self.granules
+        else:
+            end = end_sector // self.granule_sectors
+        for granule in range(first, end):
+            if granule not in self.marked:
+                self.set(granule, coverage_clean)
+
+    # a granule with a bad sector that wasn't repaired in this run is bad, even if other sectors in it were repaired
+    # A sector that was marked bad and then repaired later in the run (recover marks it bad when the scan finds it) isn't bad anymore.
+    def mark_bad(self, sector, repaired=False):
+        granule = sector // self.granule_sectors
+        still_bad = self.marked.setdefault(granule, set())
+        if repaired:
+            still_bad.discard(sector)
+        else:
+            still_bad.add(sector)
+        if still_bad:
+            self.set(granule, coverage_bad)
+        else:
+            self.set(granule, coverage_repaired)
+
+    # returns the first sector at or after sector that isn't in a clean granule, or None
+    def next_unclean(self, sector):
+        granule = sector // self.granule_sectors
+        while granule < self.granules and granule % 4:
+            if self.get(granule) != coverage_clean:
+                return max(sector, granule * self.granule_sectors)
+            granule += 1
+        # whole bytes of clean granules are skipped with a regex, at the speed of C
+        m = coverage_not_clean_re.search(self.m, self.header.size + granule // 4)
+        if not m:
+            return None
+        granule = (m.start() - self.header.size) * 4
+        while granule < self.granules:
+            if self.get(granule) != coverage_clean:
+                return max(sector, granule * self.granule_sectors)
+            granule += 1
+        return None
+
+    # returns the first sector after sector that is in a clean granule, looking at most limit sectors ahead
+    def next_clean(self, sector, limit):
+        granule = sector // self.granule_sectors + 1
+        end = min(self.granules, (sector + limit) // self.granule_sectors + 1)
+        while granule < end:
+            if self.get(granule) == coverage_clean:
+                return granule * self.granule_sectors
+            granule += 1
+        return sector + limit
+
+    # returns how many granules are in each state
+    def counts(self):
+        counts = [0, 0, 0, 0]
+        for byte, n in collections.Counter(self.m[self.header.size:]).items():
+            for shift in range(0, 8, 2):
+                counts[(byte >> shift) & 3] += n
+        # the padding at the end of the last byte isn't granules
+        counts[coverage_unverified] -= (len(self.m) - self.header.size) * 4 - self.granules
+        return counts
+
+    def summary(self):
+        counts = self.counts()
+        return ", ".join(["%s %s granules (%.2f GB)" % (coverage_names[state], counts[state], counts[state] * self.granularity / 1000000000) for state in range(0, 4)])
+
+    def close(self):
+        self.m.flush()
+        self.m.close()
+
+# returns the CoverageMap for device, or None if there is no state dir
+def open_coverage(device):
+    if not args.state_dir:
+        return None
+    try:
+        os.makedirs(args.state_dir, exist_ok=True)
+        return CoverageMap(device, args.state_dir, args.coverage_granularity)
+    except Exception as e:
+        warn("%s - can't open the coverage map in state dir %s, so not saving it: %s" % (device, args.state_dir, e))
+        return None
+
+################################################################################
+# kernel log
+################################################################################
+
+# The kernel log lines that name a failed sector, for each kind of device:
+# block layer (any device, in 512 byte sectors), eg.
+#     blk_update_request: I/O error, dev sdb, sector 5676131383 op 0x0:(READ) flags 0x0 phys_seg 1 prio class 0
+#     blk_update_request: critical medium error, dev sdb, sector 5676131383
+kmsg_block_re = re.compile(r"\bdev (\w[\w!.-]*), sector (\d+)")
+# NVMe (in the namespace's logical blocks), eg.
+#     nvme0n1: Read(0x2) @ LBA 1234, 8 blocks, Unrecovered Read Error (sct 0x2 / sc 0x81) DNR
+#     nvme0n1: I/O Cmd(0x2) @ LBA 1234, 8 blocks, I/O Error (sct 0x2 / sc 0x81) DNR
+kmsg_nvme_re = re.compile(r"\b(nvme\d+(?:c\d+)?n\d+): .*@ LBA (\d+), \d+ blocks")
+# libata (in the disk's logical blocks); the port is on the cmd line, and the LBA of the error is in the result taskfile on the next line, eg.
+#     ata4.00: cmd 25/00:08:37:e4:52/00:00:52:01:00/e0 tag 18 dma 4096 in
+#              res 51/40:00:37:e4:52/00:00:52:01:00/00 Emask 0x9 (media error)
+kmsg_ata_re = re.compile(r"\b(ata\d+)[.:]")
+kmsg_ata_res_re = re.compile(r"\bres ([0-9a-f]{2})/([0-9a-f]{2}):([0-9a-f]{2}):([0-9a-f]{2}):([0-9a-f]{2}):([0-9a-f]{2})/([0-9a-f]{2}):([0-9a-f]{2}):([0-9a-f]{2}):([0-9a-f]{2}):([0-9a-f]{2})/([0-9a-f]{2}) Emask (0x[0-9a-f]+)(?: \(([^)]*)\))?")
+# /dev/kmsg escapes newlines and other unprintable characters in a message as \xNN
+kmsg_escape_re = re.compile(r"\\x([0-9a-f]{2})")
+
+# returns the LBA in an ATA result taskfile, or None if it isn't a media error
+# fields are status/error:nsect:lbal:lbam:lbah/hob_feature:hob_nsect:hob_lbal:hob_lbam:hob_lbah/device
+def decode_ata_res(m):
+    status, err, nsect, lbal, lbam, lbah, hob_feature, hob_nsect, hob_lbal, hob_lbam, hob_lbah, dev = [int(x, 16) for x in m.groups()[0:12]]
+    emask_txt = m.group(14) or ""
+    # error register bit 6 is UNC (uncorrectable data)
+    if not ( err & 0x40 or "media error" in emask_txt ):
+        return None
+    return lbal | lbam << 8 | lbah << 16 | hob_lbal << 24 | hob_lbam << 32 | hob_lbah << 40
+
+# returns the whole disk names (eg. sdb) by ata port (eg. ata4), from sysfs
+def get_ata_ports():
+    ports = {}
+    for path in glob.glob("/sys/block/*"):
+        for part in os.path.realpath(path).split("/"):
+            if re.fullmatch(r"ata\d+", part):
+                ports.setdefault(part, os.path.basename(path))
+                break
+    return ports
+
+# returns how many 512 byte units are in a logical block of the named disk
+def get_block_units(name):
+    try:
+        with open("/sys/block/%s/queue/logical_block_size" % name) as f:
+            return int(f.read()) // 512
+    except (OSError, ValueError):
+        return 1
+
+# Finds the failed sectors in the kernel log, for all devices in one pass
+# The sectors are kept in 512 byte units by disk name (eg. sdb, nvme0n1, dm-3), like the block layer reports them. feed() takes one log message at a time, so the same parser works on /dev/kmsg records, a saved dmesg or kern.log, and new records while following /dev/kmsg.
+class KernelLog():
+    def __init__(self):
+        self.sectors = {}
+        self.ata_ports = None
+        self.ata_port = None
+        self.block_units = {}
+        self.lines = 0
+        
+    def block_unit(self, name):
+        if name not in self.block_units:
+            self.block_units[name] = get_block_units(name)
+        return self.block_units[name]
+
+    def add(self, name, sector):
+        if name not in self.sectors:
+            self.sectors[name] = SectorSet()
+        self.sectors[name].add(sector)
+
+    # parses one line; returns (name, sector) if it names a failed sector, else None
+    def feed_line(self, line):
+        self.lines += 1
+        m = kmsg_block_re.search(line)
+        if m:
+            return m.group(1), int(m.group(2))
+
+        m = kmsg_nvme_re.search(line)
+        if m:
+            name = m.group(1)
+            return name, int(m.group(2)) * self.block_unit(name)
+
+        m = kmsg_ata_re.search(line)
+        if m:
+            self.ata_port = m.group(1)
+        m = kmsg_ata_res_re.search(line)
+        if m and self.ata_port:
+            lba = decode_ata_res(m)
+            if self.ata_ports is None:
+                self.ata_ports = get_ata_ports()
+            name = self.ata_ports.get(self.ata_port)
+            if lba is not None and name:
+                return name, lba * self.block_unit(name)
+        return None
+
+    # parses a message, which may have more than one line; returns a list of (name, sector)
+    def feed(self, message):
+        ret = []
+        for line in message.splitlines():
+            found = self.feed_line(line)
+            if found:
+                self.add(*found)
+                ret += [found]
+        return ret
+
+    # parses a /dev/kmsg record like "3,1234,5678901,-;message" (more lines starting with a space are key=value properties)
+    def feed_record(self, record):
+        header, sep, message = record.partition(";")
+        if not sep:
+            return []
+        message = message.split("\n", 1)[0]
+        message = kmsg_escape_re.sub(lambda m: chr(int(m.group(1), 16)), message)
+        return self.feed(message)
+
+    # returns the failed sectors for a Device, in its sectors
+    def get(self, device):
+        name = os.path.basename(os.path.realpath(device.path))
+        ret = SectorSet()
+        for s in self.sectors.get(name, []):
+            ret.add(s * 512 // device.sector_size)
+        return ret
+
+# opens /dev/kmsg without blocking, or returns None if it can't be read (eg. not Linux, or not root)
+def open_kmsg():
+    try:
+        return os.open("/dev/kmsg", os.O_RDONLY | os.O_NONBLOCK)
+    except OSError as e:
+        debug("can't open /dev/kmsg: %s" % (e))
+        return None
+
+# reads whatever /dev/kmsg records are ready; each read returns one record
+# yields None when there are no more records for now
+def read_kmsg(fd):
+    while True:
+        try:
+            record = os.read(fd, 8192)
+        except BlockingIOError:
+            yield None
+            continue
+        except BrokenPipeError:
+            # the kernel overwrote records before we read them; the next read continues with the oldest one left
+            warn("some kernel log records were lost before they were read")
+            continue
+        yield record.decode("utf-8", "replace")
+
+# the kernel log read once for all devices
+kernel_log = None
+# with --follow-kmsg, the /dev/kmsg fd that get_kernel_log() read, left open where it stopped, so follow_kmsg() gets every record after that
+kernel_log_fd = None
+
+# reads the kernel log (the --kmsg-file, else /dev/kmsg, else the output of dmesg) the first time, and returns the KernelLog
+def get_kernel_log():
+    global kernel_log, kernel_log_fd
+    if kernel_log is not None:
+        return kernel_log
+
+    kernel_log = KernelLog()
+    if args.kmsg_file:
+        debug("reading kernel log from %s" % (args.kmsg_file))
+        with open(args.kmsg_file, "r", errors="replace") as f:
+            for line in f:
+                kernel_log.feed(line)
+        return kernel_log
+    
+    fd = open_kmsg()
+    if fd is not None:
+        debug("reading kernel log from /dev/kmsg")
+        try:
+            for record in read_kmsg(fd):
+                if record is None:
+                    break
+                kernel_log.feed_record(record)
+        finally:
+            if args.follow_kmsg:
+                kernel_log_fd = fd
+            else:
+                os.close(fd)
+    else:
+        debug("reading kernel log from dmesg")
+        p = subprocess.run(["dmesg"], stdout=subprocess.PIPE)
+        if( p.returncode != 0 ):
+            error("Failed to read the kernel log with dmesg")
+        kernel_log.feed(p.stdout.decode("utf-8", "replace"))
+    debug("read %s kernel log lines, found failed sectors on %s" % (kernel_log.lines, list_to_string(sorted(kernel_log.sectors))))
+    return kernel_log
+
+# how long follow_kmsg() ignores new kernel log records for a sector after it was found bad or repaired
+# Reading a sector that can't be repaired fails again, and the kernel logs that too, so without this, every fixup would make the next one.
+kmsg_handled_seconds = 600
+
+# waits for new /dev/kmsg records, and repairs the failed sectors they name on the given devices as they are reported, until interrupted
+# It starts right after the records get_kernel_log() read, so records logged while the sector list was being repaired aren't lost. The sectors the list pass already handled are skipped, by Device.handled; in parallel mode, that is in the workers, so those sectors are checked once more here.
+def follow_kmsg(devices):
+    import select
+    
+    fd = kernel_log_fd
+    if fd is None:
+        fd = open_kmsg()
+        if fd is None:
+            error("--follow-kmsg needs /dev/kmsg")
+            return
+        # the kernel log was read from --kmsg-file or dmesg, so only the new records are for us
+        os.lseek(fd, 0, os.SEEK_END)
+    
+    by_name = {}
+    for device in devices:
+        by_name[os.path.basename(os.path.realpath(device.path))] = device
+    info("following the kernel log for %s" % (list_to_string(devices)))
+    
+    log = KernelLog()
+    try:
+        for record in read_kmsg(fd):
+            if record is None:
+                select.select([fd], [], [])
+                continue
+            for name, s in log.feed_record(record):
+                device = by_name.get(name)
+                if device is None:
+                    continue
+                s = s * 512 // device.sector_size
+                handled = device.handled.get(s)
+                now = time.monotonic()
+                if( handled is not None and now - handled < kmsg_handled_seconds ):
+                    debug("%s - kmsg; sector = %s (handled %.0f s ago; skipped)" % (device, s, now - handled))
+                    continue
+                device.handled[s] = now
+                info("%s - kmsg; sector = %s" % (device, s))
+                try:
+                    fixup(device, s)
+                except DiskFailed as e:
+                    # stop following this device, but not the others
+                    error(str(e))
+                    del by_name[name]
+    except KeyboardInterrupt:
+        info("stopped following the kernel log")
+    finally:
+        os.close(fd)
+
+################################################################################
+# SMART logs
+################################################################################
+
+# returns the int in a smartctl json value, which is either a number or like {"value": 123, ...}
+def smart_json_int(value):
+    if isinstance(value, dict):
+        value = value.get("value")
+    if isinstance(value, int):
+        return value
+    return None
+
+# returns the LBAs of failed self tests and media errors in smartctl --json output, in the disk's logical blocks
+def smart_json_lbas(data):
+    lbas = []
+    
+    # ATA
+    for log in ["standard", "extended"]:
+        for entry in data.get("ata_smart_self_test_log", {}).get(log, {}).get("table", []):
+            lbas += [smart_json_int(entry.get("lba"))]
+    for log in ["summary", "extended"]:
+        for entry in data.get("ata_smart_error_log", {}).get(log, {}).get("table", []):
+            # only UNC (uncorrectable data); the other errors also have an LBA, but it isn't a bad sector
+            if "UNC" in entry.get("error_description", ""):
+                lbas += [smart_json_int(entry.get("completion_registers", {}).get("lba"))]
+    
+    # NVMe
+    for entry in data.get("nvme_self_test_log", {}).get("table", []):
+        lbas += [smart_json_int(entry.get("lba"))]
+    for entry in data.get("nvme_error_information_log", {}).get("table", []):
+        # status code type 2 is media and data integrity errors
+        if entry.get("status_field", {}).get("status_code_type") == 2:
+            lbas += [smart_json_int(entry.get("lba"))]
+    
+    # SCSI
+    for key, entry in data.items():
+        if key.startswith("scsi_self_test_") and isinstance(entry, dict):
+            lbas += [smart_json_int(entry.get("lba_first_failure"))]
+
+    return [lba for lba in lbas if lba is not None]
+
+# runs smartctl --json for one device, and returns its failed sectors, or None if it failed
+def get_smart_sectors(device):
+    cmd = ["smartctl", "--json", "-l", "selftest", "-l", "error", device.path]
+    debug("%s - checking with cmd = %s" % (device, cmd))
+    try:
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        data = json.loads(p.stdout.decode("utf-8", "replace"))
+    except (OSError, ValueError) as e:
+        debug("%s - smartctl --json failed: %s" % (device, e))
+        return None
+    
+    # the exit status is a bit mask; bits 0 and 1 mean it couldn't parse the command line or open the device, and the others are about the disk, like errors in the logs
+    if( p.returncode & 3 ):
+        debug("%s - smartctl --json exit status = %s" % (device, p.returncode))
+        return None
+
+    # the LBAs are in logical blocks, which are the Device's sectors
+    sectors = SectorSet()
+    for lba in smart_json_lbas(data):
+        sectors.add(lba)
+    return sectors
+
+# the SMART log sectors by device path, collected once for all devices; None for a device means use the text parsers instead
+smart_sectors = None
+
+# runs smartctl for all the devices at the same time, at most jobs at once, and returns the SMART log sectors by device path
+def collect_smart_sectors(devices, jobs=8):
+    import concurrent.futures
+    global smart_sectors
+
+    if smart_sectors is None:
+        smart_sectors = {}
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for device, sectors in zip(devices, executor.map(get_smart_sectors, devices)):
+            smart_sectors[device.path] = sectors
+    debug("collected SMART logs for %s devices in %.1fs" % (len(devices), time.time() - start))
+    return smart_sectors
+
+################################################################################
+# health monitor
+################################################################################
+
+# the ATA SMART attributes the health monitor follows, by id
+health_ata_attributes = {5: "reallocated", 197: "pending", 198: "offline_uncorrectable"}
+
+# the counts that are added up to see if a disk is getting worse
+health_growth_keys = ["reallocated", "pending", "offline_uncorrectable", "media_errors"]
+
+# device states in sysfs (device/state, which is "running" for SCSI/SATA and "live" for NVMe when ok) that mean the kernel gave up on the device
+dead_device_states = ["offline", "dead", "deleting", "transport-offline"]
+
+# returns the SMART counts of a device from smartctl --json, as a dict with the names in health_ata_attributes (or media_errors for NVMe), and "passed" for the overall health, or None if smartctl couldn't read it
+def get_smart_health(device):
+    cmd = ["smartctl", "--json", "-H", "-A", device.path]
+    try:
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=60)
+        data = json.loads(p.stdout.decode("utf-8", "replace"))
+    except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+        debug("%s - smartctl --json failed: %s" % (device, e))
+        return None
+    if( p.returncode & 3 ):
+        debug("%s - smartctl --json exit status = %s" % (device, p.returncode))
+        return None
+
+    health = {}
+    passed = data.get("smart_status", {}).get("passed")
+    if passed != None:
+        health["passed"] = passed
+    for attribute in data.get("ata_smart_attributes", {}).get("table", []):
+        name = health_ata_attributes.get(attribute.get("id"))
+        if name:
+            health[name] = smart_json_int(attribute.get("raw"))
+    nvme_log = data.get("nvme_smart_health_information_log")
+    if nvme_log:
+        health["media_errors"] = smart_json_int(nvme_log.get("media_errors"))
+        health["critical_warning"] = smart_json_int(nvme_log.get("critical_warning"))
+    if "scsi_grown_defect_list" in data:
+        health["reallocated"] = smart_json_int(data.get("scsi_grown_defect_list"))
+    return health
+
+# watches a device while it is worked on: first once before starting (the pre-flight check), then in a thread every interval seconds, it reads the sysfs state, and the SMART counts if there is smartctl
+# If the device disappears, the kernel sets it offline, or the counts in health_growth_keys together grow by more than max_growth since the start, it sets device.health_failure, and the work on that device stops with DiskFailed at its next Device.check_health(), while the other devices keep going.
+# Every sample goes into history, the "health" events, and the <serial>.health file (json lines) in the state dir, so there is a record of how the pending count changed during the repair.
+class HealthMonitor():
+    def __init__(self, device, interval=60, max_growth=5000, use_smartctl=True):
+        self.device = device
+        self.interval = interval
+        self.max_growth = max_growth
+        self.use_smartctl = use_smartctl
+        self.sysfs_dir = get_sysfs_block_dir(device.path)
+        # (time, dict of counts) of every sample
+        self.history = []
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.history_path = None
+        if args.state_dir:
+            self.history_path = os.path.join(args.state_dir, "%s.health" % device.file_name())
+
+    # returns why the device can't be worked on anymore, or None
+    def get_failure(self, health):
+        device = self.device
+        if not os.path.exists(device.path):
+            return "%s disappeared" % (device.path)
+        if self.sysfs_dir:
+            if not os.path.exists(self.sysfs_dir):
+                return "%s disappeared" % (self.sysfs_dir)
+            state = read_sysfs(self.sysfs_dir + "/device/state")
+            if state in dead_device_states:
+                return "the kernel says the device is %s" % (state)
+        growth = self.growth(health)
+        if( self.max_growth and growth > self.max_growth ):
+            return "%s more reallocated, pending and uncorrectable sectors than at the start (limit %s)" % (growth, self.max_growth)
+        return None
+
+    # the sum of the health_growth_keys counts, or None if there are none
+    def total(self, health):
+        values = [health.get(key) for key in health_growth_keys if health.get(key) != None]
+        if not values:
+            return None
+        return sum(values)
+
+    # how much the counts grew since the first sample
+    def growth(self, health):
+        if not self.history:
+            return 0
+        first = self.total(self.history[0][1])
+        now = self.total(health)
+        if first == None or now == None:
+            return 0
+        return now - first
+
+    # takes one sample; returns the failure reason, or None
+    def sample(self):
+        device = self.device
+        health = None
+        if self.use_smartctl and os.path.exists(device.path):
+            health = get_smart_health(device)
+            if health == None:
+                # eg. a loop device or dm; don't try again every interval
+                debug("%s - smartctl can't read SMART from this device; only checking sysfs" % (device))
+                self.use_smartctl = False
+        health = health or {}
+        failure = self.get_failure(health)
+
+        now = time.time()
+        if self.history and health:
+            previous = self.history[-1][1]
+            for key in health_growth_keys:
+                if health.get(key) != None and previous.get(key) != None and health[key] > previous[key]:
+                    warn("%s - SMART %s grew from %s to %s" % (device, key, previous[key], health[key]))
+        self.history.append((now, health))
+        device.metrics.health = health
+        device.metrics.event("health", failure=failure, **health)
+        if self.history_path:
+            record = dict(health, time=round(now, 3), failure=failure)
+            try:
+                with open(self.history_path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                debug("%s - can't write %s: %s" % (device, self.history_path, e))
+        return failure
+
+    # the first sample, before the work starts; raises DiskFailed if the device is already unusable
+    def preflight(self):
+        device = self.device
+        failure = self.sample()
+        if failure:
+            raise DiskFailed("%s - not starting: %s" % (device, failure))
+        health = self.history[-1][1]
+        if health.get("passed") == False:
+            warn("%s - SMART overall health check FAILED; the disk might not last the whole run" % (device))
+        if health:
+            info("%s - health at start: %s" % (device, ", ".join(["%s = %s" % (key, value) for key, value in sorted(health.items())])))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            failure = self.sample()
+            if failure:
+                error("%s - health monitor: %s; stopping work on this device" % (self.device, failure))
+                self.device.health_failure = failure
+                return
+
+    # stops the thread and prints how the counts changed
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if not self.device.health_failure:
+            # one more sample for the end, unless the thread just took the failing one
+            self.sample()
+        changes = []
+        for key in health_growth_keys:
+            values = [health[key] for t, health in self.history if health.get(key) != None]
+            if values:
+                changes += ["%s %s -> %s (max %s)" % (key, values[0], values[-1], max(values))]
+        if changes:
+            info("%s - health over %s samples: %s" % (self.device, len(self.history), ", ".join(changes)))
+
+# makes and starts the HealthMonitor for a device, after its pre-flight check, or returns None with --health-interval 0
+def start_health_monitor(device):
+    if not args.health_interval:
+        return None
+    monitor = HealthMonitor(device, interval=args.health_interval, max_growth=args.health_max_growth, use_smartctl=which("smartctl") != None)
+    monitor.preflight()
+    monitor.start()
+    return monitor
+
+################################################################################
+# metrics
+################################################################################
+
+# counts durations in buckets that double in size, from 1 ms up to about 16 s, plus one for anything longer
+# observe() is only a frexp and a list increment, so it can time every chunk read without slowing the scan down
+class LatencyHistogram():
+    first_bound = 0.001
+    bucket_count = 15
+
+    def __init__(self):
+        self.counts = [0] * (self.bucket_count + 1)
+        self.sum = 0
+        self.count = 0
+
+    # the upper bound of each bucket in seconds, except the last one, which has no bound
+    def bounds(self):
+        return [self.first_bound * 2**n for n in range(0, self.bucket_count)]
+
+    def observe(self, seconds):
+        # frexp(x) gives the exponent e where 2**(e-1) <= x < 2**e, so bucket n is first_bound*2**(n-1) <= seconds < first_bound*2**n
+        e = math.frexp(seconds / self.first_bound)[1]
+        self.counts[min(max(e, 0), self.bucket_count)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def __str__(self):
+        ret = []
+        low = 0
+        for bound, count in zip(self.bounds() + [None], self.counts):
+            if count:
+                if bound == None:
+                    ret += [">=%gms: %s" % (low*1000, count)]
+                else:
+                    ret += ["<%gms: %s" % (bound*1000, count)]
+            low = bound
+        return ", ".join(ret)
+
+# escapes a prometheus label value
+def prom_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# the progress and error counts of one Device, for monitoring
+# With --events, each event (start, progress, read_error, repair_ok, repair_failed, done) is appended to a file as a json line; the file is opened with O_APPEND and each line is one write, so parallel workers can share it. With --textfile-dir, a prometheus textfile (for the node_exporter textfile collector) is written every --metrics-interval seconds, one per device.
+# progress is only called as often as the status line is printed, so this costs nothing per chunk.
+class Metrics():
+    def __init__(self, device):
+        self.device = device
+        self.phase = ""
+        self.sector = 0
+        self.rate = 0
+        self.done_bytes = 0
+        self.total_bytes = 0
+        self.read_errors = 0
+        self.bad_sectors = 0
+        self.repairs_ok = 0
+        self.repairs_failed = 0
+        self.read_latency = LatencyHistogram()
+        # the last SMART counts from the HealthMonitor
+        self.health = {}
+        self.done = False
+        self.events_fd = None
+        self.last_write = 0
+
+    def event(self, name, **fields):
+        if not args.events:
+            return
+        if self.events_fd == None:
+            if args.events == "-":
+                self.events_fd = sys.stdout.fileno()
+            else:
+                self.events_fd = os.open(args.events, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        record = {"time": round(time.time(), 3), "event": name, "device": self.device.path, "serial": self.device.serial}
+        record.update(fields)
+        os.write(self.events_fd, (json.dumps(record) + "\n").encode("utf-8"))
+
+    def start(self):
+        self.event("start", action=action, dry_run=dry_run, size=self.device.size, sector_size=self.device.sector_size,
+                   physical_sector_size=self.device.physical_sector_size)
+        self.write_textfile()
+
+    # rate is in MB/s, like the status line
+    def progress(self, phase, sector, rate, done_bytes, total_bytes):
+        self.phase = phase
+        self.sector = sector
+        self.rate = rate
+        self.done_bytes = done_bytes
+        self.total_bytes = total_bytes
+        if not ( args.events or args.textfile_dir ):
+            return
+
+        eta = None
+        if rate and total_bytes > done_bytes:
+            eta = round((total_bytes - done_bytes) / (rate*1000000))
+        percent = 0
+        if total_bytes:
+            percent = round(100*done_bytes/total_bytes, 2)
+        self.event("progress", phase=phase, sector=sector, sectors_per_second=round(self.sectors_per_second()), done_bytes=done_bytes,
+                   total_bytes=total_bytes, percent=percent, eta=eta)
+        if( time.time() - self.last_write >= args.metrics_interval ):
+            self.write_textfile()
+
+    def sectors_per_second(self):
+        return self.rate*1000000 / self.device.sector_size
+
+    def read_error(self, sector, size):
+        self.read_errors += 1
+        self.event("read_error", sector=sector, size=size)
+
+    def repair(self, sector, ok):
+        if ok:
+            self.repairs_ok += 1
+            self.event("repair_ok", sector=sector)
+        else:
+            self.repairs_failed += 1
+            self.event("repair_failed", sector=sector)
+
+    def finish(self, ok=True):
+        self.done = True
+        self.event("done", ok=ok, bad_sectors=self.bad_sectors, read_errors=self.read_errors, repairs_ok=self.repairs_ok,
+                   repairs_failed=self.repairs_failed, done_bytes=self.done_bytes)
+        self.write_textfile()
+        if self.events_fd != None and args.events != "-":
+            os.close(self.events_fd)
+            self.events_fd = None
+
+    def textfile(self):
+        labels = "device=\"%s\",serial=\"%s\"" % (prom_label(self.device.path), prom_label(self.device.serial))
+        lines = []
+        def metric(name, kind, help_txt, values):
+            lines.append("# HELP diskrepair9_%s %s" % (name, help_txt))
+            lines.append("# TYPE diskrepair9_%s %s" % (name, kind))
+            for extra, value in values:
+                lines.append("diskrepair9_%s{%s%s} %s" % (name, labels, extra, value))
+
+        metric("phase_info", "gauge", "The phase being worked on (read or write).", [(",phase=\"%s\"" % prom_label(self.phase), 1)])
+        metric("sector", "gauge", "The sector being worked on.", [("", self.sector)])
+        metric("sectors_per_second", "gauge", "The average rate of the phase.", [("", round(self.sectors_per_second(), 1))])
+        metric("done_bytes", "gauge", "Bytes done in the phase.", [("", self.done_bytes)])
+        metric("total_bytes", "gauge", "Bytes to do in the phase.", [("", self.total_bytes)])
+        metric("read_errors_total", "counter", "Chunk reads that failed.", [("", self.read_errors)])
+        metric("bad_sectors_total", "counter", "Bad sectors found.", [("", self.bad_sectors)])
+        metric("repairs_total", "counter", "Sectors rewritten.", [(",result=\"ok\"", self.repairs_ok), (",result=\"failed\"", self.repairs_failed)])
+        metric("done", "gauge", "1 when the device is finished.", [("", int(self.done))])
+        counts = [(",attribute=\"%s\"" % key, value) for key, value in sorted(self.health.items()) if key != "passed" and value != None]
+        if counts:
+            metric("smart_raw", "gauge", "SMART counts from the health monitor.", counts)
+        if "passed" in self.health:
+            metric("smart_passed", "gauge", "1 if the SMART overall health check passed.", [("", int(bool(self.health["passed"])))])
+
+        h = self.read_latency
+        buckets = []
+        cumulative = 0
+        for bound, count in zip(h.bounds(), h.counts):
+            cumulative += count
+            buckets.append((",le=\"%g\"" % bound, cumulative))
+        buckets.append((",le=\"+Inf\"", h.count))
+        lines.append("# HELP diskrepair9_read_latency_seconds How long each chunk read took.")
+        lines.append("# TYPE diskrepair9_read_latency_seconds histogram")
+        for extra, value in buckets:
+            lines.append("diskrepair9_read_latency_seconds_bucket{%s%s} %s" % (labels, extra, value))
+        lines.append("diskrepair9_read_latency_seconds_sum{%s} %s" % (labels, round(h.sum, 6)))
+        lines.append("diskrepair9_read_latency_seconds_count{%s} %s" % (labels, h.count))
+        return "\n".join(lines) + "\n"
+
+    # written atomically, so the collector never sees a partial file
+    def write_textfile(self):
+        if not args.textfile_dir:
+            return
+        self.last_write = time.time()
+        path = os.path.join(args.textfile_dir, "diskRepair9-%s.prom" % self.device.file_name())
+        try:
+            write_file_atomic(path, self.textfile().encode("utf-8"))
+        except OSError as e:
+            warn("%s - failed to write %s: %s" % (self.device, path, e))
+
+class Device():
+    def __init__(self, path, serial):
+        if not path:
+            raise Exception("path is required")
+        if not serial:
+            raise Exception("serial is required")
+        self.path = path
+        self.serial = serial
+        self.status_txt = None
+        # in parallel mode, this device's StatusRow in the shared status table
+        self.status_row = None
+        self.checkpoint = None
+        # how many sectors repair_sector() and fixup_python() rewrote
+        self.rewritten = 0
+        self.load_geometry()
+        self.metrics = Metrics(self)
+        # the bad, repaired and slow sectors found in this run, for --bad-out
+        self.extents = ExtentList(self.sector_size)
+        # sector -> time.monotonic() when it was last found bad or repaired, so follow_kmsg doesn't repair it again because of the kernel log records of its own reads
+        self.handled = {}
+        # (sector, seconds) of sectors that read ok, but slower than --slow-threshold
+        self.slow_sectors = []
+        self.slow_chunks = 0
+        self.coverage = None
+        # set by the HealthMonitor when the device can't be worked on anymore
+        self.health_failure = None
+        # for the bookkeeping of the --stripes threads of a scan
+        self.lock = threading.RLock()
+
+    def __str__(self):
+        return "{" + self.path + "|" + self.serial + "}"
+
+    # the serial made into a file name, for the files of this device (state dir, --bad-out, textfile metrics)
+    def file_name(self):
+        # dm serials are paths like /dev/vgname/lvname
+        return self.serial.strip("/").replace("/", "_")
+
+    # reads the size and sector sizes once, from sysfs where possible, so nothing has to look them up again while working
+    # The sectors everywhere else (--sector, the logs, the checkpoints) are logical sectors of sector_size bytes.
+    def load_geometry(self):
+        self.sector_size = 512
+        self.physical_sector_size = 512
+        self.size = None
+        self.wwid = None
+        # for get_write_strategy()
+        self.write_zeroes_max_bytes = 0
+        self.discard_max_bytes = 0
+        self.discard_zeroes_data = False
+
+        sysfs_dir = get_sysfs_block_dir(self.path)
+        if sysfs_dir:
+            queue_dir = get_sysfs_queue_dir(sysfs_dir)
+            self.sector_size = int_or_none(read_sysfs(queue_dir + "/logical_block_size")) or 512
+            self.physical_sector_size = int_or_none(read_sysfs(queue_dir + "/physical_block_size")) or self.sector_size
+            # always in 512 byte units
+            size = int_or_none(read_sysfs(sysfs_dir + "/size"))
+            if size != None:
+                self.size = size*512
+            self.wwid = read_sysfs(sysfs_dir + "/wwid") or read_sysfs(sysfs_dir + "/device/wwid")
+            self.write_zeroes_max_bytes = int_or_none(read_sysfs(queue_dir + "/write_zeroes_max_bytes")) or 0
+            self.discard_max_bytes = int_or_none(read_sysfs(queue_dir + "/discard_max_bytes")) or 0
+            self.discard_zeroes_data = read_sysfs(queue_dir + "/discard_zeroes_data") == "1"
+        if self.size == None:
+            self.size = get_file_size(self.path)
+
+        self.physical_sector_size = max(self.physical_sector_size, self.sector_size)
+        self.sectors = self.size // self.sector_size
+        # logical sectors per physical sector
+        self.physical_sectors = self.physical_sector_size // self.sector_size
+        debug("%s - sector size = %s, physical sector size = %s, size = %s, wwid = %s" % (self, self.sector_size, self.physical_sector_size, self.size, self.wwid))
+    
+    # phase is "read" or "write"
+    def print_status(self, txt, phase=None, sector=None, rate=None, done_bytes=None, total_bytes=None):
         self.status_txt = txt
 
         if parallel:
             # the controller will read status from workers and print it separately
             # and currently there is no other output... having different intervals for syslog vs stdout is more work than it's worth
-            pass
+            if sector != None:
+                self.update_status_row(phase, sector, rate, done_bytes, total_bytes)
         else:
             sameline(txt)
+        if sector != None:
+            self.metrics.progress(phase, sector, rate, done_bytes, total_bytes)
+
+    def update_status_row(self, phase, sector, rate, done_bytes, total_bytes):
+        row = self.status_row
+        if row == None:
+            return
+        row.phase = phase.encode("utf-8")
+        row.sector = int(sector)
+        row.rate = rate
+        row.done_bytes = int(done_bytes)
+        row.total_bytes = int(total_bytes)
+        row.updated = time.time()
+
+    # updates the status row at the end of a pass, since print_status is only called every target_output_interval
+    def update_status_done(self, phase, start_sector, sector, start_time, total_bytes):
+        done_bytes = (sector - start_sector)*self.sector_size
+        elapsed = time.time() - start_time
+        rate = 0
+        if elapsed > 0:
+            rate = done_bytes / elapsed / 1000000
+        self.update_status_row(phase, sector, rate, done_bytes, total_bytes)
+        self.metrics.progress(phase, sector, rate, done_bytes, total_bytes)
+
+    # counts bad sectors found, for the parallel dashboard
+    def count_bad(self, count):
+        with self.lock:
+            self.metrics.bad_sectors += count
+            if self.status_row != None:
+                self.status_row.bad += count
+
+    # raises DiskFailed if the HealthMonitor found the device gone or failing; the loops call this every chunk or sector
+    def check_health(self):
+        if self.health_failure:
+            raise DiskFailed("%s - stopping: %s" % (self, self.health_failure))
+
+    # records a bad sector in the coverage map, extents and checkpoint
+    # Every path that finds or repairs a sector (the scan, the list actions, recover) goes through here, so --resume has all of them.
+    def mark_bad(self, sector, repaired=False):
+        with self.lock:
+            self.handled[sector] = time.monotonic()
+            self.extents.add(sector, 1, "repaired" if repaired else "bad")
+            if self.coverage:
+                self.coverage.mark_bad(sector, repaired)
+            if self.checkpoint:
+                self.checkpoint.add_bad(sector)
+                if repaired:
+                    self.checkpoint.add_repaired(sector)
+
+    # records a range that was read ok in the coverage map
+    def mark_clean(self, start_sector, end_sector):
+        if self.coverage:
+            with self.lock:
+                self.coverage.mark_clean(start_sector, end_sector)
+
+    # returns a PatternWriter for zerogood/zeroall, which verifies what it writes with --verify
+    def open_writer(self, chunksize):
+        verifier = None
+        if args.verify:
+            verifier = Verifier(self, chunksize, get_pattern(chunksize, self.sector_size))
+        strategy = get_write_strategy(self)
+        info("%s - writing with write strategy %s" % (self, strategy))
+        return PatternWriter(self, chunksize, strategy, verifier)
+
+    # finds and handles the bad sectors in a chunk that failed to read in scan()
+    # bad is the SectorSet of bad sectors for zerogood
+    # writer is the PatternWriter for single pass zerogood, which writes the good sectors around the bad ones right away
+    # returns how many reads it took
+    def fixup_chunk(self, sector, count, bad, writer=None):
+        with NativeSectorIO(self, max_sectors=count) as io:
+            found, reads = locate_bad_sectors(io, self, sector, count)
+            self.count_bad(len(found))
+            info("%s - found %s bad sectors in %s sectors starting at sector %s, using %s reads" % (self, len(found), count, sector, reads))
+            for bad_sector in found:
+                with self.lock:
+                    if( action == "zerobad" ):
+                        repair_sector(io, self, bad_sector)
+                    elif( action in ["zerogood", "recover"] ):
+                        bad.add(bad_sector)
+                        self.mark_bad(bad_sector)
+
+        if writer:
+            # write the good runs between the bad sectors
+            run_start = sector
+            for bad_sector in found + [sector + count]:
+                if bad_sector > run_start:
+                    writer.write(run_start, bad_sector - run_start)
+                run_start = bad_sector + 1
+        return reads
+
+    # finds the slow sectors in a chunk that read ok in scan(), but took longer than threshold seconds, and rewrites them with --rewrite-slow
+    # returns how many reads it took
+    def check_slow_chunk(self, sector, count, elapsed, threshold):
+        with self.lock:
+            self.slow_chunks += 1
+        with NativeSectorIO(self, max_sectors=count) as io:
+            slow, reads = locate_slow_sectors(io, self, sector, count, threshold)
+            info("%s - chunk at sector %s took %.3f s to read; found %s slow sectors in it, using %s reads" % (self, sector, elapsed, len(slow), reads))
+            for slow_sector, seconds in slow:
+                with self.lock:
+                    self.slow_sectors += [(slow_sector, seconds)]
+                    self.extents.add(slow_sector, 1, "slow")
+                self.metrics.event("slow_sector", sector=slow_sector, seconds=seconds)
+                if( args.rewrite_slow and seconds != None and action in ["zerobad", "recover"] ):
+                    rewrite_slow_sector(io, self, slow_sector)
+        return reads
+
+    # prints the read latency histogram and the slow sectors found by scan()
+    def print_latency_summary(self):
+        if self.metrics.read_latency.count:
+            info("%s - chunk read latency: %s" % (self, self.metrics.read_latency))
+        if self.slow_chunks:
+            slow_txt = ", ".join(["%s (%s)" % (s, "failed" if t == None else "%.3f s" % t) for s, t in self.slow_sectors])
+            warn("%s - %s chunks were slower than %s ms; slow sectors: %s" % (self, self.slow_chunks, args.slow_threshold, slow_txt or "none found"))
 
     # broad scanning with high level IO
     # This replaces diskRepair[1-8].bash
-    def scan(self, chunksize=1024*1024, sector=0, end_sector=None):
+    # chunksize is the normal (and largest) read size; after a read error, it drops to min_chunksize, and then doubles after every grow_after clean reads
+    def scan(self, chunksize=1024*1024, sector=0, end_sector=None, min_chunksize=None, grow_after=16):
         global args
         
-        if( chunksize % sector_size != 0 ):
-            # prevent side effects of casting len(chunk)/sector_size to int later
-            raise Exception("chunksize (%s) must be a multiple of sector_size (%s)" % (chunksize, sector_size))
+        sector_size = self.sector_size
+        if( min_chunksize == None ):
+            min_chunksize = chunksize
+        for size in [chunksize, min_chunksize]:
+            if( size % self.physical_sector_size != 0 ):
+                # prevent side effects of casting len(chunk)/sector_size to int later, and reads that aren't whole physical sectors
+                raise Exception("chunksize (%s) must be a multiple of the physical sector size (%s)" % (size, self.physical_sector_size))
+        if( min_chunksize > chunksize ):
+            raise Exception("min_chunksize (%s) must not be larger than chunksize (%s)" % (min_chunksize, chunksize))
         
-        bad = []
+        bad = SectorSet()
         start_sector = sector
+        # where zerogood starts writing; when resuming, the scan starts where the checkpoint is, but the write pass still has to start at the beginning
+        write_start_sector = sector
+        if self.checkpoint:
+            bad = self.checkpoint.bad.copy()
+            write_start_sector = self.checkpoint.start_sector
+
+        # single pass zerogood writes each chunk right after it reads ok, instead of collecting all the bad sectors first and then writing in a second pass
+        singlepass = action == "zerogood" and args.zerogood_mode == "singlepass"
+        writer = None
+        status_txt = "read ok"
+        if singlepass:
+            status_txt = "read and write ok"
+            if not dry_run:
+                writer = self.open_writer(chunksize)
+                if( self.coverage and args.unverified_only ):
+                    info("%s - single pass zerogood writes every sector, so --unverified-only doesn't skip anything" % self)
         
         # Information needed for progress indicator
+        device_sectors = self.sectors
         if( end_sector == None ):
-            device_size = get_file_size(self.path)
-            x_end_sector = device_size / sector_size - 1
+            x_end_sector = device_sectors - 1
         else:
             x_end_sector = end_sector
         total_bytes = (x_end_sector - start_sector) * sector_size
@@ -564,157 +3225,279 @@ class Device():
 
         debug("%s - scanning for bad sectors..." % self)
         debug("%s - chunksize = %s, sector = %s, end_sector = %s" % (self, chunksize, sector, end_sector))
+
+        throttle = Throttle(self, args.throttle, min_chunksize, chunksize, target_util=args.target_util,
+                            latency_budget=args.latency_budget, max_rate=args.max_rate, sleep_percent=args.sleep_percent)
+        scan = ScanPass(self, chunksize, min_chunksize, grow_after, bad, writer, throttle, status_txt, start_sector, end_sector, total_bytes, start_time)
+        stripes = scan.split(sector, args.stripes, args.stripe_layout, args.stripe_size)
         
-        prev_time = None
-        last_output_time = 0
+        with (writer or contextlib.nullcontext()):
+            finished = scan.run(stripes)
+        if not finished:
+            return
         
-        with open_device_for_scan(self.path) as f:
-            if(sector != 0):
-                f.seek(sector*sector_size, 0)
-            while True:
-                try:
-                    tell = f.tell()
-                    if( tell != sector*sector_size ):
-                       # safety check, in case my math is wrong somewhere, to prevent the wrong sector from being written to
-                       # after lots of testing with different disks and situations, this can probably be removed
-                       # In this section of the code, the check is redudnant; fixup(...) does its own check before modifying anything.
-                       # This slows down the scan significantly
-                       error("%s - sector doesn't match... coding error. tell says %s which is sector %s, but sector = %s" % (self, tell, tell/sector_size, sector))
-                       return
-                    
-                    if( end_sector != None and sector >= end_sector ):
+        self.update_status_done("read", start_sector, scan.position(), start_time, total_bytes)
+        if( scan.error_count != 0 and args.locator == "bisect" ):
+            info("%s - %s failed chunks needed %s reads to locate bad sectors" % (self, scan.error_count, scan.locator_reads))
+        self.print_latency_summary()
+        debug("%s - len(bad) = %s, bad = %s" % (self, len(bad), bad))
+        
+        if( action == "zerogood" and not singlepass ):
+            if self.checkpoint:
+                self.checkpoint.next_phase("write")
+            self.zerogood(bad, chunksize=args.write_chunksize, sector=write_start_sector, end_sector=end_sector)
+        elif( action == "recover" ):
+            if self.checkpoint:
+                self.checkpoint.next_phase("recover")
+            self.recover(bad)
+        elif self.checkpoint:
+            self.checkpoint.finish()
+
+    # reads one stripe of a scan (all of it, without --stripes), range by range, and handles the chunks that fail to read
+    # returns False if it stopped early (interrupted, or the coding error check), else True
+    def scan_stripe(self, scan, stripe):
+        with open_device_for_scan(self.path, scan.chunksize) as f:
+            for range_start, range_end in stripe.ranges:
+                if not self.scan_range(scan, stripe, f, range_start, range_end):
+                    return False
+                stripe.done_sectors += range_end - range_start
+                stripe.range_done = 0
+                stripe.sector = range_end
+        stripe.finished = True
+        return True
+
+    # reads sectors range_start to range_end-1 for scan_stripe()
+    def scan_range(self, scan, stripe, f, range_start, range_end):
+        sector_size = self.sector_size
+        chunksize = scan.chunksize
+        min_chunksize = scan.min_chunksize
+        bad = scan.bad
+        writer = scan.writer
+        throttle = scan.throttle
+        read_latency = self.metrics.read_latency
+        slow_threshold = args.slow_threshold / 1000
+        # with --unverified-only, the granules that are already clean in the coverage map are skipped,
+        # unless this pass also writes (single pass zerogood), which has to cover every sector
+        coverage = self.coverage
+        unverified_only = coverage and args.unverified_only and not writer
+        sector = range_start
+        stripe.sector = sector
+        # the start of the reads since the last skip, for the coverage map
+        clean_start = sector
+        read_size = stripe.read_size
+        size = read_size
+        
+        f.seek(sector*sector_size, 0)
+        while True:
+            try:
+                if scan.stop:
+                    self.mark_clean(clean_start, sector)
+                    return False
+                self.check_health()
+                tell = f.tell()
+                if( tell != sector*sector_size ):
+                   # safety check, in case my math is wrong somewhere, to prevent the wrong sector from being written to
+                   # after lots of testing with different disks and situations, this can probably be removed
+                   # In this section of the code, the check is redudnant; fixup(...) does its own check before modifying anything.
+                   # This slows down the scan significantly
+                   error("%s - sector doesn't match... coding error. tell says %s which is sector %s, but sector = %s" % (self, tell, tell/sector_size, sector))
+                   return False
+                
+                if( sector >= range_end ):
+                    if( range_end == scan.end_sector ):
                         info("%s - hit end_sector; stopping reading" % self)
+                    break
+                if unverified_only:
+                    next_sector = coverage.next_unclean(sector)
+                    if( next_sector == None or next_sector >= range_end ):
+                        if( range_end == scan.end and sector < self.sectors ):
+                            info("%s - the rest is already clean in the coverage map; stopping reading" % self)
+                        self.mark_clean(clean_start, sector)
+                        sector = range_end
+                        clean_start = sector
                         break
-                    chunk = f.read(chunksize)
-                    if chunk:
-                        now = time.time()
-                        if( last_output_time + target_output_interval < now ):
-                            # Simple output
-                            #print_status("read ok, sector = %d" % (sector))
-                            
-                            # Output with progress indicator
-                            done_bytes=(sector-start_sector)*sector_size
-                            now_time = time.time()
-                            rate = round(done_bytes / (now_time - start_time) / 1000000, 2)
-                            self.print_status("read ok, sector = %d - %.2f MB/s - %.2f %% - %.2f GB / %.2f GB" %
-                                (sector, rate, round(100*done_bytes/total_bytes, 2), round(done_bytes/1000000000,2), round(total_bytes/1000000000,2)))
+                    if( next_sector != sector ):
+                        debug("%s - skipping clean sectors %s to %s" % (self, sector, next_sector - 1))
+                        self.mark_clean(clean_start, sector)
+                        sector = next_sector
+                        clean_start = sector
+                        f.seek(sector*sector_size, 0)
+                        continue
+                with scan.throttle_lock:
+                    size = throttle.chunksize(read_size)
+                size = min(size, (range_end - sector)*sector_size)
+                misaligned = sector % self.physical_sectors
+                if misaligned:
+                    # read up to the next physical sector, so the rest of the reads are aligned
+                    size = min(size, (self.physical_sectors - misaligned)*sector_size)
+                if unverified_only:
+                    # only read up to the next clean granule
+                    size = (coverage.next_clean(sector, size // sector_size) - sector)*sector_size
+                read_start = time.monotonic()
+                chunk = f.read(size)
+                read_time = time.monotonic() - read_start
+                with self.lock:
+                    read_latency.observe(read_time)
+                if chunk:
+                    if( slow_threshold and read_time >= slow_threshold ):
+                        self.check_slow_chunk(sector, int(len(chunk)/sector_size), read_time, slow_threshold)
+                    now = time.time()
+                    
+                    if len(chunk) != size:
+                        warn("%s - partial chunk read" % self)
+                    if writer:
+                        writer.write(sector, int(len(chunk)/sector_size))
+                    sector += int(len(chunk)/sector_size)
+                    stripe.sector = sector
+                    scan.progress(stripe, sector - range_start, now)
 
-                            last_output_time = now
-                            
-                        if len(chunk) != chunksize:
-                            warn("%s - partial chunk read" % self)
-                        sector += int(len(chunk)/sector_size)
-                        
-                        if args.sleep_percent:
-                            now = time.time()
-                            
-                            if prev_time:
-                                sleep_factor = args.sleep_percent/100
-                                sleep_time = (sleep_factor * (now - prev_time))/(1 - sleep_factor)
-                                
-                                #debug("%s - sleeping %s seconds" % (self, sleep_time))
-                                time.sleep(sleep_time)
-                            
-                            prev_time = time.time()
-                        #dump(chunk)
-                    else:
-                        info("%s - End of file" % self)
-                        break
-                except KeyboardInterrupt as e:
-                    samelinereturn()
-                    return
-                except (TypeError, NameError, ValueError, AttributeError) as e: 
-                    # TODO: add OSError in here somehow...but also handle it in the fixup except
-                    # handle this one in the fixup except:
-                    #     OSError: [Errno 5] Input/output error
-                    raise e
-                except:
-                    e = sys.exc_info()[0]
-                    debug("%s - %s" % (self, e))
-                    info("%s - read failed, sector = %s, chunksize = %s" % (self, sector, chunksize))
-                    # failed_at is greater than sector by up to chunksize minus 1; we use this to tell fixup what to fix
-                    failed_at = int( f.tell() / sector_size )
-                    debug("%s - failedat = %s" % (self, failed_at))
-                    prev_fixup_sector = None
-                    if( action == "zerobad" ):
-                        prev_fixup_sector = fixup(self, failed_at)
-                        debug("%s - prev_fixup_sector = %s" % (self, prev_fixup_sector))
-                    elif( action == "recover" ):
-                        error("%s - recover not implemented. failed_at = %s" % (self, failed_at))
-                    elif( action == "zerogood" ):
-                        bad += [sector]
+                    if( read_size < chunksize ):
+                        # errors are usually clustered, so after an error, read_size is small, and grows again after some clean reads
+                        stripe.clean_reads += 1
+                        if( stripe.clean_reads >= scan.grow_after ):
+                            read_size = min(read_size*2, chunksize)
+                            stripe.clean_reads = 0
+                    stripe.read_size = read_size
                     
-                    if prev_fixup_sector != None:
-                        sector = prev_fixup_sector+1
-                    else:
-                        sector += 1
+                    own_bytes = len(chunk)
+                    if writer:
+                        own_bytes *= 2
+                    with scan.throttle_lock:
+                        throttle.done(own_bytes)
+                    #dump(chunk)
+                else:
+                    info("%s - End of file" % self)
+                    break
+            except KeyboardInterrupt:
+                samelinereturn()
+                self.mark_clean(clean_start, sector)
+                scan.stop = True
+                return False
+            except DiskFailed as e:
+                # keep what read clean before the disk failed
+                self.mark_clean(clean_start, sector)
+                raise e
+            except (TypeError, NameError, ValueError, AttributeError) as e: 
+                # TODO: add OSError in here somehow...but also handle it in the fixup except
+                # handle this one in the fixup except:
+                #     OSError: [Errno 5] Input/output error
+                raise e
+            except:
+                e = sys.exc_info()[0]
+                debug("%s - %s" % (self, e))
+                info("%s - read failed, sector = %s, chunksize = %s" % (self, sector, size))
+                with self.lock:
+                    scan.error_count += 1
+                    self.metrics.read_error(sector, size)
+
+                if( args.locator == "bisect" ):
+                    # the failed chunk is exactly the range [sector, sector+count), so find the bad sectors in there, and continue after it
+                    count = int(size / sector_size)
+                    count = min(count, range_end - sector)
+                    with scan.windows.hold(sector, sector + count):
+                        reads = self.fixup_chunk(sector, count, bad, writer)
+                    with self.lock:
+                        scan.locator_reads += reads
+
+                    sector += count
+                    read_size = min_chunksize
+                    stripe.read_size = read_size
+                    stripe.clean_reads = 0
+                    stripe.sector = sector
+                    scan.progress(stripe, sector - range_start)
                     f.seek(sector*sector_size, 0)
+                    continue
+
+                # failed_at is greater than sector by up to chunksize minus 1; we use this to tell fixup what to fix
+                failed_at = int( f.tell() / sector_size )
+                debug("%s - failedat = %s" % (self, failed_at))
+                prev_fixup_sector = None
+                if( action == "zerobad" ):
+                    # fixup() checks fuzzy_after sectors past the error, so it can go into the next stripe's range
+                    with scan.windows.hold(failed_at, failed_at + scan.fuzzy_after + 1):
+                        prev_fixup_sector = fixup(self, failed_at, fuzzy_after=scan.fuzzy_after)
+                    debug("%s - prev_fixup_sector = %s" % (self, prev_fixup_sector))
+                elif( action in ["zerogood", "recover"] ):
+                    with self.lock:
+                        bad.add(sector)
+                        self.mark_bad(sector)
+                
+                if prev_fixup_sector != None:
+                    sector = prev_fixup_sector+1
+                else:
+                    sector += 1
+                sector = min(sector, range_end)
+                stripe.sector = sector
+                f.seek(sector*sector_size, 0)
         
-        debug("%s - len(bad) = %s, bad = %s" % (self, len(bad), bad))
-        
-        #TODO: instead of handling all bad at the end, handle as they are discovered, so interrupting doesn't mean you have to start over
-        if( action == "zerogood" ):
-            self.zerogood(bad, chunksize=chunksize, sector=start_sector, end_sector=end_sector)
+        self.mark_clean(clean_start, sector)
+        return True
+
+    # salvages the bad sectors found by scan() with a Recovery
+    # bad is a SectorSet; when resuming, the sectors the checkpoint says were already repaired are skipped
+    def recover(self, bad):
+        sectors = list(bad)
+        if self.checkpoint:
+            sectors = [s for s in sectors if s not in self.checkpoint.repaired]
+        if sectors:
+            Recovery(self, tries=args.recover_tries, budget=args.recover_budget, jobs=args.recover_jobs).run(sectors)
+        if self.checkpoint:
+            self.checkpoint.finish()
 
 
     # This replaces something that isn't in other files in the bc-it-admin repo
+    # bad is a SectorSet (or list) of sectors to skip
     def zerogood(self, bad, chunksize=1024*1024, sector=0, end_sector=None):
         start_sector = sector
+        sector_size = self.sector_size
         
         # Information needed for progress indicator
+        device_sectors = self.sectors
         if( end_sector == None ):
-            device_size = get_file_size(self.path)
-            x_end_sector = device_size / sector_size
+            x_end_sector = device_sectors
+            stop_sector = device_sectors
         else:
             x_end_sector = end_sector
+            stop_sector = min(end_sector, device_sectors)
         total_bytes = (x_end_sector - start_sector) * sector_size
         start_time = time.time()
         last_output_time = 0
         
-        data = None
-        if not args.random:
-            data = get_zeros(chunksize)
-            data_size = int(len(data)/sector_size)
+        if not isinstance(bad, SectorSet):
+            bad = SectorSet(bad)
+
         debug("%s - zeroing good sectors..." % (self))
-        debug("%s - list of bad sectors to skip = %s" % (self, bad))
-        chunksize_sectors = chunksize/sector_size
-        with open(self.path, "wb") as f:
-            if(sector != 0):
-                f.seek(sector*sector_size, 0)
+        debug("%s - number of bad sectors to skip = %s" % (self, len(bad)))
+        with self.open_writer(chunksize) as f:
+            chunksize_sectors = f.max_sectors()
             while True:
-                if args.random:
-                    data = get_random_data(chunksize)
-                    data_size = int(len(data)/sector_size)
                 try:
-                    if( end_sector != None and sector >= end_sector ):
-                        info("%s - hit end_sector; stopping writing" % self)
+                    self.check_health()
+                    if( sector >= stop_sector ):
+                        if( end_sector != None and sector >= end_sector ):
+                            info("%s - hit end_sector; stopping writing" % self)
+                        if self.checkpoint:
+                            self.checkpoint.finish()
+                        self.update_status_done("write", start_sector, sector, start_time, total_bytes)
                         break
-                    # if this write would overwrite a bad sector, skip to the point after the bad sector
-                    if( len(bad) != 0 and sector + int(chunksize_sectors) > bad[0] ):
-                        breakagain=0
-                        while( sector + data_size > bad[0] ):
+
+                    count = min(chunksize_sectors, stop_sector - sector)
+                    misaligned = sector % self.physical_sectors
+                    if misaligned:
+                        # (eg. after a bad sector) only write up to the next physical sector, so the rest of the writes are aligned
+                        count = min(count, self.physical_sectors - misaligned)
+
+                    # if this write would overwrite a bad sector, only write up to the bad sector, and then skip it
+                    next_bad = bad.next(sector)
+                    if( next_bad != None and next_bad < sector + count ):
+                        if( next_bad == sector ):
                             debug("%s - while zeroing, skipped sector %s" % (self, sector))
-                            
-                            sector = bad[0]+1
-                            bad.remove(bad[0])
-                            debug("%s - len(bad) = %s, bad = %s" % (self, len(bad), bad))
-                            if( len(bad) == 0 ):
-                                breakagain=1
-                                break
-                        if( breakagain == 1 ):
-                            # This is because python is silly and doesn't support named blocks
-                            break
-                            
-                        f.seek(sector*sector_size, 0)
+                            sector += 1
+                            continue
+                        count = next_bad - sector
+
                     if( not dry_run ):
-                        #if( f.tell() != sector*sector_size ):
-                        #    # safety check, in case my math is wrong somewhere, to prevent the wrong sector from being written to
-                        #    # after lots of testing with different disks and situations, this can probably be removed
-                        #    error("%s - sector doesn't match... coding error. tell says %s, but sector = %s" % (self, f.tell(), sector))
-                        #    # This slows down the scan significantly (calling f.tell() I think)
-                        #    return
-                        
-                        f.write(data)
+                        f.write(sector, count)
                         now = time.time()
                         if( last_output_time + target_output_interval < now ):
                             # Simple output
@@ -726,31 +3509,34 @@ class Device():
                             rate = round(done_bytes / (now_time - start_time) / 1000000, 2)
                             self.print_status(
                                 "write ok, sector = %d - %.2f MB/s - %.2f %% - %.2f GB / %.2f GB" % 
-                                (sector, rate, round(100*done_bytes/total_bytes, 2), round(done_bytes/1000000000,2), round(total_bytes/1000000000,2))
+                                (sector, rate, round(100*done_bytes/total_bytes, 2), round(done_bytes/1000000000,2), round(total_bytes/1000000000,2)),
+                                "write", sector, rate, done_bytes, total_bytes
                             )
                             
                             last_output_time = now
-                        sector += data_size
+                        sector += count
+                        if self.checkpoint:
+                            self.checkpoint.update(sector, now)
                     else:
-                        info("%s - DRY RUN - skipping zeroing of sector %s + chunksize %s" % (self, sector, chunksize))
-                        sector += data_size
+                        info("%s - DRY RUN - skipping zeroing of sector %s + %s sectors" % (self, sector, count))
+                        sector += count
                 except KeyboardInterrupt as e:
                     samelinereturn()
                     return
                 except OSError as e:
-                    if( "No space left on device" in str(e) ):
+                    if( e.errno == errno.ENOSPC ):
+                        # the end of the device
+                        if self.checkpoint:
+                            self.checkpoint.finish()
+                        self.update_status_done("write", start_sector, sector, start_time, total_bytes)
                         return
-                    raise e
-                except:
-                    e = sys.exc_info()[0]
                     if( action == "zeroall" ):
                         # unexpected error... but continue and zero anyway; it's not an error unless fixup fails too
                         warn("%s - write failed, sector = %s, chunksize = %s" % (self, sector, chunksize))
                         fixup(self, sector)
                         sector += 1
-                        f.seek(sector*sector_size, 0)
                     else:
-                        # if not zeroall, it is an error to fail here; we are supposed to skip bad sectorsm
+                        # if not zeroall, it is an error to fail here; we are supposed to skip bad sectors
                         raise e
 
     def zeroall(self, chunksize=1024*1024, sector=0, end_sector=None):
@@ -758,34 +3544,30 @@ class Device():
 
     # This replaces diskRepairDmesg.bash (Linux only probably)
     def list_sectors_dmesg(self, bad_sectors):
-        debug("%s - checking with dmesg" % (self))
-        p1 = subprocess.Popen(["dmesg"], stdout=subprocess.PIPE)
-        p2 = subprocess.Popen(["grep", "-Eo", "dev sd[a-z]+, sector [0-9]+"], stdin=p1.stdout, stdout=subprocess.PIPE)
-        p3 = subprocess.Popen(["awk", "{print $2 $NF}"], stdin=p2.stdout, stdout=subprocess.PIPE)
-        p4 = subprocess.Popen(["sort", "-u"], stdin=p3.stdout, stdout=subprocess.PIPE)
-        p4.wait()
-        
-        if( p4.returncode != 0 ):
-            error("%s - Failed to get sector list from dmesg" % (self))
+        debug("%s - checking the kernel log" % (self))
+        for sector in get_kernel_log().get(self):
+            if sector not in bad_sectors:
+                info("%s - kernel log; sector = %s" % (self, sector))
+                bad_sectors.add(sector)
+            else:
+                debug("%s - kernel log; sector = %s (skipped)" % (self, sector))
+
+    # uses the smartctl --json results collected for all devices, and the text parsers below if that failed
+    def list_sectors_smartctl(self, bad_sectors):
+        if smart_sectors is None:
+            collect_smart_sectors([self])
+        sectors = smart_sectors.get(self.path)
+        if sectors is None:
+            self.list_sectors_smartctl_selftest(bad_sectors)
+            self.list_sectors_smartctl_error(bad_sectors)
             return
         
-        stdoutdata, stderrdata = p4.communicate()
-        lines = stdoutdata.decode("utf-8").splitlines()
-        
-        for line in lines:
-            loggeddevice, sector = line.split(",")
-            loggeddevice = "/dev/%s" % loggeddevice
-            
-            if( loggeddevice != self.path ):
-                # Only handle the device given on CLI
-                continue
-            
-            value_int = int_or_none(sector)
-            if value_int != None and value_int not in bad_sectors:
-                info("%s - dmesg; device = %s, sector = %s" % (self, loggeddevice, sector))
-                bad_sectors += [value_int]
+        for sector in sectors:
+            if sector not in bad_sectors:
+                info("%s - smartctl; sector = %s" % (self, sector))
+                bad_sectors.add(sector)
             else:
-                debug("%s - dmesg; sector = %s" % (self, sector))
+                debug("%s - smartctl; sector = %s (skipped)" % (self, sector))
 
     def list_sectors_smartctl_selftest(self, bad_sectors):
         cmd = ["smartctl", "-l", "selftest", self.path]
@@ -813,7 +3595,7 @@ class Device():
                     value_int = int_or_none(value)
                     if value_int != None and value_int not in bad_sectors:
                         info("%s - smartctl selftest; sector = %s" % (self, value_int))
-                        bad_sectors += [value_int]
+                        bad_sectors.add(value_int)
                     else:
                         debug("%s - smartctl selftest; sector = %s (skipped)" % (self, value_int))
 
@@ -846,16 +3628,338 @@ class Device():
                 value_int = int_or_none(value)
                 if value_int != None and value_int not in bad_sectors:
                     info("%s - smartctl error; sector = %s" % (self, value_int))
-                    bad_sectors += [value_int]
+                    bad_sectors.add(value_int)
                 else:
                     debug("%s - smartctl error; sector = %s (skipped)" % (self, value_int))
 
     # scans specific sector list
     # intended to be used with list_sectors_X() functions to generate lists
     def scan_list(self, bad_sectors):
-        for sector in bad_sectors:    
-            info("%s - sector = %s" % (self, sector))
-            fixup(self, sector)
+        scheduler = RepairScheduler(self)
+        for sector in bad_sectors:
+            if( sector >= self.sectors ):
+                # a stale log line or --bad-in file, or one for another device
+                warn("%s - sector %s is past the end of the device (%s sectors); skipping it" % (self, sector, self.sectors))
+                continue
+            scheduler.add(sector)
+        scheduler.run()
+        if self.checkpoint:
+            self.checkpoint.finish()
+
+# repairs a list of sectors (eg. from the kernel log) with as few reads and seeks as possible
+# Each sector gets the same window as fixup(), fuzzy_after sectors after it. Windows that overlap or touch are merged into one extent, and the extents are done in ascending order, so the disk only seeks forward. fixup() goes past the end of an extent when it finds more bad sectors, so the next extents skip what it already read, and nothing is read twice.
+class RepairScheduler():
+    def __init__(self, device, fuzzy_after=300):
+        self.device = device
+        self.fuzzy_after = fuzzy_after
+        self.sectors = SectorSet()
+        # the first sector that wasn't read yet, after the last extent
+        self.next_sector = 0
+        self.extents_done = 0
+        self.verified = 0
+
+    def add(self, sector):
+        self.sectors.add(int(sector))
+
+    # returns the merged windows as a list of (first sector, last sector)
+    def extents(self):
+        ret = []
+        for sector in self.sectors:
+            end = sector + self.fuzzy_after
+            if ret and sector <= ret[-1][1] + 1:
+                ret[-1] = (ret[-1][0], max(ret[-1][1], end))
+            else:
+                ret += [(sector, end)]
+        return ret
+
+    def run(self):
+        device = self.device
+        rewritten = device.rewritten
+        extents = self.extents()
+        checkpoint = device.checkpoint
+        if checkpoint:
+            # when resuming, everything before the checkpoint's sector was already done
+            self.next_sector = max(self.next_sector, checkpoint.sector)
+        for start, end in extents:
+            device.check_health()
+            start = max(start, self.next_sector)
+            if start > end:
+                debug("%s - extent ending at %s was already read" % (device, end))
+                continue
+            info("%s - sectors = %s-%s" % (device, start, end))
+            last = fixup(device, start, fuzzy_after=end-start)
+            self.extents_done += 1
+            if last is not None:
+                self.verified += last - start + 1
+                self.next_sector = last + 1
+                if checkpoint:
+                    checkpoint.update(self.next_sector)
+
+        # without merging, every sector would be read with its whole window
+        unmerged = len(self.sectors) * (self.fuzzy_after + 1)
+        info("%s - %s sectors in the list made %s extents; processed %s extents, verified %s sectors (%s without merging), rewrote %s sectors" % (device, len(self.sectors), len(extents), self.extents_done, self.verified, unmerged, device.rewritten - rewritten))
+
+# the --stripes of a scan, that each get a worker thread (or without --stripes, the one stripe that is the whole range)
+# A stripe reads its ranges in order. The reads release the GIL, so several stripes reading at once is faster on devices that are really several disks (RAID, dm, LVM, RBD). The bad sector bookkeeping is done under the device's lock, and fixups under FixupWindows, so two stripes never repair the same sectors at once.
+class ScanStripe():
+    def __init__(self, index, ranges, sector, read_size):
+        self.index = index
+        # iterable of (start, end) sector ranges, end exclusive
+        self.ranges = ranges
+        # the sector the stripe is at; everything in the stripe before it is done
+        self.sector = sector
+        self.finished = sector == None
+        # sectors done in the finished ranges, and in the current one
+        self.done_sectors = 0
+        self.range_done = 0
+        # the read size and clean reads since the last error, for growing the read size again after errors
+        self.read_size = read_size
+        self.clean_reads = 0
+
+# yields the ranges of stripe index of count, where the range start to end is split into blocks of unit sectors, dealt out to the stripes in turn
+def interleaved_ranges(start, end, unit, index, count):
+    block_start = start + index*unit
+    while block_start < end:
+        yield (block_start, min(block_start + unit, end))
+        block_start += count*unit
+
+# the sector ranges being fixed up by the stripes of a scan
+# fixup() reads fuzzy_after sectors past the error, which can be in the next stripe's range, so a stripe waits until no other stripe is fixing up a window that overlaps its own.
+class FixupWindows():
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.held = []
+
+    @contextlib.contextmanager
+    def hold(self, start, end):
+        with self.condition:
+            while any(s < end and start < e for s, e in self.held):
+                self.condition.wait()
+            self.held.append((start, end))
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.held.remove((start, end))
+                self.condition.notify_all()
+
+# what the stripes of one scan share: the settings, the bad sectors, the writer and throttle, and the merged progress
+class ScanPass():
+    # for the linear locator, how far fixup() checks past an error
+    fuzzy_after = 300
+
+    def __init__(self, device, chunksize, min_chunksize, grow_after, bad, writer, throttle, status_txt, start_sector, end_sector, total_bytes, start_time):
+        self.device = device
+        self.chunksize = chunksize
+        self.min_chunksize = min_chunksize
+        self.grow_after = grow_after
+        self.bad = bad
+        self.writer = writer
+        self.throttle = throttle
+        self.throttle_lock = threading.Lock()
+        self.status_txt = status_txt
+        self.start_sector = start_sector
+        # end_sector is the one given (or None), and end is where the scan really stops
+        self.end_sector = end_sector
+        self.end = min(end_sector, device.sectors) if end_sector != None else device.sectors
+        self.total_bytes = total_bytes
+        self.start_time = start_time
+        self.last_output_time = 0
+        self.windows = FixupWindows()
+        self.stripes = []
+        # set to make every stripe stop, after an interrupt or an error in one of them
+        self.stop = False
+        self.error_count = 0
+        self.locator_reads = 0
+
+    # returns the ScanStripes for the range from sector to the end
+    # contiguous gives each stripe one piece of the range; interleaved deals out blocks of stripe_size bytes in turn, so all the stripes move along the device together, and the checkpoint (which is where the slowest stripe is) stays close to the real progress
+    def split(self, sector, count, layout="interleaved", stripe_size=64*1024*1024):
+        device = self.device
+        chunk_sectors = self.chunksize // device.sector_size
+        end = self.end
+        if( count <= 1 or end - sector <= chunk_sectors ):
+            return [ScanStripe(0, [(sector, end)], sector, self.chunksize)]
+
+        stripes = []
+        if( layout == "contiguous" ):
+            # whole chunks, so the reads stay aligned
+            per_stripe = (end - sector + count - 1) // count
+            per_stripe = (per_stripe + chunk_sectors - 1) // chunk_sectors * chunk_sectors
+            for start in range(sector, end, per_stripe):
+                stripes += [ScanStripe(len(stripes), [(start, min(start + per_stripe, end))], start, self.chunksize)]
+        else:
+            unit = max(chunk_sectors, stripe_size // device.sector_size // chunk_sectors * chunk_sectors)
+            for index in range(0, count):
+                start = sector + index*unit
+                if start >= end:
+                    break
+                stripes += [ScanStripe(index, interleaved_ranges(sector, end, unit, index, count), start, self.chunksize)]
+        return stripes
+
+    # runs the stripes, in threads if there is more than one
+    # returns False if the scan stopped early, else True
+    def run(self, stripes):
+        device = self.device
+        self.stripes = stripes
+        if len(stripes) == 1:
+            return device.scan_stripe(self, stripes[0])
+
+        import concurrent.futures
+        info("%s - scanning sectors %s to %s with %s stripes" % (device, stripes[0].sector, self.end - 1, len(stripes)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(stripes)) as executor:
+            futures = [executor.submit(device.scan_stripe, self, stripe) for stripe in stripes]
+            try:
+                concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            except KeyboardInterrupt:
+                samelinereturn()
+                self.stop = True
+            if any(future.done() and future.exception() for future in futures):
+                # the others stop after their current chunk
+                self.stop = True
+        # raises the exception of a failed stripe here, like a failed disk
+        results = [future.result() for future in futures]
+        return all(results) and not self.stop
+
+    # where the scan is; everything before this sector is done
+    def position(self):
+        unfinished = [stripe.sector for stripe in self.stripes if not stripe.finished]
+        if unfinished:
+            return min(unfinished)
+        return max(stripe.sector for stripe in self.stripes)
+
+    def done_sectors(self):
+        return sum(stripe.done_sectors + stripe.range_done for stripe in self.stripes)
+
+    # called by a stripe after each chunk, with how far it is into its current range; prints the merged status and saves the checkpoint
+    def progress(self, stripe, range_done, now=None):
+        device = self.device
+        if now == None:
+            now = time.time()
+        with device.lock:
+            stripe.range_done = range_done
+            position = self.position()
+            if( self.last_output_time + target_output_interval < now ):
+                # Output with progress indicator
+                done_bytes = self.done_sectors()*device.sector_size
+                rate = round(done_bytes / (now - self.start_time) / 1000000, 2)
+                total_bytes = self.total_bytes
+                device.print_status("%s, sector = %d - %.2f MB/s - %.2f %% - %.2f GB / %.2f GB" %
+                    (self.status_txt, position, rate, round(100*done_bytes/total_bytes, 2), round(done_bytes/1000000000,2), round(total_bytes/1000000000,2)),
+                    "read", position, rate, done_bytes, total_bytes)
+                self.last_output_time = now
+            if device.checkpoint:
+                device.checkpoint.update(position, now)
+
+################################################################################
+# benchmarks
+################################################################################
+
+# reads count sectors one at a time with each sector engine, and reports sectors per second
+# This only reads, so it is safe on a disk with data; use a loop device to compare the engines without a real disk's seek times
+def benchmark_fixup(device, sector, count):
+    count = max(0, min(count, device.sectors - sector))
+
+    engines = [lambda: NativeSectorIO(device)]
+    if found_hdparm:
+        engines += [lambda: HdparmSectorIO(device)]
+    else:
+        warn("%s - hdparm not found; only benchmarking the native engine" % (device))
+
+    for engine in engines:
+        results = {}
+        start_time = time.time()
+        with engine() as io:
+            for n in range(0, count):
+                result = io.read_sector(sector + n)
+                results[result.code] = results.get(result.code, 0) + 1
+            name = io.name
+        elapsed = time.time() - start_time
+        info("%s - benchmark fixup %s: %s sectors in %.2f s = %.2f sectors/s, result codes = %s" % 
+             (device, name, count, elapsed, count / elapsed, results))
+
+# returns the resident memory of this process in bytes (Linux only), or None
+def get_rss():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return None
+
+# drops the page cache for a range of the device, so each backend has to read from the disk
+def drop_cache(path, offset, length):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+# reads length bytes with each scan backend, and reports MB/s and memory use
+# The memory is measured twice: the change in resident memory during the timed run (which includes the page cache mapped by mmap), and the peak python heap use during a short extra run with tracemalloc (which is too slow to use while timing).
+def benchmark_backends(device, sector, length, chunksize=1024*1024):
+    import tracemalloc
+
+    sector_size = device.sector_size
+    length = max(0, min(length, device.size - sector*sector_size))
+    length = int(length / chunksize) * chunksize
+    chunks = int(length / chunksize)
+
+    backends = [("buffered", 1), ("mmap", 1), ("direct", 1)]
+    if args.queue_depth > 1:
+        backends += [("direct", args.queue_depth)]
+
+    for backend, queue_depth in backends:
+        drop_cache(device.path, sector*sector_size, length)
+        start_time = time.time()
+        with open_device_for_scan(device.path, chunksize, backend=backend, queue_depth=queue_depth) as f:
+            rss_before = get_rss()
+            f.seek(sector*sector_size, 0)
+            for n in range(0, chunks):
+                f.read(chunksize)
+            rss_after = get_rss()
+        elapsed = time.time() - start_time
+
+        drop_cache(device.path, sector*sector_size, length)
+        tracemalloc.start()
+        with open_device_for_scan(device.path, chunksize, backend=backend, queue_depth=queue_depth) as f:
+            f.seek(sector*sector_size, 0)
+            for n in range(0, min(chunks, 64)):
+                f.read(chunksize)
+            current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        rss_txt = "unknown"
+        if rss_before != None and rss_after != None:
+            rss_txt = "%.2f MB" % ((rss_after - rss_before)/1000000)
+        if queue_depth > 1:
+            backend = "%s queue depth %s" % (backend, queue_depth)
+        info("%s - benchmark backend %s: %.2f GB in %.2f s = %.2f MB/s, resident memory growth = %s, peak python heap = %.2f MB" % 
+             (device, backend, length/1000000000, elapsed, length/elapsed/1000000, rss_txt, peak/1000000))
+
+# makes length bytes of random data with each generator, and reports MB/s
+def benchmark_random(device, length, chunksize=1024*1024):
+    chunks = max(1, int(length / chunksize))
+    chunksize_sectors = int(chunksize / device.sector_size)
+    generators = [
+        ("os.urandom", lambda n: os.urandom(chunksize)),
+        ("random.getrandbits", lambda n: get_random_data(chunksize)),
+        ("RandomPattern", lambda n, pattern=RandomPattern(chunksize, random_seed, device.sector_size): pattern.get(n*chunksize_sectors, chunksize_sectors)),
+    ]
+    for name, generator in generators:
+        start_time = time.time()
+        for n in range(0, chunks):
+            generator(n)
+        elapsed = time.time() - start_time
+        info("%s - benchmark random %s: %.2f GB in %.2f s = %.2f MB/s" % 
+             (device, name, chunks*chunksize/1000000000, elapsed, chunks*chunksize/elapsed/1000000))
+
+def benchmark(device):
+    benchmark_fixup(device, sector, args.benchmark_sectors)
+    benchmark_backends(device, sector, args.benchmark_bytes, args.chunksize)
+    benchmark_random(device, args.benchmark_bytes, args.chunksize)
 
 def run(device):
     debug("%s - working on device" % device)
@@ -864,41 +3968,275 @@ def run(device):
     elif( os.path.isfile(device.path) or os.path.isdir(device.path) ):
         raise Exception("File is not a device: %s" % device.path)
 
-    if( action in ["zerobaddmesg", "zerobadsmartctl", "quick"] ):
-        bad_sectors = []
+    device.metrics.start()
+    ok = False
+    monitor = None
+    try:
+        monitor = start_health_monitor(device)
+        run_action(device)
+        ok = True
+    finally:
+        if monitor:
+            monitor.stop()
+        device.metrics.finish(ok)
+        if args.bad_out:
+            save_bad_out(device)
+
+# opens the device's coverage map for the length of a with block, and prints what it knows at the end
+@contextlib.contextmanager
+def coverage_context(device):
+    device.coverage = open_coverage(device)
+    try:
+        yield device.coverage
+    finally:
+        if device.coverage:
+            info("%s - coverage map: %s" % (device, device.coverage.summary()))
+            device.coverage.close()
+            device.coverage = None
+
+# opens the device's checkpoint (see open_checkpoint) and adds what it already has to the device's extents
+# returns the Checkpoint or None; when it says it's done, there is nothing left to do
+def resume_checkpoint(device, start_sector, stop_sector):
+    checkpoint = open_checkpoint(device, start_sector, stop_sector)
+    device.checkpoint = checkpoint
+    if checkpoint:
+        if( checkpoint.start_sector != start_sector or checkpoint.end_sector != stop_sector ):
+            warn("%s - checkpoint %s is for sectors %s to %s, not %s to %s; resuming with the checkpoint's range" %
+                 (device, checkpoint.path, checkpoint.start_sector, checkpoint.end_sector, start_sector, stop_sector))
+        # so --bad-out has what was found before the interruption too
+        for bad_sector in checkpoint.bad:
+            device.extents.add(bad_sector, 1, "bad")
+        for repaired_sector in checkpoint.repaired:
+            device.extents.add(repaired_sector, 1, "repaired")
+        if checkpoint.done:
+            info("%s - checkpoint %s says this is already done" % (device, checkpoint.path))
+    return checkpoint
+
+# does the action on one device; run() wraps this with the start and done metrics
+def run_action(device):
+    if( action in ["zerobaddmesg", "zerobadsmartctl", "quick", "zerobadlist"] ):
+        checkpoint = resume_checkpoint(device, 0, None)
+        if( checkpoint and checkpoint.done ):
+            return
+        bad_sectors = SectorSet()
         
         if( action in ["zerobaddmesg", "quick"] ):
             device.list_sectors_dmesg(bad_sectors)
         if( action in ["zerobadsmartctl", "quick"] ):
-            device.list_sectors_smartctl_selftest(bad_sectors)
-            device.list_sectors_smartctl_error(bad_sectors)
-            
-        bad_sectors = sorted(bad_sectors)
-        device.scan_list(bad_sectors)
-    elif( action == "zerobad" or action == "zerogood" or action == "recover" ):
-        device.scan(sector=sector, end_sector=end_sector)
-    elif( action == "zeroall" ):
-        device.zeroall(sector=sector, end_sector=end_sector)
+            device.list_sectors_smartctl(bad_sectors)
+        if args.bad_in or args.bad_exclude:
+            # the sectors from the logs and --bad-in, minus --bad-exclude
+            extents = ExtentList(device.sector_size)
+            for bad_sector in bad_sectors:
+                extents.add(bad_sector)
+            bad_sectors = SectorSet(load_bad_in(device, extents).sectors("bad"))
+
+        try:
+            with coverage_context(device):
+                device.scan_list(bad_sectors)
+        finally:
+            if checkpoint and not checkpoint.done:
+                checkpoint.save()
+    elif( action in ["zerobad", "zerogood", "recover", "zeroall"] ):
+        start_sector = sector
+        stop_sector = end_sector
+        phase = "scan"
 
-def init_threading():
-    import threading
+        checkpoint = resume_checkpoint(device, start_sector, stop_sector)
+        if checkpoint:
+            if checkpoint.done:
+                return
+            start_sector = checkpoint.sector
+            stop_sector = checkpoint.end_sector
+            phase = checkpoint.phase
+
+        try:
+            with coverage_context(device):
+                if( action == "zeroall" ):
+                    device.zeroall(chunksize=args.write_chunksize, sector=start_sector, end_sector=stop_sector)
+                elif( phase == "write" ):
+                    device.zerogood(checkpoint.bad.copy(), chunksize=args.write_chunksize, sector=start_sector, end_sector=stop_sector)
+                elif( phase == "recover" ):
+                    device.recover(checkpoint.bad.copy())
+                else:
+                    device.scan(chunksize=args.chunksize, sector=start_sector, end_sector=stop_sector, min_chunksize=args.min_chunksize, grow_after=args.grow_after)
+        finally:
+            # save on interrupt or crash too; the checkpoint only has progress that is really done
+            if checkpoint and not checkpoint.done:
+                checkpoint.save()
+    elif( action == "benchmark" ):
+        benchmark(device)
+
+################################################################################
+# parallel mode
+################################################################################
+
+# worker states in the status table
+state_waiting = 0
+state_running = 1
+state_done = 2
+state_failed = 3
+state_names = ["waiting", "running", "done", "failed"]
+
+def init_multiprocessing():
+    import multiprocessing
+    import ctypes
     
-    global Worker
+    global Worker, StatusRow, mp_context
+
+    # fork, so the workers get the globals set up by the CLI handling
+    mp_context = multiprocessing.get_context("fork")
 
-    class Worker(threading.Thread) :
-        def __init__(self, device):
+    # one row per device in the shared memory status table; each row is only written by its own worker, and read by the controller
+    class StatusRow(ctypes.Structure):
+        _fields_ = [
+            ("state", ctypes.c_int),
+            ("phase", ctypes.c_char*8),
+            ("sector", ctypes.c_uint64),
+            ("rate", ctypes.c_double),
+            ("done_bytes", ctypes.c_uint64),
+            ("total_bytes", ctypes.c_uint64),
+            ("bad", ctypes.c_uint64),
+            ("updated", ctypes.c_double),
+        ]
+
+    # one process per device, so the devices don't compete for the GIL
+    class Worker(mp_context.Process):
+        def __init__(self, device, status_row, queue):
             super(Worker, self).__init__()
             self.device = device
-            
-            self.started = False
-            self.done = False
+            self.status_row = status_row
+            self.queue = queue
 
         def run(self):
+            global output_queue
+            output_queue = self.queue
+            self.device.status_row = self.status_row
+            self.status_row.state = state_running
             try:
-                self.started = True
                 run(self.device)
-            finally:
-                self.done = True
+                self.status_row.state = state_done
+            except DiskFailed as e:
+                self.status_row.state = state_failed
+                error(str(e))
+            except (Exception, SystemExit):
+                self.status_row.state = state_failed
+                import traceback
+                error("%s - %s" % (self.device, traceback.format_exc()))
+            except KeyboardInterrupt:
+                self.status_row.state = state_failed
+
+# returns a shared memory array with a StatusRow for each of count devices
+def make_status_table(count):
+    import multiprocessing.sharedctypes
+    return multiprocessing.sharedctypes.RawArray(StatusRow, count)
+
+# prints the status of all the workers as a block of lines, one per device and a total
+# On a terminal, the block is redrawn in place, and output from the workers is printed above it. Otherwise (eg. a log file) the block is only printed every 60 refreshes.
+class Dashboard():
+    def __init__(self, devices, status_table):
+        self.devices = devices
+        self.status_table = status_table
+        self.tty = sys.stdout.isatty()
+        self.lines_drawn = 0
+        self.renders = 0
+
+    # erases the block, so other output can be printed where it was
+    def erase(self):
+        if self.lines_drawn:
+            # move to the start of the first line of the block, and clear to the end of the screen
+            sys.stdout.write("\x1b[%dF\x1b[J" % self.lines_drawn)
+            self.lines_drawn = 0
+
+    def print_message(self, txt):
+        self.erase()
+        print(txt)
+
+    # returns the total MB/s of all running workers
+    def total_rate(self):
+        total = 0
+        for row in self.status_table:
+            if row.state == state_running:
+                total += row.rate
+        return total
+
+    def lines(self):
+        lines = []
+        counts = [0, 0, 0, 0]
+        total_bad = 0
+        for device, row in zip(self.devices, self.status_table):
+            counts[row.state] += 1
+            total_bad += row.bad
+            percent = 0
+            if row.total_bytes:
+                percent = 100*row.done_bytes/row.total_bytes
+            lines += ["%s %-7s %-5s sector = %d - %.2f MB/s - %.2f %% - %.2f GB / %.2f GB - %d bad" %
+                (device, state_names[row.state], row.phase.decode("utf-8"), row.sector, row.rate, percent, row.done_bytes/1000000000, row.total_bytes/1000000000, row.bad)]
+        lines += ["total: %d running, %d done, %d failed - %.2f MB/s - %d bad" %
+            (counts[state_running], counts[state_done], counts[state_failed], self.total_rate(), total_bad)]
+        return lines
+
+    def render(self, force=False):
+        self.renders += 1
+        if not self.tty and not force and self.renders % 60 != 1:
+            return
+        lines = self.lines()
+        self.erase()
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+        if self.tty:
+            self.lines_drawn = len(lines)
+
+# runs one Worker process per device, and shows their status until they are all done
+def run_parallel(devices):
+    import queue as queue_module
+
+    status_table = make_status_table(len(devices))
+    queue = mp_context.Queue()
+    dashboard = Dashboard(devices, status_table)
+
+    workers = []
+    for n in range(0, len(devices)):
+        worker = Worker(devices[n], status_table[n], queue)
+        workers += [worker]
+        worker.start()
+
+    try:
+        while True:
+            next_render = time.time() + args.refresh
+            # print output from the workers as it comes, until it's time to render again
+            while True:
+                timeout = next_render - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    dashboard.print_message(queue.get(timeout=timeout))
+                except queue_module.Empty:
+                    break
+            dashboard.render()
+
+            alive = 0
+            for w in workers:
+                if w.is_alive():
+                    alive += 1
+            if alive == 0:
+                break
+    except KeyboardInterrupt:
+        # the workers got the interrupt too, and save their checkpoints before exiting
+        pass
+
+    for w in workers:
+        w.join()
+    # output sent just before the workers exited
+    while True:
+        try:
+            dashboard.print_message(queue.get(timeout=0.1))
+        except queue_module.Empty:
+            break
+    dashboard.render(force=True)
+
+    # returns how many workers failed
+    return len([row for row in status_table if row.state == state_failed])
 
 ################################################################################
 # Main - CLI Handling
@@ -907,7 +4245,7 @@ def init_threading():
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Repair a disk's bad sectors.")
     parser.add_argument('devices', metavar='devices', type=str, nargs='+',
-                    help='device(s) to repair (path to device, or (linux only) the serial number, or for action zerobaddmesg "all" selects all found')
+                    help='device(s) to repair (path to device, or (linux only) the serial number or wwn, or a selector like model=ST3000*, transport=sata, rotational or !rotational, with commas for "and", like transport=sata,rotational; for action zerobaddmesg "all" selects all disks found (not loop, ram or cdrom devices, or dm and md devices, whose disks are already included))')
     parser.add_argument('-n', '--dry-run', action='store_const',
                     const=True, default=False,
                     help='To report but not repair any sectors')
@@ -927,28 +4265,139 @@ if __name__ == "__main__":
                     help='Starting sector (default=0)')
     parser.add_argument('-a', '--action', action='store',
                     type=str, default="zerobad", 
-                        choices=["zerobad", "zerogood", "zerobaddmesg", "zerobadsmartctl", "zeroall", "recover", "quick"],
-                    help="Action: zerobad = (default) zero only the bad sectors to repair them; zerogood = zero only good sectors so the disk is less likely to fail during zeroing and is still noticably bad for returning; zerobaddmesg = use dmesg for sector list; zerobadsmartctl = use smartctl error log for sector list; zeroall = zero everything without scanning first; recover = if a bad sector can be read sometimes, then use that value to overwrite it so it is recovered old data rewritten to a good sector; quick = use dmesg and smartctl for sector list")
+                        choices=["zerobad", "zerogood", "zerobaddmesg", "zerobadsmartctl", "zerobadlist", "zeroall", "recover", "quick", "benchmark"],
+                    help="Action: zerobad = (default) zero only the bad sectors to repair them; zerogood = zero only good sectors so the disk is less likely to fail during zeroing and is still noticably bad for returning; zerobaddmesg = use the kernel log for sector list; zerobadsmartctl = use smartctl error log for sector list; zerobadlist = use only the --bad-in files for sector list; zeroall = zero everything without scanning first; recover = if a bad sector can be read sometimes, then use that value to overwrite it so it is recovered old data rewritten to a good sector; quick = use the kernel log and smartctl for sector list; benchmark = read only test comparing the speed of the fixup engines, scan backends and random data generators")
+    parser.add_argument('--smartctl-jobs', action='store', type=int, default=8,
+                    help="for zerobadsmartctl and quick, how many smartctl commands to run at the same time (default 8)")
+    parser.add_argument('--recover-tries', action='store', type=int, default=10,
+                    help="for action recover, how many times to try reading each bad sector before writing zeros (default 10)")
+    parser.add_argument('--recover-budget', action='store', type=float, default=60,
+                    help="for action recover, the most seconds to spend on reading each bad sector (default 60)")
+    parser.add_argument('--recover-jobs', action='store', type=int, default=4,
+                    help="for action recover, how many regions of bad sectors to work on at the same time (default 4)")
+    parser.add_argument('--kmsg-file', action='store', type=str, default=None,
+                    help="for zerobaddmesg and quick, read the kernel log from this file (eg. saved dmesg output or kern.log) instead of /dev/kmsg")
+    parser.add_argument('--follow-kmsg', action='store_const', const=True, default=False,
+                    help="for zerobaddmesg and quick, after repairing the sectors already in the kernel log, keep watching /dev/kmsg and repair new failed sectors as they are reported, until interrupted")
+    parser.add_argument('--zerogood-mode', action='store', type=str, default="twopass",
+                    choices=["singlepass", "twopass"],
+                    help="for action zerogood: twopass = (default) read everything first, then write everything except the bad sectors; singlepass = write each chunk right after it reads ok, which takes one pass over the disk instead of two")
+    parser.add_argument('--verify', action='store_const', const=True, default=False,
+                    help="for zerogood and zeroall, read back everything written (with O_DIRECT, in a thread behind the writes) and compare it to what was written")
     parser.add_argument('-r', '--random', action='store_const',
                     const=True, default=False,
-                    help='instead of zeros, use random data (not fully implemented; has no effect when using hdparm, so doesn\'t affect zerobad* on Linux)')
+                    help='for zerogood and zeroall, instead of zeros, use random data (repairs of single sectors still write zeros, except with --fixup-engine python)')
+    parser.add_argument('--random-seed', action='store', type=int, default=None,
+                    help="the seed for --random; the same seed makes the same data, so what was written can be verified later (default: a new random seed, which is logged)")
+    parser.add_argument('--throttle', action='store', type=str, default="sleep",
+                    choices=["adaptive", "sleep", "none"],
+                    help="for read scanning, how to leave room for other IO on the device: sleep = (default) always sleep --sleep-percent of the time; adaptive = watch the device's IO stats in sysfs, run flat out while nothing else uses the device, and back off when other IO goes over --target-util or --latency-budget; none = don't")
     parser.add_argument('-z', '--sleep-percent', action='store', type=float, default=20,
-                    help="for read scanning only, sleep some percentage of the time so the disk can't be busy with only repairing (default 20)")
-    parser.add_argument('--direct', action='store_const', const=True, default=False,
-                    help="enable experimental O_DIRECT support")
+                    help="for read scanning with --throttle sleep, sleep some percentage of the time so the disk can't be busy with only repairing (default 20)")
+    parser.add_argument('--target-util', action='store', type=float, default=80,
+                    help="for --throttle adaptive, the most percent of the time the device should be busy while something else also uses it (default 80)")
+    parser.add_argument('--latency-budget', action='store', type=float, default=50,
+                    help="for --throttle adaptive, back off when the average IO takes longer than this many ms while something else also uses the device (default 50)")
+    parser.add_argument('--max-rate', action='store', type=float, default=0,
+                    help="for read scanning, the most MB/s to read, in any throttle mode (default 0 = unlimited)")
+    parser.add_argument('--backend', action='store', type=str, default="buffered",
+                    choices=["buffered", "mmap", "direct"],
+                    help="for read scanning, how to read the device: buffered = (default) regular python file; mmap = mmap the whole device with O_DIRECT (what --direct does); direct = O_DIRECT reads into one reused aligned buffer, which bypasses the page cache")
+    parser.add_argument('--direct', action='store_const', dest='backend', const="mmap",
+                    help="enable experimental O_DIRECT support; same as --backend mmap (for the newer O_DIRECT reads into one buffer, use --backend direct)")
+    parser.add_argument('-q', '--queue-depth', action='store', type=int, default=1,
+                    help="for read scanning, how many reads to keep in flight; more than 1 uses a thread per read, which helps on SSDs, arrays and dm devices (default 1)")
+    parser.add_argument('-c', '--chunksize', action='store', type=int, default=1024*1024,
+                    help="for read scanning, the normal (and largest) read size in bytes (default 1048576)")
+    parser.add_argument('--health-interval', action='store', type=float, default=60,
+                    help="seconds between health checks of each device (SMART reallocated, pending and offline uncorrectable counts with smartctl, and the sysfs state); a device that disappears or goes offline stops, and the others go on; 0 disables the checks, including the one before starting (default 60)")
+    parser.add_argument('--health-max-growth', action='store', type=int, default=5000,
+                    help="stop a device when its reallocated, pending and offline uncorrectable counts together grow by more than this during the run; 0 never stops for this (default 5000)")
+    parser.add_argument('--stripes', action='store', type=int, default=1,
+                    help="for read scanning, how many threads read different parts of the device at the same time (default 1); more can be faster on RAID, dm, LVM and network block devices, and slower on a single disk")
+    parser.add_argument('--stripe-layout', action='store', type=str, default="interleaved", choices=["interleaved", "contiguous"],
+                    help="how --stripes splits the range: interleaved = (default) blocks of --stripe-size are dealt out to the stripes in turn, so they move along the device together; contiguous = each stripe gets one piece of the range")
+    parser.add_argument('--stripe-size', action='store', type=int, default=64*1024*1024,
+                    help="for --stripe-layout interleaved, the block size in bytes (default 67108864); it is rounded down to a multiple of --chunksize")
+    parser.add_argument('--write-chunksize', action='store', type=int, default=8*1024*1024,
+                    help="for zerogood and zeroall, the write size in bytes (default 8388608); with --write-strategy zeroout or discard, each ioctl does up to 256 MiB")
+    parser.add_argument('--write-strategy', action='store', type=str, default="auto",
+                    choices=["auto", "direct", "buffered", "zeroout", "discard"],
+                    help="how zerogood and zeroall write: direct = large O_DIRECT writes from one reused buffer; buffered = writes through the page cache; zeroout = BLKZEROOUT, the disk's write zeroes command if it has one (Linux only); discard = BLKDISCARD, reading back and writing zeros where discarded blocks don't read as zeros (Linux only, SSDs and thin LVs); auto = (default) direct for zerogood; for zeroall, zeroout if the device has write zeroes, else discard if it says discarded blocks read as zeros, else direct")
+    parser.add_argument('--min-chunksize', action='store', type=int, default=64*1024,
+                    help="for read scanning, the read size in bytes right after a read error; it doubles after every --grow-after clean reads, up to --chunksize (default 65536)")
+    parser.add_argument('--grow-after', action='store', type=int, default=16,
+                    help="for read scanning, how many clean reads before the read size doubles again (default 16)")
+    parser.add_argument('--slow-threshold', action='store', type=float, default=0,
+                    help="for read scanning, chunks that take longer than this many ms to read are read again in halves to find the slow sectors, which are listed at the end, eg. 1000; 0 to disable (default 0)")
+    parser.add_argument('--bad-out', action='store', type=str, default=None,
+                    help="write the bad, repaired and slow sectors found to this file as extents (start, length, state); {serial} in it is replaced by the device serial, which is required with more than one device")
+    parser.add_argument('--bad-format', action='store', type=str, default="text", choices=["text", "binary"],
+                    help="the format for --bad-out (default text); --bad-in reads either")
+    parser.add_argument('--bad-in', action='append', default=[],
+                    help="for zerobaddmesg, zerobadsmartctl, quick and zerobadlist, add the bad sectors in this extent file (from --bad-out, or a list of sectors one per line) to the list; can be given more than once, and {serial} works like in --bad-out")
+    parser.add_argument('--bad-exclude', action='append', default=[],
+                    help="remove the sectors in this extent file (any state) from the list, eg. the --bad-out of an earlier run, to skip what it already did; can be given more than once")
+    parser.add_argument('--rewrite-slow', action='store_const', const=True, default=False,
+                    help="for zerobad and recover, rewrite slow sectors with their own data, so the disk can remap them before they fail")
+    parser.add_argument('--locator', action='store', type=str, default="bisect",
+                    choices=["bisect", "linear"],
+                    help="for read scanning, how to find the bad sectors in a chunk that failed to read: bisect = (default) read it in halves down to single sectors; linear = use the fixup engine one sector at a time, up to 300 sectors past the last error")
+    parser.add_argument('--fixup-engine', action='store', type=str, default="auto",
+                    choices=["auto", "native", "hdparm", "python"],
+                    help="how to read and repair single sectors: native = pread/pwrite with O_DIRECT (Linux); hdparm = run hdparm for each sector (Linux); python = the same pread/pwrite IO as native, but only checks 300 sectors without going further after an error, and writes random data with --random (FreeBSD); auto = (default) native on Linux, else hdparm if found, else python")
+    parser.add_argument('--benchmark-sectors', action='store', type=int, default=1000,
+                    help="for action benchmark, how many sectors to read with each engine (default 1000)")
+    parser.add_argument('--benchmark-bytes', action='store', type=int, default=1024*1024*1024,
+                    help="for action benchmark, how many bytes to read with each scan backend (default 1073741824)")
+    parser.add_argument('--state-dir', action='store', type=str, default=None,
+                    help="where to save checkpoints, coverage maps and health history, named by device serial (and action for checkpoints), like /var/lib/diskRepair9; nothing is saved without it (default none)")
+    parser.add_argument('--coverage-granularity', action='store', type=int, default=1024*1024,
+                    help="bytes per granule of the coverage map in the state dir, which remembers which parts of the disk read clean, were bad, or were repaired (default 1048576)")
+    parser.add_argument('--unverified-only', action='store_const', const=True, default=False,
+                    help="for read scanning, skip the parts of the disk that the coverage map says already read clean, so only unverified, bad and repaired parts are read; single pass zerogood still reads and writes everything")
+    parser.add_argument('--checkpoint-interval', action='store', type=float, default=30,
+                    help="seconds between checkpoint saves (default 30)")
+    parser.add_argument('--resume', action='store_const', const=True, default=False,
+                    help="continue from the checkpoint of an interrupted run with the same action, instead of starting at --sector")
+    parser.add_argument('--events', action='store', type=str, default=None,
+                    help="append progress and error events to this file as json lines (start, progress, read_error, repair_ok, repair_failed, done); - for stdout")
+    parser.add_argument('--textfile-dir', action='store', type=str, default=None,
+                    help="write prometheus metrics for each device to diskRepair9-<serial>.prom in this dir, for the node_exporter textfile collector")
+    parser.add_argument('--metrics-interval', action='store', type=float, default=15,
+                    help="seconds between writes of the --textfile-dir metrics (default 15)")
     parser.add_argument('-p', '--parallel', action='store_const',
                     const=True, default=False,
-                    help='enable parallel mode, with one device per thread (intended to be used only with syslog)')
+                    help='enable parallel mode, with one process per device, and a status dashboard')
+    parser.add_argument('--refresh', action='store', type=float, default=1,
+                    help="for parallel mode, seconds between dashboard updates (default 1)")
 
     args = parser.parse_args()
 
     devices = get_devices(args.devices)
+
+    if( args.stripes < 1 ):
+        parser.error("--stripes has to be at least 1")
+    if( args.write_chunksize <= 0 or args.write_chunksize % 4096 ):
+        parser.error("--write-chunksize has to be a multiple of 4096")
+
+    list_actions = ["zerobaddmesg", "zerobadsmartctl", "quick", "zerobadlist"]
+    if( args.action == "zerobadlist" and not args.bad_in ):
+        parser.error("action zerobadlist needs --bad-in")
+    if( (args.bad_in or args.bad_exclude) and args.action not in list_actions ):
+        parser.error("--bad-in and --bad-exclude only work with actions %s" % (", ".join(list_actions)))
+    if( args.bad_out and len(devices) > 1 and "{serial}" not in args.bad_out ):
+        parser.error("--bad-out needs {serial} in it with more than one device")
+    if( args.rewrite_slow and not args.slow_threshold ):
+        parser.error("--rewrite-slow needs --slow-threshold")
+    for option, value in [("--resume", args.resume), ("--unverified-only", args.unverified_only)]:
+        if( value and not args.state_dir ):
+            parser.error("%s needs --state-dir" % (option))
     
     dry_run = args.dry_run
     debug_enabled = args.debug
     sector = args.sector
     end_sector = args.end_sector
-    sector_size = 512 # TODO: unhardcode this
     action = args.action
     syslog_enabled = args.syslog
     parallel = args.parallel
@@ -958,8 +4407,13 @@ if __name__ == "__main__":
         syslog.openlog("diskRepair9")
     if( args.dry_run ):
         info("DRY RUN")
+    random_seed = args.random_seed
+    if( random_seed == None ):
+        random_seed = int.from_bytes(os.urandom(8), "little")
+    if( args.random ):
+        info("random seed = %s" % (random_seed))
     if( args.parallel ):
-        init_threading()
+        init_multiprocessing()
 
 def list_to_string(l):
     ret = ""
@@ -981,41 +4435,37 @@ def main():
     
     # Verify that required shell commands exist
     shell_commands_required = []
-    if( action == "zerobaddmesg" ):
-        shell_commands_required=["dmesg", "grep", "awk", "sort"]
-    if os.uname().sysname == "Linux":
+    if( action in ["zerobadsmartctl", "quick"] ):
+        shell_commands_required += ["smartctl"]
+    if get_fixup_engine() == "hdparm":
         shell_commands_required += ["hdparm"]
     for cmd in shell_commands_required:
         require(cmd)
 
+    # read the logs once for all devices before starting, so parallel workers share them
+    if( action in ["zerobaddmesg", "quick"] ):
+        get_kernel_log()
+    if( action in ["zerobadsmartctl", "quick"] ):
+        collect_smart_sectors(devices, args.smartctl_jobs)
+
+    failed = 0
     if parallel:
-        workers = []
-        for device in devices:
-            worker = Worker(device)
-            workers += [worker]
-            worker.start()
-        
-        #wait for workers
-        while True:
-            done_count = 0
-            for w in workers:
-                if w.done:
-                    done_count += 1
-                elif w.device.status_txt:
-                    sameline("%s - %s" % (w.device, w.device.status_txt))
-
-                    for n in range(0, 3):
-                        if w.done:
-                            break
-                        time.sleep(1)
-            
-            if done_count == len(workers):
-                break
-            
-            time.sleep(0.1)
+        failed = run_parallel(devices)
     else:
         for device in devices:
-            run(device)
+            try:
+                run(device)
+            except DiskFailed as e:
+                # go on with the other devices
+                error(str(e))
+                failed += 1
+
+    if( args.follow_kmsg and action in ["zerobaddmesg", "quick"] ):
+        follow_kmsg(devices)
+
+    if failed:
+        error("%s of %s devices failed" % (failed, len(devices)))
+        exit(failed_disk)
 
 
 if __name__ == "__main__":